@@ -3,12 +3,40 @@ import json
 import subprocess
 import platform
 import os
-from PyQt5.QtGui import QIcon, QKeySequence, QFont
+import threading
+import time
+import re
+import math
+import bisect
+import heapq
+import queue
+import sqlite3
+import shutil
+import html
+import hashlib
+import codecs
+import marshal
+import urllib.request
+import urllib.parse
+from array import array
+from collections import OrderedDict
+from html.parser import HTMLParser
+from contextlib import contextmanager
+
+# Taken before the Qt imports so --startup-trace can include them
+STARTUP_BEGIN = time.perf_counter()
+
+from PyQt5.QtGui import QIcon, QKeySequence, QFont, QColor, QStandardItemModel, QStandardItem, QImage, QPixmap
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QLineEdit, QPushButton, QHBoxLayout,
                              QVBoxLayout, QWidget, QTabWidget, QFileDialog, QDialog,
-                             QLabel, QProgressBar, QMenu, QMessageBox, QStyleFactory, QComboBox, QSpinBox, QAction, QDialogButtonBox, QInputDialog, QScrollArea)
-from PyQt5.QtCore import QUrl, Qt, QSize, QProcess, QObject
+                             QLabel, QProgressBar, QMenu, QMessageBox, QStyleFactory, QComboBox, QSpinBox, QAction, QDialogButtonBox, QInputDialog, QCompleter, QCheckBox,
+                             QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QListView,
+                             QStyledItemDelegate, QStyleOptionProgressBar, QStyleOptionButton, QStyle, QProgressDialog)
+from PyQt5.QtCore import (QUrl, Qt, QSize, QProcess, QObject, QBuffer, QIODevice, QUrlQuery, QTimer, QByteArray, QDataStream, pyqtSignal, pyqtProperty,
+                          QAbstractListModel, QModelIndex, QRect, QEvent, QFileSystemWatcher, QFile)
 from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEngineDownloadItem, QWebEnginePage, QWebEngineProfile
+from PyQt5.QtWebEngineCore import (QWebEngineUrlScheme, QWebEngineUrlSchemeHandler, QWebEngineUrlRequestJob,
+                                   QWebEngineUrlRequestInterceptor, QWebEngineUrlRequestInfo, QWebEngineScript)
 from PyQt5.QtWebChannel import QWebChannel
 
 # Define the current version of the application
@@ -16,6 +44,32 @@ CURRENT_VERSION = "0.0 (Beta Build)"
 
 print(f"Application current version: {CURRENT_VERSION}")
 
+# Internal pages (history, ...) are served from this scheme by InternalSchemeHandler
+INTERNAL_SCHEME = b"pybrowser"
+HISTORY_URL = "pybrowser://history"
+NEW_TAB_URL = "pybrowser://newtab"
+HISTORY_PAGE_SIZE = 100
+# A filtered history page stops looking for matches after this many URLs
+HISTORY_SCAN_ROWS = 2000
+# History retention defaults: visits older than this many days (0 = keep forever)
+# and visits beyond this count, oldest first, are removed
+HISTORY_RETENTION_DAYS = 90
+HISTORY_MAX_VISITS = 200000
+# EasyList-syntax filter lists (*.txt) for content blocking; the compiled cache is kept in the profile
+FILTER_LISTS_DIR = "filter_lists"
+FILTER_CACHE_NAME = "filter_lists.compiled"
+# User themes (*.css, see "Starter Code for Theme API")
+THEMES_DIR = "themes"
+# Each profile's data lives in PROFILES_DIR/<first>_<last>
+PROFILES_DIR = "profiles"
+DARK_MODE_SCRIPT_NAME = "pybrowser-dark-mode"
+
+SEARCH_ENGINE_URLS = {
+    'Google': 'https://www.google.com/search',
+    'Bing': 'https://www.bing.com/search',
+    'DuckDuckGo': 'https://duckduckgo.com/'
+}
+
 def is_dark_mode_windows() -> bool:
     try:
         import winreg
@@ -42,8 +96,7 @@ def is_dark_mode() -> bool:
         return is_dark_mode_macos()
     return False
 
-def apply_dark_theme(app: QApplication):
-    dark_stylesheet = """
+DARK_STYLESHEET = """
     QWidget {
         background-color: #2b2b2b;
         color: #dcdcdc;
@@ -82,10 +135,8 @@ def apply_dark_theme(app: QApplication):
         background-color: #6c6c6c;
     }
     """
-    app.setStyleSheet(dark_stylesheet)
 
-def apply_light_theme(app: QApplication):
-    light_stylesheet = """
+LIGHT_STYLESHEET = """
     QWidget {
         background-color: #ffffff;
         color: #000000;
@@ -117,155 +168,2878 @@ def apply_light_theme(app: QApplication):
         background-color: #d4d4d4;
     }
     """
-    app.setStyleSheet(light_stylesheet)
+
+BUILTIN_THEMES = {'Light': LIGHT_STYLESHEET, 'Dark': DARK_STYLESHEET}
+
+def split_declarations(body: str):
+    # Splits a rule body on the semicolons that end declarations, not those inside
+    # url(...) or quoted strings (e.g. url(data:image/png;base64,...)); None if a
+    # bracket or quote is left open
+    declarations = []
+    start = 0
+    depth = 0
+    quote = None
+    for position, character in enumerate(body):
+        if quote:
+            if character == quote and body[position - 1] != '\\':
+                quote = None
+        elif character in '"\'':
+            quote = character
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            if depth == 0:
+                return None
+            depth -= 1
+        elif character == ';' and depth == 0:
+            declarations.append(body[start:position])
+            start = position + 1
+    if quote or depth:
+        return None
+    declarations.append(body[start:])
+    return declarations
+
+def validate_stylesheet(text: str):
+    # Checks a theme's Qt stylesheet rule by rule and returns (normalized stylesheet,
+    # None) or (None, error message)
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    rules = []
+    position = 0
+    for match in re.finditer(r'([^{}]*)\{([^{}]*)\}', text):
+        selector = match.group(1).strip()
+        if text[position:match.start()].strip():
+            return None, f"unexpected text before '{selector}'"
+        if not selector:
+            return None, "rule without a selector"
+        parts = split_declarations(match.group(2))
+        if parts is None:
+            return None, f"unbalanced brackets or quotes in '{selector}'"
+        declarations = []
+        for declaration in parts:
+            declaration = declaration.strip()
+            if not declaration:
+                continue
+            name, _, value = declaration.partition(':')
+            name = name.strip().lower()
+            if not re.fullmatch(r'-?[a-z][a-z0-9-]*', name) or not value.strip():
+                return None, f"invalid declaration '{declaration}' in '{selector}'"
+            declarations.append(f"{name}: {value.strip()};")
+        rules.append(f"{selector} {{ {' '.join(declarations)} }}")
+        position = match.end()
+    if text[position:].strip():
+        return None, "unbalanced braces"
+    return "\n".join(rules), None
+
+class ThemeEngine(QObject):
+    # Built-in themes plus user themes from THEMES_DIR/*.css (a file named like a
+    # built-in theme replaces it). Theme files are validated once and the result is
+    # cached until the file changes; a QFileSystemWatcher re-applies the active theme
+    # when its file is edited. The theme and the font size setting go out as a single
+    # application stylesheet, and only when that stylesheet actually changes.
+    theme_applied = pyqtSignal()
+    # Rules whose background is the window's own rather than a single control's
+    BASE_SELECTORS = {'*', 'QWidget', 'QMainWindow', 'QDialog'}
+
+    def __init__(self, directory: str = THEMES_DIR, parent=None):
+        super().__init__(parent)
+        self.directory = directory
+        self.themes = {}  # name -> file path, or None for a built-in theme
+        self.cache = {}  # path -> ((mtime, size), stylesheet or None when invalid)
+        self.current_theme = None
+        self.font_size = None
+        self.applied = None
+        self.last_apply_ms = 0.0
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.on_file_changed)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        self.discover()
+
+    def discover(self):
+        self.themes = {name: None for name in BUILTIN_THEMES}
+        try:
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith('.css'))
+        except OSError:
+            return
+        if self.directory not in self.watcher.directories():
+            self.watcher.addPath(self.directory)
+        for name in names:
+            path = os.path.join(self.directory, name)
+            self.themes[os.path.splitext(name)[0]] = path
+            if path not in self.watcher.files():
+                self.watcher.addPath(path)
+
+    def theme_names(self) -> list:
+        return [name for name in self.themes if self.stylesheet(name) is not None]
+
+    def stylesheet(self, name: str):
+        if name not in self.themes:
+            return None
+        path = self.themes[name]
+        if path is None:
+            return BUILTIN_THEMES[name]
+        try:
+            status = os.stat(path)
+        except OSError:
+            return None
+        key = (status.st_mtime_ns, status.st_size)
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                stylesheet, error = validate_stylesheet(file.read())
+        except (OSError, UnicodeDecodeError) as e:
+            stylesheet, error = None, str(e)
+        if error:
+            print(f"Error in theme {path}: {error}")
+        self.cache[path] = (key, stylesheet)
+        return stylesheet
+
+    def apply(self, name: str, font_size: int):
+        start = time.perf_counter()
+        stylesheet = self.stylesheet(name)
+        if stylesheet is None:
+            name = 'Light'
+            stylesheet = BUILTIN_THEMES[name]
+        self.current_theme = name
+        self.font_size = font_size
+        combined = f"{stylesheet}\n* {{ font-size: {font_size}px; }}"
+        if combined == self.applied:
+            return
+        QApplication.instance().setStyleSheet(combined)
+        self.applied = combined
+        self.last_apply_ms = (time.perf_counter() - start) * 1000
+        print(f"Applied theme {name} in {self.last_apply_ms:.1f} ms")
+        self.theme_applied.emit()
+
+    def is_dark(self, name: str) -> bool:
+        # Judged from the theme's window background, or failing that its text colour
+        stylesheet = self.stylesheet(name)
+        if stylesheet is None:
+            return False
+        background = text = None
+        for selectors, body in re.findall(r'([^{}]*)\{([^{}]*)\}', stylesheet):
+            if not self.BASE_SELECTORS & {selector.strip() for selector in selectors.split(',')}:
+                continue
+            for declaration in split_declarations(body) or []:
+                property_name, _, value = declaration.partition(':')
+                color = QColor(value.strip())
+                if not color.isValid():
+                    continue
+                if property_name.strip() in ('background-color', 'background'):
+                    background = color
+                elif property_name.strip() == 'color':
+                    text = color
+        if background is not None:
+            return background.lightness() < 128
+        return text is not None and text.lightness() >= 128
+
+    def on_file_changed(self, path: str):
+        # Editors often save by replacing the file, which drops it from the watcher
+        if os.path.exists(path) and path not in self.watcher.files():
+            self.watcher.addPath(path)
+        if self.current_theme is not None and self.themes.get(self.current_theme) == path:
+            self.apply(self.current_theme, self.font_size)
+
+    def on_directory_changed(self, _):
+        self.discover()
+        if self.current_theme is not None:
+            self.apply(self.current_theme, self.font_size)
+
+class PersistenceService:
+    # Owns all writes to profile data. Callers only queue work and a single writer
+    # thread does the disk I/O:
+    #  - work is queued under a key (a file or database path); queuing again under
+    #    the same key supersedes whatever was still pending for it
+    #  - file replacements go to a temp file that is fsynced and renamed over the original
+    #  - flush() blocks until the queue is empty; used at shutdown and by worker threads
+    #    that read from their own connection
+    # max_stall_ms is the longest time a GUI-thread call into the service took.
+    def __init__(self):
+        self.pending = {}  # key -> [job, due time]
+        self.active = None  # key the writer thread is working on
+        self.running = True
+        self.max_stall_ms = 0.0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="PersistenceWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, key: str, job, delay: float = 0):
+        # job() runs on the writer thread; with a delay, further submissions within
+        # that time are merged into one
+        start = time.perf_counter()
+        with self.condition:
+            if self.running:
+                due = time.monotonic() + delay
+                entry = self.pending.get(key)
+                self.pending[key] = [job, min(due, entry[1]) if entry else due]
+                self.condition.notify()
+        if not self.running:
+            self.perform(key, job)
+        self.record_stall(start)
+
+    def write(self, path: str, render, delay: float = 0):
+        # render() runs on the writer thread and returns the file's new contents
+        self.submit(path, lambda: self.replace_file(path, render()), delay)
+
+    def write_json(self, path: str, data):
+        # Only the top-level container is copied; nested values must not be changed in place
+        snapshot = dict(data) if isinstance(data, dict) else list(data)
+        self.write(path, lambda: json.dumps(snapshot))
+
+    def flush(self, key: str = None, wait: bool = True):
+        # Runs everything queued (or everything queued under one key) now
+        start = time.perf_counter()
+        with self.condition:
+            for pending_key, entry in self.pending.items():
+                if key is None or pending_key == key:
+                    entry[1] = 0
+            self.condition.notify()
+            if wait:
+                self.condition.wait_for(lambda: not self.is_pending(key))
+        self.record_stall(start)
+
+    def is_pending(self, key: str = None) -> bool:
+        if key is None:
+            return bool(self.pending) or self.active is not None
+        return key in self.pending or self.active == key
+
+    def close(self):
+        # Work queued after this runs synchronously on the caller's thread
+        if not self.running:
+            return
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def record_stall(self, start: float):
+        if threading.current_thread() is threading.main_thread():
+            self.max_stall_ms = max(self.max_stall_ms, (time.perf_counter() - start) * 1000)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    due = [key for key, entry in self.pending.items() if entry[1] <= now]
+                    if due or not self.running:
+                        break
+                    timeout = min((entry[1] for entry in self.pending.values()), default=now + 60) - now
+                    self.condition.wait(timeout)
+                if not due:
+                    return
+                key = due[0]
+                job, _ = self.pending.pop(key)
+                self.active = key
+            self.perform(key, job)
+            with self.condition:
+                self.active = None
+                self.condition.notify_all()
+
+    def perform(self, key: str, job):
+        try:
+            job()
+        except (OSError, ValueError, TypeError, sqlite3.Error) as e:
+            print(f"Error saving {key}: {e}")
+
+    @staticmethod
+    def replace_file(path: str, text: str):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+def legacy_profile_paths(profile_name: str) -> list:
+    # Where a profile's data lived before profiles got their own directory
+    suffixes = ("_settings.json", "_history.json", "_history.jsonl", "_session.json",
+                "_content.db", "_content.db-wal", "_content.db-shm", "_web")
+    return [profile_name + suffix for suffix in suffixes]
+
+def read_json_file(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+class ProfileStore:
+    # One profile's settings, history, downloads and session in a SQLite database
+    # (WAL mode) in the profile's own directory. Reads go through a connection on the
+    # GUI thread and only fetch what they are asked for; changes are queued and the
+    # persistence writer thread commits everything queued in one transaction. The
+    # writer thread also creates and upgrades the database, and copies in any
+    # legacy files, before the store is first read.
+    #
+    # History is one record per URL (visit count, first/last visit, interned host)
+    # plus a visit log of (url id, time) rows. Retention trims the visit log and
+    # drops URLs and hosts that no longer have visits; on_history_purged is then
+    # called (on the writer thread) with those URLs so their page text and
+    # thumbnails go too.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, host TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, title TEXT NOT NULL,
+                                         host_id INTEGER NOT NULL, visit_count INTEGER NOT NULL,
+                                         first_visit REAL NOT NULL, last_visit REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS urls_last_visit ON urls (last_visit, id);
+        CREATE INDEX IF NOT EXISTS urls_by_frecency ON urls (visit_count DESC, last_visit DESC);
+        CREATE TABLE IF NOT EXISTS visits (id INTEGER PRIMARY KEY, url_id INTEGER NOT NULL, visited_at REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS visits_url ON visits (url_id);
+        CREATE INDEX IF NOT EXISTS visits_visited_at ON visits (visited_at);
+        CREATE TABLE IF NOT EXISTS downloads (filename TEXT PRIMARY KEY, state TEXT NOT NULL,
+                                              started_at REAL NOT NULL DEFAULT 0,
+                                              resumable INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS sessions (name TEXT PRIMARY KEY, state TEXT NOT NULL);
+    """
+    # Download progress is saved often, so it is merged over this many seconds
+    DOWNLOAD_FLUSH_INTERVAL = 2.0
+    # Retention runs again with the last settings after this many new visits, or
+    # with the first commit this long after it last ran
+    COMPACT_EVERY_VISITS = 1000
+    COMPACT_INTERVAL = 24 * 3600
+
+    def __init__(self, persistence: PersistenceService, directory: str, legacy_profile_name: str = None):
+        self.persistence = persistence
+        self.directory = directory
+        self.path = os.path.join(directory, "profile.db")
+        self.legacy_profile_name = legacy_profile_name
+        self.connection = None
+        self.write_connection = None  # Opened by the writer thread, which also creates and upgrades the database
+        self.host_ids = {}
+        self.lock = threading.Lock()
+        # Changes waiting for the next commit
+        self.settings = None
+        self.session = None
+        self.history_cleared = False
+        self.visits = []
+        self.retention = None
+        self.retention_settings = None  # Last (max age days, max visits) applied
+        self.visits_since_compaction = 0
+        self.last_compaction = time.monotonic()
+        self.downloads = {}  # filename -> state, or None to delete it
+        self.download_write_counts = {}
+        self.on_history_purged = None
+        # The first commit sets up the database; nothing can be read before that
+        self.persistence.submit(self.path, self.commit)
+        self.persistence.flush(self.path)
+        self.connection = sqlite3.connect(self.path)
+
+    def open_database(self):
+        # Called on the writer thread
+        os.makedirs(self.directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        # Only takes effect for a new database; lets compaction hand pages back
+        connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(self.SCHEMA)
+        self.upgrade_history_table(connection)
+        self.upgrade_downloads_table(connection)
+        if self.legacy_profile_name:
+            self.import_legacy_files(connection, self.legacy_profile_name)
+        return connection
+
+    def upgrade_history_table(self, connection):
+        # The first version of the store kept one flat row per visit
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'history'").fetchone():
+            with connection:
+                self.record_visits(connection, connection.execute(
+                    "SELECT title, url, visited_at FROM history ORDER BY id").fetchall())
+                connection.execute("DROP TABLE history")
+
+    def upgrade_downloads_table(self, connection):
+        # Downloads used to be only (filename, state); the columns let the download
+        # list page saved entries in by start time
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(downloads)")}
+        if 'started_at' not in columns:
+            with connection:
+                connection.execute("ALTER TABLE downloads ADD COLUMN started_at REAL NOT NULL DEFAULT 0")
+                connection.execute("ALTER TABLE downloads ADD COLUMN resumable INTEGER NOT NULL DEFAULT 0")
+                connection.executemany(
+                    "UPDATE downloads SET started_at = ?, resumable = ? WHERE filename = ?",
+                    [self.download_row(filename, json.loads(state))[2:] + (filename,) for filename, state in
+                     connection.execute("SELECT filename, state FROM downloads").fetchall()])
+        connection.execute("CREATE INDEX IF NOT EXISTS downloads_by_start ON downloads (resumable, started_at, filename)")
+
+    @staticmethod
+    def download_row(filename: str, state: dict) -> tuple:
+        # Segmented downloads that weren't canceled are restored as soon as the list opens
+        resumable = bool(state.get('resume')) and not state.get('is_canceled')
+        return filename, json.dumps(state), state.get('started_at') or 0, int(resumable)
+
+    def import_legacy_files(self, connection, profile_name: str):
+        # Copies a profile kept as loose files in the working directory into the store
+        # once; the old files are renamed (or moved into the profile directory)
+        settings = read_json_file(f"{profile_name}_settings.json")
+        session = read_json_file(f"{profile_name}_session.json")
+        downloads = read_json_file("downloads.json")  # Was shared by every user
+        history = self.read_legacy_history(profile_name)
+        with connection:
+            if isinstance(settings, dict):
+                connection.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                                       [(key, json.dumps(value)) for key, value in settings.items()])
+            if isinstance(session, dict):
+                connection.execute("INSERT OR REPLACE INTO sessions (name, state) VALUES ('last', ?)",
+                                   (json.dumps(session),))
+            if isinstance(downloads, dict):
+                connection.executemany("INSERT OR REPLACE INTO downloads (filename, state, started_at, resumable) "
+                                       "VALUES (?, ?, ?, ?)", [self.download_row(filename, state)
+                                                               for filename, state in downloads.items()])
+            self.record_visits(connection, history)
+        for path in (f"{profile_name}_settings.json", f"{profile_name}_session.json", "downloads.json",
+                     f"{profile_name}_history.jsonl", f"{profile_name}_history.json"):
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        for path, name in ((f"{profile_name}_web", "web"), (f"{profile_name}_content.db", "content.db"),
+                           (f"{profile_name}_content.db-wal", "content.db-wal"),
+                           (f"{profile_name}_content.db-shm", "content.db-shm")):
+            if os.path.exists(path) and not os.path.exists(os.path.join(self.directory, name)):
+                os.replace(path, os.path.join(self.directory, name))
+
+    @staticmethod
+    def read_legacy_history(profile_name: str) -> list:
+        entries = []
+        try:
+            with open(f"{profile_name}_history.jsonl", "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                        entries.append((record[0], record[1], record[2] if len(record) > 2 else 0))
+                    except (ValueError, TypeError, IndexError, KeyError):
+                        continue
+        except FileNotFoundError:
+            legacy_entries = read_json_file(f"{profile_name}_history.json") or []
+            entries = [(entry[0], entry[1], 0) for entry in legacy_entries]
+        return entries
+
+    def read(self, query: str, parameters=()) -> list:
+        # WAL lets this see the last commit without waiting for the writer thread, so
+        # changes still queued aren't visible yet; callers that need them say so
+        return self.connection.execute(query, parameters).fetchall()
+
+    def queue(self, delay: float = 0):
+        if self.connection is not None:
+            self.persistence.submit(self.path, self.commit, delay)
+
+    def flush(self, wait: bool = True):
+        self.persistence.flush(self.path, wait)
+
+    def load_settings(self) -> dict:
+        return {key: json.loads(value) for key, value in self.read("SELECT key, value FROM settings")}
+
+    def save_settings(self, settings: dict):
+        with self.lock:
+            self.settings = dict(settings)
+        self.queue()
+
+    def has_history(self) -> bool:
+        with self.lock:
+            if self.visits:
+                return True
+            if self.history_cleared:
+                return False
+        return bool(self.read("SELECT 1 FROM urls LIMIT 1"))
+
+    def retained_visit_count(self, max_age_days: int) -> int:
+        # Visits the next compaction keeps by age; they all count against the visit limit
+        cutoff = time.time() - max_age_days * 86400 if max_age_days > 0 else 0
+        with self.lock:
+            pending = sum(1 for _, _, visited_at in self.visits if not 0 < visited_at < cutoff)
+            if self.history_cleared:
+                return pending
+        return pending + self.read("SELECT COUNT(*) FROM visits WHERE NOT (visited_at > 0 AND visited_at < ?)",
+                                   (cutoff,))[0][0]
+
+    def pending_visits(self) -> list:
+        # Visits not yet handed to the writer thread, as (title, url, visited at)
+        with self.lock:
+            return list(self.visits)
+
+    def history_page(self, before: tuple = None, query: str = '', limit: int = HISTORY_PAGE_SIZE) -> dict:
+        # URLs newest-visit first. The cursor is "last visit,id" of the last URL looked
+        # at; it carries the time itself so a URL visited again while paging doesn't
+        # move it. A filtered page looks at no more than HISTORY_SCAN_ROWS URLs and may
+        # come back short (even empty) with a cursor to carry on from.
+        cursor, parameters = ("WHERE (last_visit, id) < (?, ?)", list(before)) if before is not None else ("", [])
+        if not query:
+            rows = self.read(f"SELECT id, title, url, visit_count, last_visit FROM urls {cursor} "
+                             f"ORDER BY last_visit DESC, id DESC LIMIT ?", parameters + [limit])
+            scan_end = rows[-1] if len(rows) == limit else None
+        else:
+            pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            scanned = (f"SELECT id, title, url, visit_count, last_visit FROM urls {cursor} "
+                       f"ORDER BY last_visit DESC, id DESC LIMIT ?")
+            rows = self.read(f"SELECT * FROM ({scanned}) WHERE title LIKE ? ESCAPE '\\' OR url LIKE ? ESCAPE '\\' "
+                             f"ORDER BY last_visit DESC, id DESC LIMIT ?",
+                             parameters + [HISTORY_SCAN_ROWS, pattern, pattern, limit])
+            if len(rows) == limit:
+                scan_end = rows[-1]
+            else:
+                # The last URL looked at, if the scan stopped before the end of the history
+                last = self.read(f"SELECT id, last_visit FROM urls {cursor} ORDER BY last_visit DESC, id DESC "
+                                 f"LIMIT 1 OFFSET ?", parameters + [HISTORY_SCAN_ROWS - 1])
+                scan_end = last[0] if last else None
+        entries = [{'title': title, 'url': url, 'visits': visit_count} for _, title, url, visit_count, _ in rows]
+        return {'entries': entries, 'next': f"{scan_end[-1]!r},{scan_end[0]}" if scan_end else None}
+
+    def url_records(self):
+        # Called from a worker thread, so it uses a connection of its own. Returns
+        # (url, title, visit count, last visit) for every URL and the id of the
+        # newest visit they include.
+        self.persistence.flush(self.path)
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute("BEGIN")
+            records = connection.execute("SELECT url, title, visit_count, last_visit FROM urls").fetchall()
+            newest_visit = connection.execute("SELECT COALESCE(MAX(id), 0) FROM visits").fetchone()[0]
+            connection.rollback()
+        finally:
+            connection.close()
+        return records, newest_visit
+
+    def visits_since(self, visit_id: int) -> list:
+        return self.read("SELECT urls.title, urls.url, visits.visited_at FROM visits JOIN urls "
+                         "ON urls.id = visits.url_id WHERE visits.id > ? ORDER BY visits.id", (visit_id,))
+
+    def top_sites(self, limit: int = 8) -> list:
+        return self.read("SELECT url, title FROM urls WHERE url LIKE 'http%' "
+                         "ORDER BY visit_count DESC, last_visit DESC LIMIT ?", (limit,))
+
+    def add_visit(self, title: str, url: str, visited_at: float):
+        with self.lock:
+            self.visits.append((title, url, visited_at))
+        self.queue()
+
+    def add_visits(self, visits: list):
+        with self.lock:
+            self.visits.extend(visits)
+        self.queue()
+
+    def clear_history(self):
+        with self.lock:
+            self.history_cleared = True
+            self.visits = []
+        self.queue()
+
+    def apply_history_retention(self, max_age_days: int, max_visits: int):
+        with self.lock:
+            self.retention = self.retention_settings = (max_age_days, max_visits)
+        self.queue()
+
+    def host_id(self, connection, host: str) -> int:
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            connection.execute("INSERT OR IGNORE INTO hosts (host) VALUES (?)", (host,))
+            host_id = connection.execute("SELECT id FROM hosts WHERE host = ?", (host,)).fetchone()[0]
+            self.host_ids[host] = host_id
+        return host_id
+
+    def record_visits(self, connection, visits):
+        for title, url, visited_at in visits:
+            row = connection.execute("SELECT id FROM urls WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                host = urllib.parse.urlsplit(url).hostname or ''
+                url_id = connection.execute(
+                    "INSERT INTO urls (url, title, host_id, visit_count, first_visit, last_visit) "
+                    "VALUES (?, ?, ?, 1, ?, ?)",
+                    (url, title or '', self.host_id(connection, host), visited_at, visited_at)).lastrowid
+            else:
+                url_id = row[0]
+                connection.execute(
+                    "UPDATE urls SET visit_count = visit_count + 1, first_visit = MIN(first_visit, ?1), "
+                    "last_visit = MAX(last_visit, ?1), title = CASE WHEN ?2 != '' THEN ?2 ELSE title END "
+                    "WHERE id = ?3", (visited_at, title or '', url_id))
+            connection.execute("INSERT INTO visits (url_id, visited_at) VALUES (?, ?)", (url_id, visited_at))
+
+    def compact_history(self, connection, max_age_days: int, max_visits: int):
+        # Returns the URLs that no longer have any visits, or None if nothing expired
+        # Visits with no timestamp (imported from before timestamps) only go by count
+        cutoff = time.time() - max_age_days * 86400 if max_age_days > 0 else 0
+        # The visit log isn't in time order once another browser's history is imported
+        row = connection.execute("SELECT visited_at, id FROM visits ORDER BY visited_at DESC, id DESC "
+                                 "LIMIT 1 OFFSET ?", (max_visits,)).fetchone() if max_visits > 0 else None
+        parameters = (cutoff,) + (tuple(row) if row else (-1, -1))
+        expired = "(visited_at > 0 AND visited_at < ?) OR (visited_at, id) <= (?, ?)"
+        url_ids = [(url_id,) for url_id, in connection.execute(
+            f"SELECT DISTINCT url_id FROM visits WHERE {expired}", parameters)]
+        if not url_ids:
+            return None
+        connection.execute(f"DELETE FROM visits WHERE {expired}", parameters)
+        connection.executemany(
+            "UPDATE urls SET visit_count = (SELECT COUNT(*) FROM visits WHERE url_id = ?1), "
+            "first_visit = COALESCE((SELECT MIN(visited_at) FROM visits WHERE url_id = ?1), first_visit) "
+            "WHERE id = ?1", url_ids)
+        purged = [url for url, in connection.execute("SELECT url FROM urls WHERE visit_count = 0")]
+        connection.execute("DELETE FROM urls WHERE visit_count = 0")
+        connection.execute("DELETE FROM hosts WHERE id NOT IN (SELECT host_id FROM urls)")
+        self.host_ids = {}
+        return purged
+
+    def load_resumable_downloads(self) -> list:
+        return [json.loads(state) for state, in
+                self.read("SELECT state FROM downloads WHERE resumable = 1 ORDER BY rowid")]
+
+    def download_page(self, before: tuple = None, limit: int = 100) -> list:
+        # Other saved downloads, newest first; the cursor is (started at, filename) of
+        # the last one on the previous page
+        cursor, parameters = ("AND (started_at, filename) < (?, ?)", list(before)) if before is not None else ("", [])
+        rows = self.read(f"SELECT filename, state, started_at FROM downloads WHERE resumable = 0 {cursor} "
+                         f"ORDER BY started_at DESC, filename DESC LIMIT ?", parameters + [limit])
+        return [(dict(json.loads(state), filename=filename), (started_at, filename))
+                for filename, state, started_at in rows]
+
+    def save_download(self, state: dict, flush: bool = False):
+        with self.lock:
+            self.downloads[state['filename']] = dict(state)
+        self.queue(0 if flush else self.DOWNLOAD_FLUSH_INTERVAL)
+
+    def remove_download(self, filename: str):
+        with self.lock:
+            self.downloads[filename] = None
+            self.download_write_counts.pop(filename, None)
+        self.queue()
+
+    def download_write_count(self, filename: str) -> int:
+        return self.download_write_counts.get(filename, 0)
+
+    def load_session(self):
+        rows = self.read("SELECT state FROM sessions WHERE name = 'last'")
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_session(self, session: dict):
+        with self.lock:
+            self.session = session
+        self.queue()
+
+    def commit(self):
+        # Called on the writer thread
+        with self.lock:
+            settings, self.settings = self.settings, None
+            session, self.session = self.session, None
+            history_cleared, self.history_cleared = self.history_cleared, False
+            visits, self.visits = self.visits, []
+            retention, self.retention = self.retention, None
+            self.visits_since_compaction += len(visits)
+            now = time.monotonic()
+            if retention is None and self.retention_settings is not None and (
+                    self.visits_since_compaction >= self.COMPACT_EVERY_VISITS or
+                    now - self.last_compaction >= self.COMPACT_INTERVAL):
+                retention = self.retention_settings
+            if retention is not None:
+                self.visits_since_compaction = 0
+                self.last_compaction = now
+            downloads, self.downloads = self.downloads, {}
+            for filename, state in downloads.items():
+                if state is not None:
+                    self.download_write_counts[filename] = self.download_write_counts.get(filename, 0) + 1
+        if self.write_connection is None:
+            self.write_connection = self.open_database()
+        with self.write_connection as connection:
+            if settings is not None:
+                connection.execute("DELETE FROM settings")
+                connection.executemany("INSERT INTO settings (key, value) VALUES (?, ?)",
+                                       [(key, json.dumps(value)) for key, value in settings.items()])
+            if session is not None:
+                connection.execute("INSERT OR REPLACE INTO sessions (name, state) VALUES ('last', ?)",
+                                   (json.dumps(session),))
+            if history_cleared:
+                connection.execute("DELETE FROM visits")
+                connection.execute("DELETE FROM urls")
+                connection.execute("DELETE FROM hosts")
+                self.host_ids = {}
+            self.record_visits(connection, visits)
+            purged = self.compact_history(connection, *retention) if retention is not None else None
+            for filename, state in downloads.items():
+                if state is None:
+                    connection.execute("DELETE FROM downloads WHERE filename = ?", (filename,))
+                else:
+                    connection.execute("INSERT INTO downloads (filename, state, started_at, resumable) "
+                                       "VALUES (?, ?, ?, ?) ON CONFLICT (filename) DO UPDATE SET "
+                                       "state = excluded.state, started_at = excluded.started_at, "
+                                       "resumable = excluded.resumable", self.download_row(filename, state))
+        if history_cleared or purged is not None:
+            self.write_connection.execute("PRAGMA incremental_vacuum")
+        if purged and self.on_history_purged is not None:
+            self.on_history_purged(purged)
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.close()
+        self.connection = None
+        if self.write_connection is not None:
+            self.write_connection.close()
+            self.write_connection = None
+
+class BookmarkParser(HTMLParser):
+    # Collects (title, url, added at) for each <A HREF=... ADD_DATE=...> in a
+    # Netscape-format bookmarks export
+    def __init__(self):
+        super().__init__()
+        self.bookmarks = []
+        self.current = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        attrs = dict(attrs)
+        url = attrs.get('href') or ''
+        if not url.startswith(('http:', 'https:')):
+            return
+        try:
+            added = float(attrs.get('add_date') or 0)
+        except ValueError:
+            added = 0
+        # Some exporters write microseconds instead of seconds
+        self.current = [url, '', added / 1000000 if added > 1e11 else added]
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.current[1] += data
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.current is not None:
+            url, title, added = self.current
+            self.bookmarks.append((title.strip(), url, added))
+            self.current = None
+
+class HistoryImporter(QObject):
+    # Imports another browser's history into a ProfileStore on a worker thread:
+    # Chrome's "History" and Firefox's "places.sqlite" databases, and bookmark
+    # exports in the Netscape HTML format (each bookmark becomes one visit at the
+    # time it was added). Rows are streamed in batches and each batch is committed
+    # before the next one is read, so memory use doesn't grow with the import.
+    # Visits that history retention would delete at the next compaction are left out
+    # and counted instead. The visit limit is shared with the visits the profile
+    # already has; databases are read newest first so it keeps the most recent
+    # visits, and reading stops once it is reached.
+    progress = pyqtSignal('qint64', 'qint64')  # work done, total (rows, or bytes for bookmarks)
+    finished = pyqtSignal(int, int, str)  # entries imported, entries left out, error message ('' on success)
+    BATCH_SIZE = 5000
+    READ_SIZE = 64 * 1024
+    # Chrome counts microseconds from 1601-01-01, Firefox from 1970-01-01
+    QUERIES = {
+        'chrome': ("SELECT COUNT(*) FROM visits",
+                   "SELECT urls.url, urls.title, visits.visit_time / 1000000.0 - 11644473600 "
+                   "FROM visits JOIN urls ON urls.id = visits.url ORDER BY visits.visit_time DESC"),
+        'firefox': ("SELECT COUNT(*) FROM moz_historyvisits",
+                    "SELECT moz_places.url, moz_places.title, moz_historyvisits.visit_date / 1000000.0 "
+                    "FROM moz_historyvisits JOIN moz_places ON moz_places.id = moz_historyvisits.place_id "
+                    "ORDER BY moz_historyvisits.visit_date DESC"),
+    }
+
+    def __init__(self, store: ProfileStore, path: str, max_age_days: int, max_visits: int,
+                 existing_visits: int = 0, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.path = path
+        self.max_age_days = max_age_days
+        self.max_visits = max_visits
+        self.existing_visits = existing_visits
+        self.cancelled = threading.Event()
+        self.limit_reached = False  # The rest of the source was left out
+
+    @staticmethod
+    def open_database(path: str):
+        # immutable=1 reads without taking locks, so this works while the other browser is running
+        return sqlite3.connect(QUrl.fromLocalFile(os.path.abspath(path)).toString() + "?immutable=1", uri=True)
+
+    @classmethod
+    def detect(cls, path: str):
+        with open(path, "rb") as file:
+            header = file.read(512)
+        if header.startswith(b"SQLite format 3\x00"):
+            connection = cls.open_database(path)
+            try:
+                tables = {name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            finally:
+                connection.close()
+            if {'urls', 'visits'} <= tables:
+                return 'chrome'
+            if {'moz_places', 'moz_historyvisits'} <= tables:
+                return 'firefox'
+        elif b"netscape-bookmark-file" in header.lower():
+            return 'bookmarks'
+        return None
+
+    def start(self):
+        threading.Thread(target=self.run, name="HistoryImporter", daemon=True).start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        imported = 0
+        skipped = 0
+        error = ''
+        # Same rules as ProfileStore.compact_history; visits without a time only go by count
+        cutoff = time.time() - self.max_age_days * 86400 if self.max_age_days > 0 else 0
+        try:
+            kind = self.detect(self.path)
+            if kind is None:
+                raise ValueError("This is not a Chrome or Firefox history database or an exported bookmarks file.")
+            batches = self.read_bookmarks() if kind == 'bookmarks' else self.read_database(kind)
+            room = self.max_visits - self.existing_visits if self.max_visits > 0 else None
+            for batch, done, total in batches:
+                if self.cancelled.is_set():
+                    break
+                kept = [visit for visit in batch if not 0 < visit[2] < cutoff]
+                skipped += len(batch) - len(kept)
+                if room is not None and len(kept) > room - imported:
+                    kept = kept[:max(room - imported, 0)]
+                    self.limit_reached = True
+                if kept:
+                    self.store.add_visits(kept)
+                    self.store.flush()  # Keeps at most one batch in memory
+                imported += len(kept)
+                self.progress.emit(done, total)
+                if self.limit_reached:
+                    break
+        except (OSError, ValueError, sqlite3.Error) as e:
+            error = str(e)
+        self.finished.emit(imported, skipped, error)
+
+    def read_database(self, kind: str):
+        count_query, query = self.QUERIES[kind]
+        connection = self.open_database(self.path)
+        try:
+            total = connection.execute(count_query).fetchone()[0]
+            cursor = connection.execute(query)
+            done = 0
+            while True:
+                rows = cursor.fetchmany(self.BATCH_SIZE)
+                if not rows:
+                    break
+                done += len(rows)
+                yield ([(title or '', url, max(visited_at or 0, 0)) for url, title, visited_at in rows
+                        if url.startswith(('http:', 'https:'))], done, total)
+        finally:
+            connection.close()
+
+    def read_bookmarks(self):
+        total = os.path.getsize(self.path)
+        parser = BookmarkParser()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        done = 0
+        with open(self.path, "rb") as file:
+            while True:
+                chunk = file.read(self.READ_SIZE)
+                done += len(chunk)
+                parser.feed(decoder.decode(chunk, final=not chunk))
+                if len(parser.bookmarks) >= self.BATCH_SIZE or not chunk:
+                    yield parser.bookmarks, done, total
+                    parser.bookmarks = []
+                if not chunk:
+                    break
+        parser.close()
+
+class OmniboxIndex:
+    # Incremental prefix index over visited URLs, host labels and title words.
+    # Suggestions are ranked by frecency: visit count x exponential recency decay.
+    # log(count) + last_visit * DECAY_RATE orders URLs exactly like that score but
+    # doesn't change as time passes, so the best URLs for each short prefix can be
+    # kept precomputed and only need updating when a URL is visited.
+    HALF_LIFE = 30 * 24 * 3600
+    DECAY_RATE = math.log(2) / HALF_LIFE
+    PREFIX_CACHE_LENGTH = 3
+    PREFIX_CACHE_SIZE = 10
+    # Bounds the index range scanned for longer prefixes
+    SCAN_LIMIT = 500
+    MAX_TITLE_WORDS = 12
+
+    def __init__(self):
+        # Numbers are kept in typed arrays and words are interned, which keeps a
+        # year of history at a few bytes per URL beyond its URL and title strings
+        self.url_ids = {}
+        self.urls = []
+        self.titles = []
+        self.counts = array('I')
+        self.last_visits = array('d')
+        self.ranks = array('d')
+        self.normalized_urls = []  # By id; url_keys holds the same strings in sorted order
+        self.words = []
+        self.url_keys = []
+        self.url_key_ids = array('i')
+        self.tokens = []
+        self.postings = {}
+        self.top = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = text.strip().lower()
+        for prefix in ('https://', 'http://'):
+            if text.startswith(prefix):
+                text = text[len(prefix):]
+                break
+        if text.startswith('www.'):
+            text = text[4:]
+        return text
+
+    def extract_words(self, title: str, url_key: str) -> set:
+        words = set(re.findall(r'\w{2,}', title.lower())[:self.MAX_TITLE_WORDS])
+        host_labels = url_key.split('/', 1)[0].split(':', 1)[0].split('.')
+        words.update(label for label in host_labels[:-1] if len(label) > 1)
+        return {sys.intern(word) for word in words}
+
+    def rank(self, url_id: int) -> float:
+        return math.log(self.counts[url_id]) + self.last_visits[url_id] * self.DECAY_RATE
+
+    def build(self, records):
+        # Bulk load from (url, title, visit count, last visit) records: sort the keys
+        # and fill the prefix cache once instead of inserting URL by URL.
+        for url, title, visit_count, last_visit in records:
+            url_id = self.add_url(url, title, last_visit, sort=False)
+            self.counts[url_id] = max(visit_count, 1)
+            self.ranks[url_id] = self.rank(url_id)
+        for url_id, url in enumerate(self.urls):
+            self.add_words(url_id, self.extract_words(self.titles[url_id], self.url_keys[url_id]), sort=False)
+
+        order = sorted(range(len(self.urls)), key=lambda url_id: self.url_keys[url_id])
+        self.url_key_ids = array('i', order)
+        self.url_keys = [self.url_keys[url_id] for url_id in order]
+        self.tokens = sorted(self.postings)
+
+        for url_id in sorted(range(len(self.urls)), key=self.ranks.__getitem__, reverse=True):
+            for prefix in self.prefixes(url_id):
+                best = self.top.setdefault(prefix, [])
+                if len(best) < self.PREFIX_CACHE_SIZE:
+                    best.append(url_id)
+
+    def add_url(self, url: str, title: str, visited_at: float, sort: bool = True) -> int:
+        url_id = len(self.urls)
+        self.url_ids[url] = url_id
+        self.urls.append(url)
+        self.titles.append(title)
+        self.counts.append(1)
+        self.last_visits.append(visited_at)
+        self.ranks.append(0.0)
+        self.words.append(())
+        url_key = self.normalize(url)
+        self.normalized_urls.append(url_key)
+        if sort:
+            position = bisect.bisect_right(self.url_keys, url_key)
+            self.url_keys.insert(position, url_key)
+            self.url_key_ids.insert(position, url_id)
+        else:
+            # build() sorts the keys afterwards; until then url_keys is indexed by id
+            self.url_keys.append(url_key)
+        return url_id
+
+    def add_words(self, url_id: int, words: set, sort: bool = True):
+        new_words = words.difference(self.words[url_id])
+        if not new_words:
+            return
+        self.words[url_id] = tuple(words.union(self.words[url_id]))
+        for word in new_words:
+            posting = self.postings.get(word)
+            if posting is None:
+                self.postings[word] = array('i', [url_id])
+                if sort:
+                    bisect.insort(self.tokens, word)
+            else:
+                posting.append(url_id)
+
+    def record_visit(self, title: str, url: str, visited_at: float):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.add_url(url, title, visited_at)
+        else:
+            self.counts[url_id] += 1
+            self.last_visits[url_id] = max(self.last_visits[url_id], visited_at)
+            if title:
+                self.titles[url_id] = title
+        self.add_words(url_id, self.extract_words(title, self.normalized_urls[url_id]))
+
+        # A visit only ever raises a URL's rank, so it can only move up in the cache
+        rank = self.ranks[url_id] = self.rank(url_id)
+        for prefix in self.prefixes(url_id):
+            best = self.top.setdefault(prefix, [])
+            if url_id in best:
+                best.remove(url_id)
+            position = 0
+            while position < len(best) and self.ranks[best[position]] >= rank:
+                position += 1
+            if position < self.PREFIX_CACHE_SIZE:
+                best.insert(position, url_id)
+                del best[self.PREFIX_CACHE_SIZE:]
+
+    def remove(self, urls):
+        # Removed URLs keep their slots and sorted keys (a count of 0 marks them) so
+        # nothing has to be shifted; the index is rebuilt when the profile is opened
+        for url in urls:
+            url_id = self.url_ids.pop(url, None)
+            if url_id is None:
+                continue
+            for prefix in self.prefixes(url_id):
+                best = self.top.get(prefix)
+                if best and url_id in best:
+                    best.remove(url_id)
+            self.counts[url_id] = 0
+            self.ranks[url_id] = float('-inf')
+
+    def prefixes(self, url_id: int) -> set:
+        keys = (self.normalized_urls[url_id],) + self.words[url_id]
+        return {key[:length] for key in keys for length in range(1, min(len(key), self.PREFIX_CACHE_LENGTH) + 1)}
+
+    def has_prefix(self, url_id: int, prefix: str) -> bool:
+        return (self.normalized_urls[url_id].startswith(prefix) or
+                any(word.startswith(prefix) for word in self.words[url_id]))
+
+    def query(self, text: str, limit: int = 8) -> list:
+        words = self.normalize(text).split()
+        if not words:
+            return []
+        prefix, other_words = words[0], words[1:]
+
+        # Everything taken from the key range or the word postings is known to match
+        # the prefix; only the cached entries of a shorter prefix need checking
+        if len(prefix) <= self.PREFIX_CACHE_LENGTH:
+            candidates = set(self.top.get(prefix, ()))
+        else:
+            candidates = {url_id for url_id in self.top.get(prefix[:self.PREFIX_CACHE_LENGTH], ())
+                          if self.has_prefix(url_id, prefix)}
+            position = bisect.bisect_left(self.url_keys, prefix)
+            after_prefix = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            end = bisect.bisect_left(self.url_keys, after_prefix, position,
+                                     min(position + self.SCAN_LIMIT, len(self.url_keys)))
+            candidates.update(self.url_key_ids[position:end])
+            position = bisect.bisect_left(self.tokens, prefix)
+            budget = self.SCAN_LIMIT
+            while budget > 0 and position < len(self.tokens) and self.tokens[position].startswith(prefix):
+                posting = self.postings[self.tokens[position]]
+                candidates.update(posting[-budget:])
+                budget -= len(posting)
+                position += 1
+            candidates = {url_id for url_id in candidates if self.counts[url_id]}
+
+        if other_words:
+            # Checked best first, so a common match stops after a few candidates
+            best = []
+            for url_id in sorted(candidates, key=self.ranks.__getitem__, reverse=True):
+                title, url_key = self.titles[url_id].lower(), self.normalized_urls[url_id]
+                if all(word in title or word in url_key for word in other_words):
+                    best.append(url_id)
+                    if len(best) == limit:
+                        break
+        else:
+            best = heapq.nlargest(limit, candidates, key=self.ranks.__getitem__)
+        return [(self.titles[url_id], self.urls[url_id]) for url_id in best]
+
+    def inline_completion(self, text: str, url: str):
+        # Completes what was typed to the end of the suggested host, or to the whole
+        # URL once the typed text reaches past the host
+        typed = self.normalize(text)
+        url_key = self.normalize(url)
+        if not typed or ' ' in typed or not url_key.startswith(typed):
+            return None
+        host_end = url_key.find('/')
+        end = host_end if 0 <= host_end and len(typed) < host_end else len(url_key)
+        return text + url_key[len(typed):end]
+
+class PageTextIndex:
+    # Full-text index (SQLite FTS5) of the text of visited pages. Ingestion happens
+    # on a background thread that owns the write connection; searches use a
+    # separate read connection, which WAL mode keeps from blocking on writes.
+    MAX_PAGE_CHARS = 100000
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pages (
+        id INTEGER PRIMARY KEY,
+        url TEXT UNIQUE NOT NULL,
+        title TEXT,
+        visited_at REAL,
+        size INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS pages_visited_at ON pages (visited_at);
+    CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(title, body);
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.available = True
+        self.read_connection = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="PageTextIndexer", daemon=True)
+        self.thread.start()
+
+    def add(self, url: str, title: str, text: str, visited_at: float):
+        if self.available and text:
+            self.queue.put(('add', url, title, text, visited_at))
+
+    def remove(self, urls: list):
+        self.queue.put(('remove', urls))
+
+    def clear(self):
+        self.queue.put(('clear',))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.read_connection is not None:
+            self.read_connection.close()
+            self.read_connection = None
+
+    def run(self):
+        try:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+        except sqlite3.Error as e:
+            print(f"Page text search is unavailable: {e}")
+            self.available = False
+            return
+
+        while True:
+            tasks = [self.queue.get()]
+            # Everything already queued goes into the same transaction
+            while not self.queue.empty() and tasks[-1] is not None:
+                tasks.append(self.queue.get())
+            try:
+                with connection:
+                    for task in tasks:
+                        if task is None:
+                            break
+                        if task[0] == 'add':
+                            self.store(connection, *task[1:])
+                        elif task[0] == 'remove':
+                            for url in task[1]:
+                                row = connection.execute("SELECT id FROM pages WHERE url = ?", (url,)).fetchone()
+                                if row:
+                                    connection.execute("DELETE FROM pages WHERE id = ?", row)
+                                    connection.execute("DELETE FROM page_text WHERE rowid = ?", row)
+                        elif task[0] == 'clear':
+                            connection.execute("DELETE FROM pages")
+                            connection.execute("DELETE FROM page_text")
+                    self.enforce_size_cap(connection)
+            except sqlite3.Error as e:
+                print(f"Error indexing page text: {e}")
+            if tasks[-1] is None:
+                connection.close()
+                return
+
+    def store(self, connection, url: str, title: str, text: str, visited_at: float):
+        text = text[:self.MAX_PAGE_CHARS]
+        size = len(text.encode('utf-8'))
+        row = connection.execute("SELECT id FROM pages WHERE url = ?", (url,)).fetchone()
+        if row:
+            page_id = row[0]
+            connection.execute("DELETE FROM page_text WHERE rowid = ?", (page_id,))
+            connection.execute("UPDATE pages SET title = ?, visited_at = ?, size = ? WHERE id = ?",
+                               (title, visited_at, size, page_id))
+        else:
+            page_id = connection.execute("INSERT INTO pages (url, title, visited_at, size) VALUES (?, ?, ?, ?)",
+                                         (url, title, visited_at, size)).lastrowid
+        connection.execute("INSERT INTO page_text (rowid, title, body) VALUES (?, ?, ?)", (page_id, title, text))
+
+    def enforce_size_cap(self, connection):
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        while total > self.max_bytes:
+            oldest = connection.execute("SELECT id, size FROM pages ORDER BY visited_at LIMIT 100").fetchall()
+            if not oldest:
+                break
+            for page_id, size in oldest:
+                connection.execute("DELETE FROM pages WHERE id = ?", (page_id,))
+                connection.execute("DELETE FROM page_text WHERE rowid = ?", (page_id,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        # Every word becomes a quoted prefix term so user input can't break FTS syntax
+        words = re.findall(r'\w+', query)
+        return ' '.join('"' + word + '"*' for word in words)
+
+    def search(self, query: str, limit: int = 50) -> list:
+        expression = self.match_expression(query)
+        if not self.available or not expression:
+            return []
+        if self.read_connection is None:
+            self.read_connection = sqlite3.connect(self.path)
+        try:
+            rows = self.read_connection.execute(
+                "SELECT pages.url, pages.title, snippet(page_text, 1, '\x02', '\x03', '...', 16) "
+                "FROM page_text JOIN pages ON pages.id = page_text.rowid "
+                "WHERE page_text MATCH ? ORDER BY bm25(page_text) LIMIT ?", (expression, limit)).fetchall()
+        except sqlite3.OperationalError:
+            return []  # Index not created yet
+        return [{'url': url, 'title': title, 'snippet': snippet} for url, title, snippet in rows]
+
+class ThumbnailCache:
+    # Page thumbnails for the tab switcher and the new tab page's top sites. They are
+    # JPEG files in the profile, named after a hash of the URL, and the least recently
+    # used ones are removed once the directory grows past max_bytes. The GUI thread
+    # only grabs the view; scaling, encoding and file work happen on this thread.
+    WIDTH = 320
+    HEIGHT = 200
+    QUALITY = 75
+    # Pages are captured this long after loading, once they have painted
+    CAPTURE_DELAY_MS = 1000
+    # Leaving a tab again within this many seconds keeps its last thumbnail
+    MIN_INTERVAL = 5
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.total = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="ThumbnailCache", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def file_name(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest() + ".jpg"
+
+    def add(self, url: str, image: QImage):
+        self.queue.put(('add', url, image))
+
+    def path(self, url: str):
+        name = self.file_name(url)
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        self.queue.put(('touch', name))
+        return os.path.join(self.directory, name)
+
+    def load(self, url: str) -> QImage:
+        path = self.path(url)
+        return QImage(path) if path else QImage()
+
+    def remove(self, urls: list):
+        self.queue.put(('remove', urls))
+
+    def clear(self):
+        self.queue.put(('clear',))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # The modification time is bumped on every use, so it gives the LRU order back after a restart
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".jpg"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            with self.lock:
+                for _, name, size in sorted(files):
+                    self.entries[name] = size
+                    self.total += size
+        except OSError as e:
+            print(f"Error reading thumbnail cache: {e}")
+
+        while True:
+            tasks = [self.queue.get()]
+            while not self.queue.empty() and tasks[-1] is not None:
+                tasks.append(self.queue.get())
+            for task in tasks:
+                if task is None:
+                    break
+                try:
+                    if task[0] == 'add':
+                        self.store(*task[1:])
+                    elif task[0] == 'touch':
+                        os.utime(os.path.join(self.directory, task[1]))
+                    elif task[0] == 'remove':
+                        self.remove_files([self.file_name(url) for url in task[1]])
+                    elif task[0] == 'clear':
+                        self.remove_all()
+                except OSError as e:
+                    print(f"Error updating thumbnail cache: {e}")
+            self.enforce_size_cap()
+            if tasks[-1] is None:
+                return
+
+    def store(self, url: str, image: QImage):
+        thumbnail = image.scaled(self.WIDTH, self.HEIGHT, Qt.KeepAspectRatioByExpanding, Qt.SmoothTransformation)
+        thumbnail = thumbnail.copy(0, 0, self.WIDTH, self.HEIGHT)  # Keep the top of the page
+        name = self.file_name(url)
+        path = os.path.join(self.directory, name)
+        if not thumbnail.save(path + ".tmp", "JPG", self.QUALITY):
+            raise OSError(f"could not write {path}")
+        os.replace(path + ".tmp", path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+
+    def remove_files(self, names: list):
+        with self.lock:
+            names = [name for name in names if name in self.entries]
+            for name in names:
+                self.total -= self.entries.pop(name)
+        self.delete_files(names)
+
+    def remove_all(self):
+        with self.lock:
+            names = list(self.entries)
+            self.entries.clear()
+            self.total = 0
+        self.delete_files(names)
+
+    def delete_files(self, names: list):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # Already deleted by hand; the rest still go
+
+    def enforce_size_cap(self):
+        while True:
+            with self.lock:
+                if self.total <= self.max_bytes or not self.entries:
+                    return
+                name, size = self.entries.popitem(last=False)
+                self.total -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                print(f"Error removing thumbnail: {e}")
+
+HISTORY_PAGE_HTML = """
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>History</title>
+    <style>
+        body {
+            font-family: 'Arial', sans-serif;
+            margin: 20px;
+            background-color: #f4f4f9;
+            color: #333;
+        }
+        h1 {
+            color: #5d647b;
+            text-align: center;
+        }
+        #filter {
+            display: block;
+            width: 100%;
+            font-size: 16px;
+            padding: 8px;
+            box-sizing: border-box;
+        }
+        ul {
+            list-style: none;
+            padding: 0;
+        }
+        li {
+            background: white;
+            border-bottom: 1px solid #ccc;
+            padding: 10px;
+            margin-top: 5px;
+        }
+        a {
+            color: #5d647b;
+            text-decoration: none;
+        }
+        a:hover {
+            text-decoration: underline;
+        }
+        #status {
+            text-align: center;
+            color: gray;
+        }
+        .snippet {
+            color: gray;
+            font-size: 90%;
+            margin-top: 4px;
+        }
+    </style>
+</head>
+<body>
+    <h1>History</h1>
+    <input id="filter" type="search" placeholder="Search history" autofocus>
+    <label><input id="content" type="checkbox"> Search page text</label>
+    <ul id="entries"></ul>
+    <p id="status"></p>
+    <script>
+        var list = document.getElementById('entries');
+        var statusLine = document.getElementById('status');
+        var filter = document.getElementById('filter');
+        var content = document.getElementById('content');
+        var cursor = null;
+        var done = false;
+        var loading = false;
+        var generation = 0;
+
+        function loadMore() {
+            if (loading || done) {
+                return;
+            }
+            loading = true;
+            var requestGeneration = generation;
+            var url = 'pybrowser://history/entries?q=' + encodeURIComponent(filter.value);
+            if (cursor !== null) {
+                url += '&before=' + encodeURIComponent(cursor);
+            }
+            fetch(url).then(function(response) { return response.json(); }).then(function(page) {
+                loading = false;
+                if (requestGeneration !== generation) {
+                    return;
+                }
+                page.entries.forEach(function(entry) {
+                    var item = document.createElement('li');
+                    var link = document.createElement('a');
+                    link.href = entry.url;
+                    link.textContent = entry.title;
+                    item.appendChild(link);
+                    item.appendChild(document.createTextNode(' - ' + entry.url +
+                        (entry.visits > 1 ? ' (' + entry.visits + ' visits)' : '')));
+                    list.appendChild(item);
+                });
+                cursor = page.next;
+                done = cursor === null;
+                statusLine.textContent = done ? (list.children.length ? 'End of history' : 'No matching history') :
+                    (filter.value ? 'Searching...' : '');
+                // Keep going until the viewport is filled or the history runs out
+                if (!done && document.body.scrollHeight <= window.innerHeight + 200) {
+                    loadMore();
+                }
+            });
+        }
+
+        function appendSnippet(item, snippet) {
+            // The index marks matches with \\x02 ... \\x03
+            var element = document.createElement('div');
+            element.className = 'snippet';
+            snippet.split('\\x02').forEach(function(part, index) {
+                var pieces = index === 0 ? ['', part] : part.split('\\x03');
+                if (pieces[0]) {
+                    var mark = document.createElement('mark');
+                    mark.textContent = pieces[0];
+                    element.appendChild(mark);
+                }
+                element.appendChild(document.createTextNode(pieces.slice(1).join('')));
+            });
+            item.appendChild(element);
+        }
+
+        function searchContent() {
+            var requestGeneration = generation;
+            loading = true;
+            fetch('pybrowser://history/search?q=' + encodeURIComponent(filter.value)).then(function(response) {
+                return response.json();
+            }).then(function(page) {
+                loading = false;
+                done = true;
+                if (requestGeneration !== generation) {
+                    return;
+                }
+                page.results.forEach(function(result) {
+                    var item = document.createElement('li');
+                    var link = document.createElement('a');
+                    link.href = result.url;
+                    link.textContent = result.title || result.url;
+                    item.appendChild(link);
+                    item.appendChild(document.createTextNode(' - ' + result.url));
+                    appendSnippet(item, result.snippet || '');
+                    list.appendChild(item);
+                });
+                statusLine.textContent = page.results.length ? '' : 'No pages contain that text';
+            });
+        }
+
+        function reset() {
+            generation++;
+            list.textContent = '';
+            cursor = null;
+            done = false;
+            loading = false;
+            if (content.checked && filter.value.trim()) {
+                searchContent();
+            } else {
+                loadMore();
+            }
+        }
+
+        var filterTimer = null;
+        filter.addEventListener('input', function() {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(reset, 150);
+        });
+        content.addEventListener('change', reset);
+        window.addEventListener('scroll', function() {
+            if (window.innerHeight + window.scrollY >= document.body.scrollHeight - 400) {
+                loadMore();
+            }
+        });
+        loadMore();
+    </script>
+</body>
+</html>
+"""
+
+def render_new_tab_page(search_engine: str) -> bytes:
+    search_url = SEARCH_ENGINE_URLS.get(search_engine, SEARCH_ENGINE_URLS['Google'])
+
+    new_tab_html = f"""
+    <html>
+        <head>
+            <meta charset="utf-8">
+            <title>New Tab</title>
+            <style>
+                body {{
+                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+                    margin: 0;
+                    padding: 0;
+                    display: flex;
+                    justify-content: center;
+                    align-items: center;
+                    height: 100vh;
+                    background-color: #f0f0f0;
+                    color: #333;
+                }}
+                .container {{
+                    text-align: center;
+                }}
+                h1 {{
+                    font-size: 48px;
+                    margin-bottom: 20px;
+                }}
+                input[type="text"] {{
+                    font-size: 18px;
+                    padding: 10px;
+                    width: 300px;
+                    border: 1px solid #ccc;
+                    border-radius: 5px;
+                }}
+                input[type="submit"] {{
+                    font-size: 18px;
+                    padding: 10px 20px;
+                    margin-left: 10px;
+                    border: none;
+                    border-radius: 5px;
+                    background-color: #0078D7;
+                    color: white;
+                    cursor: pointer;
+                }}
+                input[type="submit"]:hover {{
+                    background-color: #0056b3;
+                }}
+                .top-sites {{
+                    display: flex;
+                    flex-wrap: wrap;
+                    justify-content: center;
+                    max-width: 720px;
+                    margin-top: 40px;
+                }}
+                .tile {{
+                    width: 160px;
+                    margin: 10px;
+                    color: #333;
+                    text-decoration: none;
+                    font-size: 13px;
+                }}
+                .tile .thumbnail {{
+                    width: 160px;
+                    height: 100px;
+                    border-radius: 5px;
+                    background-color: #ddd;
+                    background-size: cover;
+                    box-shadow: 0 1px 3px rgba(0, 0, 0, 0.3);
+                }}
+                .tile .title {{
+                    margin-top: 6px;
+                    overflow: hidden;
+                    white-space: nowrap;
+                    text-overflow: ellipsis;
+                }}
+            </style>
+            <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
+        </head>
+        <body>
+            <div class="container">
+                <h1>Welcome to PyBrowser {CURRENT_VERSION}</h1>
+                <p>Enter a search term below to start browsing:</p>
+                <form action="{search_url}" method="get">
+                    <input type="text" name="q" placeholder="Search {search_engine}" />
+                    <input type="submit" value="Search" />
+                </form>
+                <div class="top-sites" id="top-sites"></div>
+            </div>
+            <script>
+                // The page itself is cached; the most visited sites are fetched each time it opens
+                fetch('{NEW_TAB_URL}/top-sites').then(function(response) {{
+                    return response.json();
+                }}).then(function(sites) {{
+                    var container = document.getElementById('top-sites');
+                    sites.forEach(function(site) {{
+                        var tile = document.createElement('a');
+                        tile.className = 'tile';
+                        tile.href = site.url;
+                        var thumbnail = document.createElement('div');
+                        thumbnail.className = 'thumbnail';
+                        if (site.thumbnail) {{
+                            thumbnail.style.backgroundImage = 'url("{NEW_TAB_URL}/thumbnail?url=' +
+                                encodeURIComponent(site.url) + '")';
+                        }}
+                        var title = document.createElement('div');
+                        title.className = 'title';
+                        title.textContent = site.title || site.url;
+                        tile.appendChild(thumbnail);
+                        tile.appendChild(title);
+                        container.appendChild(tile);
+                    }});
+                }});
+            </script>
+        </body>
+    </html>
+    """
+    return new_tab_html.encode('utf-8')
+
+def register_internal_scheme():
+    # Must run before the QApplication is created
+    scheme = QWebEngineUrlScheme(INTERNAL_SCHEME)
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Host)
+    scheme.setFlags(QWebEngineUrlScheme.SecureScheme | QWebEngineUrlScheme.LocalScheme |
+                    QWebEngineUrlScheme.LocalAccessAllowed | QWebEngineUrlScheme.CorsEnabled)
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+class InternalSchemeHandler(QWebEngineUrlSchemeHandler):
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.new_tab_page = None
+        self.new_tab_page_version = None
+
+    def get_new_tab_page(self) -> bytes:
+        # Rendered once per settings version and shared by every blank tab
+        if self.new_tab_page_version != self.main_window.settings_version:
+            self.new_tab_page = render_new_tab_page(self.main_window.settings.get('search_engine', 'Google'))
+            self.new_tab_page_version = self.main_window.settings_version
+        return self.new_tab_page
+
+    def requestStarted(self, job: QWebEngineUrlRequestJob):
+        url = job.requestUrl()
+        try:
+            if url.host() == 'newtab':
+                if url.path() == '/top-sites':
+                    sites = [{'url': site_url, 'title': title,
+                              'thumbnail': self.main_window.thumbnail_cache.path(site_url) is not None}
+                             for site_url, title in self.main_window.profile_store.top_sites()]
+                    self.reply(job, b"application/json", json.dumps(sites).encode('utf-8'))
+                elif url.path() == '/thumbnail':
+                    path = self.main_window.thumbnail_cache.path(QUrlQuery(url).queryItemValue('url', QUrl.FullyDecoded))
+                    if path is None:
+                        job.fail(QWebEngineUrlRequestJob.UrlNotFound)
+                        return
+                    with open(path, "rb") as file:
+                        self.reply(job, b"image/jpeg", file.read())
+                else:
+                    self.reply(job, b"text/html", self.get_new_tab_page())
+            elif url.host() == 'history':
+                self.main_window.load_history_data()
+                if url.path() == '/search':
+                    query = QUrlQuery(url).queryItemValue('q', QUrl.FullyDecoded)
+                    results = self.main_window.page_text_index.search(query)
+                    self.reply(job, b"application/json", json.dumps({'results': results}).encode('utf-8'))
+                elif url.path() == '/entries':
+                    query = QUrlQuery(url)
+                    before = query.queryItemValue('before')
+                    if before:
+                        last_visit, url_id = before.split(',')
+                        before = (float(last_visit), int(url_id))
+                    page = self.main_window.profile_store.history_page(before or None,
+                                                                       query.queryItemValue('q', QUrl.FullyDecoded))
+                    self.reply(job, b"application/json", json.dumps(page).encode('utf-8'))
+                else:
+                    self.reply(job, b"text/html", HISTORY_PAGE_HTML.encode('utf-8'))
+            else:
+                job.fail(QWebEngineUrlRequestJob.UrlNotFound)
+        except (ValueError, OSError):
+            job.fail(QWebEngineUrlRequestJob.RequestFailed)
+
+    def reply(self, job: QWebEngineUrlRequestJob, content_type: bytes, body: bytes):
+        # The buffer is parented to the job so it lives exactly as long as the request
+        buffer = QBuffer(job)
+        buffer.setData(body)
+        buffer.open(QIODevice.ReadOnly)
+        job.reply(content_type, buffer)
+
+class StartupTrace:
+    # Times each startup phase; enabled with --startup-trace[=trace.json]. With a
+    # file name the report is also written as JSON so CI can compare runs.
+    def __init__(self, enabled: bool = False, output_path: str = None, start: float = None):
+        self.enabled = enabled
+        self.output_path = output_path
+        self.start = STARTUP_BEGIN if start is None else start
+        self.phases = []
+        self.milestones = {}
+
+    @classmethod
+    def from_args(cls, args):
+        for arg in args:
+            if arg == '--startup-trace':
+                return cls(enabled=True)
+            if arg.startswith('--startup-trace='):
+                return cls(enabled=True, output_path=arg.split('=', 1)[1])
+        return cls()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name: str, start: float, end: float):
+        self.phases.append({'name': name, 'start_ms': (start - self.start) * 1000, 'duration_ms': (end - start) * 1000})
+
+    def mark(self, name: str):
+        self.milestones[name] = (time.perf_counter() - self.start) * 1000
+
+    def report(self):
+        if not self.enabled:
+            return
+        print("Startup trace:")
+        for phase in self.phases:
+            print(f"  {phase['name']:<28} {phase['duration_ms']:9.1f} ms  (at {phase['start_ms']:.1f} ms)")
+        for name, at in self.milestones.items():
+            print(f"  {name:<28} {'':>9}     at {at:.1f} ms")
+        if self.output_path:
+            try:
+                with open(self.output_path, "w") as file:
+                    json.dump({'phases': self.phases, 'milestones': self.milestones}, file, indent=2)
+            except OSError as e:
+                print(f"Error writing startup trace: {e}")
+
+def process_rss_bytes(pid: int):
+    # Resident set size read from /proc; None where that isn't available
+    try:
+        with open(f"/proc/{pid}/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class TabLifecycleManager(QObject):
+    # Freezes idle background tabs and discards the least recently used ones once
+    # their renderers exceed the memory budget. Discarded tabs reload on activation.
+    CHECK_INTERVAL_MS = 30000
+    # Per-tab estimate used when renderer memory can't be read (non-Linux)
+    ESTIMATED_TAB_MEMORY_MB = 150
+
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.check_tabs)
+        self.timer.start(self.CHECK_INTERVAL_MS)
+
+    def browsers(self) -> list:
+        return self.main_window.browsers()
+
+    def on_tab_activated(self, index: int):
+        browser = self.main_window.tab_widget.widget(index)
+        if browser is None:
+            return
+        browser.last_active = time.monotonic()
+        page = browser.page()
+        if page.lifecycleState() != QWebEnginePage.LifecycleState.Active:
+            # Going back to Active from Discarded reloads the page
+            page.setLifecycleState(QWebEnginePage.LifecycleState.Active)
+        self.set_discarded_marker(browser, False)
+
+    def check_tabs(self):
+        settings = self.main_window.settings
+        freeze_after = settings.get('freeze_after_minutes', 5) * 60
+        budget = settings.get('tab_memory_budget_mb', 2048) * 1024 * 1024
+        current = self.main_window.tab_widget.currentWidget()
+        now = time.monotonic()
+
+        candidates = [browser for browser in self.browsers() if browser is not current and
+                      browser.page().recommendedState() != QWebEnginePage.LifecycleState.Active]
+        for browser in candidates:
+            page = browser.page()
+            if page.lifecycleState() == QWebEnginePage.LifecycleState.Active and now - browser.last_active >= freeze_after:
+                page.setLifecycleState(QWebEnginePage.LifecycleState.Frozen)
+
+        usage = self.renderer_memory()
+        total = sum(usage.values())
+        for browser in sorted(candidates, key=lambda browser: browser.last_active):
+            if total <= budget:
+                break
+            if browser.page().lifecycleState() == QWebEnginePage.LifecycleState.Discarded:
+                continue
+            total -= usage.get(browser, 0)
+            self.discard(browser)
+
+    def renderer_memory(self) -> dict:
+        # Renderers can be shared between tabs, so each tab is charged its share
+        by_pid = {}
+        usage = {}
+        for browser in self.browsers():
+            if browser.page().lifecycleState() == QWebEnginePage.LifecycleState.Discarded:
+                continue
+            pid = browser.page().renderProcessPid()
+            if pid > 0:
+                by_pid.setdefault(pid, []).append(browser)
+            else:
+                usage[browser] = 0
+        for pid, browsers in by_pid.items():
+            rss = process_rss_bytes(pid)
+            if rss is None:
+                rss = self.ESTIMATED_TAB_MEMORY_MB * 1024 * 1024 * len(browsers)
+            for browser in browsers:
+                usage[browser] = rss // len(browsers)
+        return usage
+
+    def discard(self, browser):
+        if browser is self.main_window.tab_widget.currentWidget():
+            return
+        browser.page().setLifecycleState(QWebEnginePage.LifecycleState.Discarded)
+        self.set_discarded_marker(browser, True)
+
+    def set_discarded_marker(self, browser, discarded: bool):
+        browser.discarded = discarded
+        tab_widget = self.main_window.tab_widget
+        index = tab_widget.indexOf(browser)
+        if index < 0:
+            return
+        tab_widget.tabBar().setTabTextColor(index, QColor('gray') if discarded else QColor())
+        self.main_window.update_tab_tooltip(browser)
+
+class FilterRuleSet:
+    # One side (block or allow) of a compiled filter list:
+    #  - hosts: plain ||host^ rules, matched by looking up each suffix of the host
+    #  - host_rules: other ||host... rules, keyed by their host
+    #  - token_rules: remaining rules keyed by one token that every URL they match
+    #    must contain as a whole token, so a URL only tests rules sharing a token
+    #  - generic_rules: the few rules without such a token, tested on every URL
+    def __init__(self):
+        self.hosts = set()
+        self.host_rules = {}
+        self.token_rules = {}
+        self.generic_rules = []
+
+    def rule_count(self) -> int:
+        return (len(self.hosts) + sum(map(len, self.host_rules.values())) +
+                sum(map(len, self.token_rules.values())) + len(self.generic_rules))
+
+    def dump_state(self) -> tuple:
+        return (self.hosts, self.host_rules, self.token_rules, self.generic_rules)
+
+    @classmethod
+    def from_state(cls, state):
+        rule_set = cls()
+        rule_set.hosts, rule_set.host_rules, rule_set.token_rules, rule_set.generic_rules = state
+        return rule_set
+
+class ContentFilter:
+    # Matcher compiled from EasyList-syntax filter lists. Rules are stored as plain
+    # tuples so the compiled form can be cached on disk with marshal, which only
+    # holds data (unlike pickle, loading it can't run code); their regexes are
+    # built lazily the first time a rule is actually tested.
+    CACHE_VERSION = 2
+    RESOURCE_TYPES = {
+        'script': QWebEngineUrlRequestInfo.ResourceTypeScript,
+        'image': QWebEngineUrlRequestInfo.ResourceTypeImage,
+        'stylesheet': QWebEngineUrlRequestInfo.ResourceTypeStylesheet,
+        'font': QWebEngineUrlRequestInfo.ResourceTypeFontResource,
+        'media': QWebEngineUrlRequestInfo.ResourceTypeMedia,
+        'object': QWebEngineUrlRequestInfo.ResourceTypeObject,
+        'subdocument': QWebEngineUrlRequestInfo.ResourceTypeSubFrame,
+        'xmlhttprequest': QWebEngineUrlRequestInfo.ResourceTypeXhr,
+        'ping': QWebEngineUrlRequestInfo.ResourceTypePing,
+        'other': QWebEngineUrlRequestInfo.ResourceTypeUnknown,
+    }
+    TOKEN_CHARACTERS = re.compile(r'[a-z0-9%]+')
+    PURE_HOST_RULE = re.compile(r'^\|\|([a-z0-9.-]+)\^?\|?$')
+    HOST_ANCHOR = re.compile(r'^\|\|([a-z0-9.-]+)(?=[\^/*]|$)')
+
+    def __init__(self):
+        self.block = FilterRuleSet()
+        self.allow = FilterRuleSet()
+        self.regexes = {}
+
+    def dump_state(self) -> tuple:
+        return (self.block.dump_state(), self.allow.dump_state())
+
+    @classmethod
+    def from_state(cls, state):
+        content_filter = cls()
+        content_filter.block = FilterRuleSet.from_state(state[0])
+        content_filter.allow = FilterRuleSet.from_state(state[1])
+        return content_filter
+
+    @classmethod
+    def load(cls, directory: str, cache_path: str):
+        # Reuses the compiled cache as long as no list file has changed
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.txt'))
+        except OSError:
+            return None
+        paths = [os.path.join(directory, name) for name in names]
+        cache_key = ((cls.CACHE_VERSION, marshal.version) +
+                     tuple((path, os.path.getsize(path), os.path.getmtime(path)) for path in paths))
+        try:
+            with open(cache_path, "rb") as file:
+                # loads() on the whole file is several times faster than load() on the stream
+                cached_key, state = marshal.loads(file.read())
+            if cached_key == cache_key:
+                return cls.from_state(state)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        content_filter = cls()
+        for path in paths:
+            with open(path, "r", encoding="utf-8", errors="replace") as file:
+                for line in file:
+                    content_filter.add_rule(line)
+        try:
+            with open(cache_path + ".tmp", "wb") as file:
+                file.write(marshal.dumps((cache_key, content_filter.dump_state())))
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            print(f"Error caching compiled filter lists: {e}")
+        return content_filter
+
+    def add_rule(self, line: str):
+        line = line.strip()
+        if not line or line.startswith(('!', '[')) or '##' in line or '#@#' in line or '#?#' in line or '#$#' in line:
+            return  # Comments, headers and element hiding rules
+        rule_set = self.block
+        if line.startswith('@@'):
+            rule_set = self.allow
+            line = line[2:]
+        pattern, options = line, None
+        if '$' in line:
+            pattern, option_text = line.rsplit('$', 1)
+            options = self.parse_options(option_text)
+            if options is None:
+                return  # Uses an option this matcher doesn't implement
+        if len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/'):
+            return  # Regular expression rules
+        pattern = pattern.lower()
+        if not pattern or pattern in ('*', '|', '||'):
+            return
+
+        pure_host = self.PURE_HOST_RULE.match(pattern)
+        if pure_host and options is None:
+            rule_set.hosts.add(pure_host.group(1))
+            return
+        rule = (pattern, options)
+        host_anchor = self.HOST_ANCHOR.match(pattern)
+        if host_anchor:
+            rule_set.host_rules.setdefault(host_anchor.group(1), []).append(rule)
+            return
+        token = self.rule_token(pattern)
+        if token:
+            rule_set.token_rules.setdefault(token, []).append(rule)
+        else:
+            rule_set.generic_rules.append(rule)
+
+    def parse_options(self, option_text: str):
+        # (third_party, resource types or None, include domains, exclude domains)
+        third_party = None
+        types = 0
+        excluded_types = 0
+        include_domains = []
+        exclude_domains = []
+        for option in option_text.lower().split(','):
+            negated = option.startswith('~')
+            name = option.lstrip('~')
+            if name in ('third-party', '3p'):
+                third_party = not negated
+            elif name in ('first-party', '1p'):
+                third_party = negated
+            elif name in self.RESOURCE_TYPES:
+                if negated:
+                    excluded_types |= 1 << self.RESOURCE_TYPES[name]
+                else:
+                    types |= 1 << self.RESOURCE_TYPES[name]
+            elif name.startswith('domain='):
+                for domain in name[len('domain='):].split('|'):
+                    if domain.startswith('~'):
+                        exclude_domains.append(domain[1:])
+                    elif domain:
+                        include_domains.append(domain)
+            elif name == 'match-case':
+                pass
+            else:
+                return None
+        if excluded_types and not types:
+            types = ~excluded_types
+        return (third_party, types or None, tuple(include_domains), tuple(exclude_domains))
+
+    def rule_token(self, pattern: str):
+        # Longest token that is delimited on both sides within the pattern itself,
+        # so any URL the rule matches contains it as a complete token
+        best = None
+        for match in self.TOKEN_CHARACTERS.finditer(pattern):
+            start, end = match.span()
+            before = pattern[start - 1] if start > 0 else ''
+            after = pattern[end] if end < len(pattern) else ''
+            if start == 0 or before == '*' or (before == '|' and start == 1):
+                continue
+            if after in ('', '*'):
+                continue
+            if best is None or end - start > len(best):
+                best = match.group()
+        return best
+
+    def rule_regex(self, pattern: str):
+        regex = self.regexes.get(pattern)
+        if regex is None:
+            source = pattern
+            prefix = ''
+            suffix = ''
+            if source.startswith('||'):
+                prefix = r'^[a-z][a-z0-9+.-]*://([^/?#]*\.)?'
+                source = source[2:]
+            elif source.startswith('|'):
+                prefix = '^'
+                source = source[1:]
+            if source.endswith('|'):
+                suffix = '$'
+                source = source[:-1]
+            body = ''.join('.*' if char == '*' else r'(?:[^\w.%-]|$)' if char == '^' else re.escape(char)
+                           for char in source)
+            regex = self.regexes[pattern] = re.compile(prefix + body + suffix)
+        return regex
+
+    @staticmethod
+    def site(host: str) -> str:
+        # Approximate registrable domain, enough to tell first from third party
+        labels = host.split('.')
+        if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in ('co', 'com', 'org', 'net', 'ac', 'gov', 'edu'):
+            return '.'.join(labels[-3:])
+        return '.'.join(labels[-2:])
+
+    @staticmethod
+    def host_suffixes(host: str):
+        yield host
+        position = host.find('.')
+        while position >= 0:
+            yield host[position + 1:]
+            position = host.find('.', position + 1)
+
+    def should_block(self, url: str, host: str, first_party_host: str, resource_type: int) -> bool:
+        url = url.lower()
+        host = host.lower()
+        first_party_host = first_party_host.lower()
+        context = (url, host, first_party_host, resource_type)
+        if not self.matches(self.block, context):
+            return False
+        return not self.matches(self.allow, context)
+
+    def matches(self, rule_set: FilterRuleSet, context) -> bool:
+        url, host, first_party_host, resource_type = context
+        for suffix in self.host_suffixes(host):
+            if suffix in rule_set.hosts:
+                return True
+            rules = rule_set.host_rules.get(suffix)
+            if rules and self.any_rule_matches(rules, context):
+                return True
+        if rule_set.token_rules:
+            for token in set(self.TOKEN_CHARACTERS.findall(url)):
+                rules = rule_set.token_rules.get(token)
+                if rules and self.any_rule_matches(rules, context):
+                    return True
+        return bool(rule_set.generic_rules) and self.any_rule_matches(rule_set.generic_rules, context)
+
+    def any_rule_matches(self, rules, context) -> bool:
+        url, host, first_party_host, resource_type = context
+        for pattern, options in rules:
+            if options is not None:
+                third_party, types, include_domains, exclude_domains = options
+                if third_party is not None and third_party != (self.site(host) != self.site(first_party_host)):
+                    continue
+                if types is not None and not types & (1 << resource_type):
+                    continue
+                if include_domains and not any(domain in include_domains
+                                               for domain in self.host_suffixes(first_party_host)):
+                    continue
+                if exclude_domains and any(domain in exclude_domains
+                                           for domain in self.host_suffixes(first_party_host)):
+                    continue
+            if self.rule_regex(pattern).search(url):
+                return True
+        return False
+
+class ContentBlockingInterceptor(QWebEngineUrlRequestInterceptor):
+    # Installed per page rather than on the profile so blocked requests can be
+    # counted per tab; page interceptors run on the UI thread.
+    def __init__(self, browser):
+        super().__init__(browser)
+        self.browser = browser
+
+    def interceptRequest(self, info):
+        main_window = self.browser.main_window
+        if info.resourceType() == QWebEngineUrlRequestInfo.ResourceTypeMainFrame:
+            if self.browser.blocked_requests:
+                self.browser.blocked_requests = 0
+                main_window.update_tab_tooltip(self.browser)
+            return
+        content_filter = main_window.content_filter
+        if content_filter is None or not main_window.settings.get('content_blocking', True):
+            return
+        url = info.requestUrl()
+        if url.scheme() not in ('http', 'https', 'ws', 'wss'):
+            return
+        first_party_host = info.firstPartyUrl().host() or url.host()
+        if content_filter.should_block(url.toString(), url.host(), first_party_host, info.resourceType()):
+            info.block(True)
+            self.browser.blocked_requests += 1
+            main_window.update_tab_tooltip(self.browser)
 
 class JavaScriptAPI(QObject):
-    pass
+    # One instance shared by every tab's web channel, so a theme change is a single
+    # signal however many tabs are open; pages subscribe to it from dark_mode_script
+    darkModeChanged = pyqtSignal(bool)
+    CLIENT_SOURCE = None
 
-class DownloadDialog(QDialog):
-    def __init__(self, filename: str, path: str, main_window, parent=None):
+    def __init__(self, parent=None):
         super().__init__(parent)
-        self.setWindowTitle('Download Progress')
-        self.setWindowModality(Qt.ApplicationModal)
+        self.dark_mode = False
+
+    @pyqtProperty(bool, notify=darkModeChanged)
+    def isDarkMode(self) -> bool:
+        return self.dark_mode
+
+    def set_dark_mode(self, dark_mode: bool):
+        if dark_mode != self.dark_mode:
+            self.dark_mode = dark_mode
+            self.darkModeChanged.emit(dark_mode)
+
+    @classmethod
+    def client_source(cls) -> str:
+        # qwebchannel.js ships as a resource inside the QtWebChannel library
+        if cls.CLIENT_SOURCE is None:
+            file = QFile(":/qtwebchannel/qwebchannel.js")
+            cls.CLIENT_SOURCE = bytes(file.readAll()).decode('utf-8') if file.open(QIODevice.ReadOnly) else ''
+        return cls.CLIENT_SOURCE
+
+def dark_mode_script(is_dark_mode: bool) -> QWebEngineScript:
+    # Runs at document creation, so pages know the theme before their first paint.
+    # Later changes come from JavaScriptAPI.darkModeChanged over the tab's web
+    # channel; qwebchannel.js is included inside the function so pages don't see it.
+    source = """
+    (function() {
+        var isDarkMode = %s;
+        function apply(value) {
+            isDarkMode = value;
+            if (!document.documentElement) return false;
+            document.documentElement.style.setProperty('--is-dark-mode', value);
+            var event = new CustomEvent('darkModeChanged', { detail: { isDarkMode: value } });
+            document.dispatchEvent(event);
+            return true;
+        }
+        if (!apply(isDarkMode)) {
+            var observer = new MutationObserver(function() {
+                if (apply(isDarkMode)) observer.disconnect();
+            });
+            observer.observe(document, { childList: true });
+        }
+        // Repeated for listeners added by the page's own scripts
+        document.addEventListener('DOMContentLoaded', function() { apply(isDarkMode); });
+
+        %s
+
+        var subscribed = false;
+        function subscribe() {
+            // The transport appears once the tab has set up its web channel
+            if (subscribed || typeof qt === 'undefined' || !qt.webChannelTransport) return;
+            subscribed = true;
+            new QWebChannel(qt.webChannelTransport, function(channel) {
+                var api = channel.objects.jsAPI;
+                if (!api) return;
+                if (api.isDarkMode !== isDarkMode) apply(api.isDarkMode);
+                api.darkModeChanged.connect(apply);
+            });
+        }
+        subscribe();
+        document.addEventListener('DOMContentLoaded', subscribe);
+        window.addEventListener('load', subscribe);
+    })();
+    """ % (str(is_dark_mode).lower(), JavaScriptAPI.client_source())
+    script = QWebEngineScript()
+    script.setName(DARK_MODE_SCRIPT_NAME)
+    script.setSourceCode(source)
+    script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+    script.setWorldId(QWebEngineScript.MainWorld)
+    script.setRunsOnSubFrames(False)
+    return script
+
+class CookieMirror:
+    # Copy of the web profile's cookies, so downloads made outside QtWebEngine can
+    # send them too. Kept up to date from QWebEngineCookieStore's signals.
+    def __init__(self):
+        self.cookies = {}  # (domain, path, name) -> (value, secure)
+
+    @staticmethod
+    def key(cookie) -> tuple:
+        return (cookie.domain(), cookie.path() or '/', bytes(cookie.name()).decode('latin-1'))
+
+    def add(self, cookie):
+        self.cookies[self.key(cookie)] = (bytes(cookie.value()).decode('latin-1'), cookie.isSecure())
+
+    def remove(self, cookie):
+        self.cookies.pop(self.key(cookie), None)
+
+    def header(self, url: str) -> str:
+        parts = urllib.parse.urlsplit(url)
+        host = (parts.hostname or '').lower()
+        path = parts.path or '/'
+        pairs = []
+        for (domain, cookie_path, name), (value, secure) in self.cookies.items():
+            domain = domain.lower()
+            # A leading dot means the cookie is also sent to subdomains
+            if domain.startswith('.'):
+                if host != domain[1:] and not host.endswith(domain):
+                    continue
+            elif host != domain:
+                continue
+            if not path.startswith(cookie_path) or (secure and parts.scheme != 'https'):
+                continue
+            pairs.append(f"{name}={value}")
+        return '; '.join(pairs)
+
+class SegmentedDownload(QObject):
+    # Fetches a file over several parallel HTTP range requests into <path>.part and
+    # records each segment's progress in resume_state(), so a partial file can be
+    # resumed, including after a restart. Servers without range support get one
+    # plain request. Provides the parts of the QWebEngineDownloadItem API that
+    # DownloadEntry uses, with the same state values.
+    downloadProgress = pyqtSignal('qint64', 'qint64')
+    finished = pyqtSignal()
+    SEGMENT_COUNT = 4
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    RETRIES = 3
+    TIMEOUT = 30
+    PROGRESS_INTERVAL = 0.1
+
+    def __init__(self, url: str, path: str, request_headers=None, resume_state: dict = None, parent=None):
+        super().__init__(parent)
+        self.url = url
+        self.path = path
+        self.part_path = path + ".part"
+        self.request_headers = request_headers  # Called with the URL on the GUI thread
+        self.headers = {}
+        self.lock = threading.Lock()
+        self.total = -1
+        self.supports_ranges = False
+        self.segments = []  # [start, end (inclusive, -1 while unknown), bytes received]
+        if resume_state:
+            self.total = resume_state['total']
+            self.supports_ranges = resume_state['ranges']
+            self.segments = [list(segment) for segment in resume_state['segments']]
+        self.download_state = QWebEngineDownloadItem.DownloadRequested
+        self.paused = False
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_progress = 0.0
+        self.limiters = []  # BandwidthLimiters set by DownloadScheduler
+
+    def suggestedFileName(self) -> str:
+        return os.path.basename(self.path)
+
+    def state(self):
+        return self.download_state
+
+    def isPaused(self) -> bool:
+        return self.paused
+
+    def totalBytes(self) -> int:
+        return self.total
+
+    def receivedBytes(self) -> int:
+        with self.lock:
+            return sum(segment[2] for segment in self.segments)
+
+    def resume_state(self) -> dict:
+        with self.lock:
+            return {'url': self.url, 'path': self.path, 'total': self.total, 'ranges': self.supports_ranges,
+                    'segments': [list(segment) for segment in self.segments]}
+
+    def start(self):
+        self.headers = self.request_headers(self.url) if self.request_headers else {}
+        self.paused = False
+        self.download_state = QWebEngineDownloadItem.DownloadInProgress
+        self.stop_event = threading.Event()
+        # A paused run may still be finishing its last chunk; the new run waits for it
+        self.thread = threading.Thread(target=self.run, args=(self.stop_event, self.thread),
+                                       name="SegmentedDownload", daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        if self.download_state == QWebEngineDownloadItem.DownloadInProgress and not self.paused:
+            self.paused = True
+            self.stop_event.set()
+
+    def resume(self):
+        if self.paused or self.download_state == QWebEngineDownloadItem.DownloadInterrupted:
+            self.start()
+
+    def cancel(self):
+        if self.download_state in (QWebEngineDownloadItem.DownloadCompleted, QWebEngineDownloadItem.DownloadCancelled):
+            return
+        self.download_state = QWebEngineDownloadItem.DownloadCancelled
+        self.stop_event.set()
+        if self.thread is None or not self.thread.is_alive():
+            self.remove_part_file()
+        self.finished.emit()
+
+    def wait(self, timeout: float = None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def remove_part_file(self):
+        try:
+            os.remove(self.part_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing partial download: {e}")
+
+    def segment_complete(self, segment) -> bool:
+        return segment[1] >= 0 and segment[2] >= segment[1] - segment[0] + 1
+
+    def run(self, stop_event: threading.Event, previous_thread: threading.Thread):
+        if previous_thread is not None:
+            previous_thread.join()
+        errors = []
+        try:
+            if not self.segments or not os.path.exists(self.part_path):
+                self.plan()
+                with open(self.part_path, "wb") as file:
+                    if self.total > 0:
+                        file.truncate(self.total)  # Preallocate so segments can write in place
+            workers = [threading.Thread(target=self.fetch_segment, args=(segment, stop_event, errors),
+                                        name="DownloadSegment", daemon=True)
+                       for segment in self.segments if not self.segment_complete(segment)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        except (OSError, ValueError) as e:
+            errors.append(e)
+
+        if self.download_state == QWebEngineDownloadItem.DownloadCancelled:
+            self.remove_part_file()
+            return
+        if self.paused and not errors:
+            self.report_progress(force=True)
+            return
+        if not errors and not all(self.segment_complete(segment) for segment in self.segments):
+            errors.append(ValueError("download incomplete"))
+        if not errors:
+            try:
+                os.truncate(self.part_path, max(self.total, 0))
+                os.replace(self.part_path, self.path)
+                self.download_state = QWebEngineDownloadItem.DownloadCompleted
+            except OSError as e:
+                errors.append(e)
+        if errors:
+            print(f"Error downloading {self.url}: {errors[0]}")
+            self.download_state = QWebEngineDownloadItem.DownloadInterrupted
+        self.report_progress(force=True)
+        self.finished.emit()
+
+    @classmethod
+    def probe(cls, url: str, headers: dict) -> tuple:
+        # A one-byte range request tells us both the size and whether ranges work
+        headers = dict(headers, Range="bytes=0-0")
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=cls.TIMEOUT) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status == 206 and '/' in content_range and not content_range.endswith('/*'):
+                return True, int(content_range.rsplit('/', 1)[1])
+            return False, int(response.headers.get('Content-Length') or -1)
+
+    def plan(self):
+        self.supports_ranges, self.total = self.probe(self.url, self.headers)
+        with self.lock:
+            if not self.supports_ranges:
+                self.segments = [[0, self.total - 1 if self.total >= 0 else -1, 0]]
+                return
+            count = max(1, min(self.SEGMENT_COUNT, self.total // self.MIN_SEGMENT_SIZE))
+            size = -(-self.total // count) if self.total else 0
+            self.segments = [[start, min(start + size, self.total) - 1, 0] for start in range(0, self.total, size or 1)]
+
+    def fetch_segment(self, segment: list, stop_event: threading.Event, errors: list):
+        attempts = 0
+        while not self.segment_complete(segment) and not stop_event.is_set():
+            headers = dict(self.headers)
+            if self.supports_ranges:
+                headers['Range'] = f"bytes={segment[0] + segment[2]}-{segment[1]}"
+            else:
+                with self.lock:
+                    segment[2] = 0  # Without ranges every attempt starts over
+            try:
+                request = urllib.request.Request(self.url, headers=headers)
+                with urllib.request.urlopen(request, timeout=self.TIMEOUT) as response, \
+                        open(self.part_path, "r+b") as file:
+                    if self.supports_ranges and response.status != 206:
+                        raise ValueError("server stopped honouring range requests")
+                    file.seek(segment[0] + segment[2])
+                    while not stop_event.is_set():
+                        remaining = segment[1] - segment[0] + 1 - segment[2] if segment[1] >= 0 else self.CHUNK_SIZE
+                        chunk = response.read(min(self.CHUNK_SIZE, remaining)) if remaining > 0 else b''
+                        if not chunk:
+                            break
+                        file.write(chunk)
+                        with self.lock:
+                            segment[2] += len(chunk)
+                        self.report_progress()
+                        for limiter in self.limiters:
+                            limiter.consume(len(chunk))
+                if segment[1] < 0 and not stop_event.is_set():
+                    # Length wasn't announced, so the end of the body is the end of the file
+                    with self.lock:
+                        segment[1] = segment[2] - 1
+                        self.total = segment[2]
+                elif not self.segment_complete(segment) and not stop_event.is_set():
+                    raise ValueError("connection closed early")
+                attempts = 0
+            except (OSError, ValueError) as e:
+                attempts += 1
+                if attempts > self.RETRIES:
+                    errors.append(e)
+                    stop_event.set()
+                    return
+
+    def report_progress(self, force: bool = False):
+        # Emitted from the worker threads; throttled so the GUI isn't flooded
+        now = time.monotonic()
+        if not force and now - self.last_progress < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        self.downloadProgress.emit(self.receivedBytes(), self.total)
+
+class BandwidthLimiter:
+    # Token bucket shared by the download threads it throttles. A rate of 0 means
+    # unlimited; callers over their budget sleep until it has refilled.
+    def __init__(self, rate: int = 0):
+        self.rate = rate  # Bytes per second
+        self.allowance = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate: int):
+        with self.lock:
+            self.rate = rate
+            self.allowance = 0.0
+            self.updated = time.monotonic()
+
+    def consume(self, size: int):
+        with self.lock:
+            if self.rate <= 0:
+                return
+            now = time.monotonic()
+            # Allows at most one second's worth of burst after an idle period
+            self.allowance = min(self.rate, self.allowance + (now - self.updated) * self.rate) - size
+            self.updated = now
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+class DownloadScheduler(QObject):
+    # Starts queued downloads in priority order, first come first served within a
+    # priority, while fewer than the configured maximum are running, and keeps the
+    # toolbar's DownloadIndicator up to date. Bandwidth limits apply to downloads
+    # made by SegmentedDownload; QtWebEngine's own downloads can only be queued.
+    PRIORITIES = {'High': 2, 'Normal': 1, 'Low': 0}
+    INDICATOR_INTERVAL_MS = 500
+
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.manager = manager
+        self.running = []
+        self.queue = []
+        self.sequence = 0
+        self.global_limiter = BandwidthLimiter()
+        self.limiters = {}  # Per-download limiter of each running entry
+        self.indicator_timer = QTimer(self)
+        self.indicator_timer.setInterval(self.INDICATOR_INTERVAL_MS)
+        self.indicator_timer.timeout.connect(self.update_indicator)
+        self.apply_settings()
+
+    def apply_settings(self):
+        settings = self.manager.main_window.settings
+        self.global_limiter.set_rate(settings.get('download_limit_kbps', 0) * 1024)
+        for limiter in self.limiters.values():
+            limiter.set_rate(settings.get('per_download_limit_kbps', 0) * 1024)
+        self.start_queued()
+
+    def enqueue(self, entry):
+        self.sequence += 1
+        entry.queued_at = self.sequence
+        self.queue.append(entry)
+        item = entry.download_item
+        if not isinstance(item, SegmentedDownload) and item.state() == QWebEngineDownloadItem.DownloadInProgress \
+                and not item.isPaused():
+            item.pause()  # QtWebEngine starts a download as soon as it is accepted
+        entry.set_queued(True)
+        self.start_queued()
+
+    def start_queued(self):
+        limit = max(1, self.manager.main_window.settings.get('max_concurrent_downloads', 3))
+        while self.queue and len(self.running) < limit:
+            entry = max(self.queue, key=lambda entry: (entry.priority, -entry.queued_at))
+            self.queue.remove(entry)
+            self.running.append(entry)
+            self.start(entry)
+        self.update_indicator()
+
+    def start(self, entry):
+        item = entry.download_item
+        if isinstance(item, SegmentedDownload):
+            limiter = BandwidthLimiter(self.manager.main_window.settings.get('per_download_limit_kbps', 0) * 1024)
+            self.limiters[entry] = limiter
+            item.limiters = [self.global_limiter, limiter]
+            if item.state() == QWebEngineDownloadItem.DownloadRequested:
+                item.start()
+            else:
+                item.resume()
+        else:
+            item.resume()
+        entry.set_queued(False)
+        if not self.indicator_timer.isActive():
+            self.indicator_timer.start()
+
+    def release(self, entry):
+        # Called when a download finishes, fails, is paused or is canceled
+        if entry in self.running:
+            self.running.remove(entry)
+        if entry in self.queue:
+            self.queue.remove(entry)
+        self.limiters.pop(entry, None)
+        self.start_queued()
+
+    def set_priority(self, entry, priority: int):
+        entry.priority = priority
+        self.manager.model.mark_dirty(entry)
+
+    def update_indicator(self):
+        received = 0
+        total = 0
+        for entry in self.running:
+            if entry.bytes_total > 0:
+                received += entry.bytes_received
+                total += entry.bytes_total
+        self.manager.main_window.download_indicator.update_status(len(self.running), len(self.queue), received, total)
+        if not self.running and not self.queue:
+            self.indicator_timer.stop()
+
+class DownloadIndicator(QWidget):
+    # One summary of all running and queued downloads for the toolbar;
+    # clicking it opens the download manager
+    def __init__(self, main_window):
+        super().__init__(main_window)
         self.main_window = main_window
-        self.filename_label = QLabel(f'File: {filename}')
-        self.path_label = QLabel(f'Save to: {path}')
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.label = QLabel()
         self.progress_bar = QProgressBar()
-        self.progress_bar.setValue(0)
-        self.manage_downloads_button = QPushButton('Manage Downloads')
-        self.manage_downloads_button.clicked.connect(self.open_download_manager)
-        layout = QVBoxLayout()
-        layout.addWidget(self.filename_label)
-        layout.addWidget(self.path_label)
+        self.progress_bar.setMaximumWidth(160)
+        layout.addWidget(self.label)
         layout.addWidget(self.progress_bar)
-        layout.addWidget(self.manage_downloads_button)
         self.setLayout(layout)
+        self.setCursor(Qt.PointingHandCursor)
+        self.setToolTip('Show Download Manager')
+        self.setVisible(False)
 
-    def update_progress(self, received: int, total: int):
+    def update_status(self, active: int, queued: int, received: int, total: int):
+        self.setVisible(bool(active or queued))
+        self.label.setText(f"{active} downloading" + (f", {queued} queued" if queued else ""))
         if total > 0:
-            percentage = int((received / total) * 100)
-            self.progress_bar.setValue(percentage)
-
-    def download_complete(self):
-        msg_box = QMessageBox(self)
-        msg_box.setWindowTitle('Download Complete')
-        msg_box.setText('The download is complete.')
-        msg_box.setStandardButtons(QMessageBox.Ok)
-        msg_box.buttonClicked.connect(self.close_dialog)
-        msg_box.exec_()
-
-    def download_canceled(self):
-        msg_box = QMessageBox(self)
-        msg_box.setWindowTitle('Download Canceled')
-        msg_box.setText('The download was canceled.')
-        msg_box.setStandardButtons(QMessageBox.Ok)
-        msg_box.buttonClicked.connect(self.close_dialog)
-        msg_box.exec_()
-
-    def open_download_manager(self):
-        self.main_window.show_download_manager()
-        self.hide()
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(int(received / total * 100))
+        else:
+            self.progress_bar.setRange(0, 0)  # Sizes unknown, so just show activity
 
-    def close_dialog(self):
-        self.close()
+    def mousePressEvent(self, event):
+        self.main_window.show_download_manager()
 
-class DownloadItemWidget(QWidget):
-    def __init__(self, download_item, download_manager, saved_state=None):
-        super().__init__()
+class DownloadEntry:
+    # One row of the download manager: either a live download (QWebEngineDownloadItem
+    # or SegmentedDownload) or a finished one paged in from the saved state
+    def __init__(self, model, download_item=None, saved_state=None):
+        self.model = model
         self.download_item = download_item
+        self.filename = download_item.suggestedFileName() if download_item is not None else saved_state['filename']
+        self.progress = 0
+        self.status = "%p%"
+        self.is_paused = False
         self.is_canceled = False
-        self.is_paused = False  # New flag to track pause/resume state
-        self.download_manager = download_manager
-
-        self.layout = QHBoxLayout()
-        self.setLayout(self.layout)
-
-        self.filename_label = QLabel(self.download_item.suggestedFileName())
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setValue(0)
-        self.progress_bar.setFormat("%p%")  # Set format to show percentage
-        self.cancel_button = QPushButton("Remove")
-        self.pause_resume_button = QPushButton("Pause")
-
-        self.layout.addWidget(self.filename_label)
-        self.layout.addWidget(self.progress_bar)
-        self.layout.addWidget(self.pause_resume_button)
-        self.layout.addWidget(self.cancel_button)
-
-        self.download_item.downloadProgress.connect(self.update_progress)
-        self.download_item.finished.connect(self.on_download_finished)
-
-        self.cancel_button.clicked.connect(self.cancel_download)
-        self.pause_resume_button.clicked.connect(self.pause_resume_download)  # Connect to the new method
-
+        self.is_failed = False
+        # Saved entries without a live download can only be removed
+        self.is_finished = download_item is None
+        self.started_at = time.time()
+        self.priority = DownloadScheduler.PRIORITIES['Normal']
+        self.queued_at = 0
+        self.is_queued = False
+        self.bytes_received = 0
+        self.bytes_total = -1
+        if download_item is not None:
+            download_item.downloadProgress.connect(self.update_progress)
+            download_item.finished.connect(self.on_download_finished)
         if saved_state:
             self.load_state(saved_state)
 
+    def buttons(self) -> list:
+        if self.is_finished or self.is_canceled:
+            return [("Remove", self.remove_download)]
+        if self.is_failed:
+            label = "Retry"
+        else:
+            label = "Resume" if self.is_paused else "Pause"
+        return [(label, self.pause_resume_download), ("Remove", self.cancel_download)]
+
+    def set_queued(self, queued: bool):
+        self.is_queued = queued
+        self.status = "Queued" if queued else "%p%"
+        self.model.mark_dirty(self)
+
     def update_progress(self, bytes_received, bytes_total):
+        self.bytes_received = bytes_received
+        self.bytes_total = bytes_total
         if bytes_total > 0:
             progress = int((bytes_received / bytes_total) * 100)
-            self.progress_bar.setValue(progress)
-            self.save_state()
+            if progress != self.progress:
+                self.progress = progress
+                self.save_state()
+                self.model.mark_dirty(self)
 
     def on_download_finished(self):
-        self.progress_bar.setValue(100)
-        self.progress_bar.setFormat("Download Completed")
-        self.pause_resume_button.setVisible(False)
-        self.cancel_button.setText("Remove")
-        self.cancel_button.clicked.disconnect()
-        self.cancel_button.clicked.connect(self.remove_download)
-        self.save_state()
+        state = self.download_item.state()
+        if state == QWebEngineDownloadItem.DownloadCancelled:
+            return
+        self.model.manager.scheduler.release(self)
+        if state == QWebEngineDownloadItem.DownloadInterrupted:
+            self.status = "Download Failed (%p%)"
+            self.is_failed = True
+            self.is_paused = True
+        else:
+            self.progress = 100
+            self.status = "Download Completed"
+            self.is_finished = True
+        self.save_state(flush=True)
+        self.model.mark_dirty(self)
 
     def pause_resume_download(self):
+        # Resuming goes back through the scheduler's queue rather than starting at once
+        scheduler = self.model.manager.scheduler
         if not self.is_paused:
-            self.download_item.pause()
-            self.pause_resume_button.setText("Resume")
+            if not self.is_queued:
+                self.download_item.pause()
+            scheduler.release(self)
+            self.is_queued = False
+            self.status = "%p%"
             self.is_paused = True
         else:
-            self.download_item.resume()
-            self.pause_resume_button.setText("Pause")
             self.is_paused = False
-        self.save_state()
+            self.is_failed = False
+            scheduler.enqueue(self)
+        self.save_state(flush=True)
+        self.model.mark_dirty(self)
 
     def cancel_download(self):
         self.is_canceled = True
+        self.is_queued = False
+        self.model.manager.scheduler.release(self)
         self.download_item.cancel()
-        self.progress_bar.setFormat("Download Canceled")
-        self.cancel_button.setText("Remove")
-        self.pause_resume_button.setEnabled(False)
-        self.cancel_button.clicked.disconnect()
-        self.cancel_button.clicked.connect(self.remove_download)
-        self.save_state()
+        self.status = "Download Canceled"
+        self.save_state(flush=True)
+        self.model.mark_dirty(self)
 
     def remove_download(self):
-        self.setParent(None)
-        self.deleteLater()
-        self.download_manager.check_no_downloads()
-        self.download_manager.remove_saved_state(self.filename_label.text())
+        self.model.remove_entry(self)
+        self.model.manager.check_no_downloads()
+        self.model.manager.remove_saved_state(self.filename)
 
-    def save_state(self):
+    def save_state(self, flush=False):
         state = {
-            'filename': self.filename_label.text(),
-            'progress': self.progress_bar.value(),
+            'filename': self.filename,
+            'progress': self.progress,
             'is_paused': self.is_paused,
-            'is_canceled': self.is_canceled
+            'is_canceled': self.is_canceled,
+            'started_at': self.started_at
         }
-        self.download_manager.save_download_state(state)
+        if isinstance(self.download_item, SegmentedDownload) and \
+                self.download_item.state() != QWebEngineDownloadItem.DownloadCompleted:
+            state['resume'] = self.download_item.resume_state()
+        self.model.manager.save_download_state(state, flush)
 
     def load_state(self, state):
-        self.progress_bar.setValue(state['progress'])
+        self.progress = state['progress']
         self.is_paused = state['is_paused']
         self.is_canceled = state['is_canceled']
-        if self.is_paused:
-            self.pause_resume_button.setText("Resume")
+        self.started_at = state.get('started_at', 0)
         if self.is_canceled:
-            self.progress_bar.setFormat("Download Canceled")
-            self.pause_resume_button.setEnabled(False)
-            self.cancel_button.setText("Remove")
+            self.status = "Download Canceled"
+        elif self.is_finished:
+            self.status = "Download Completed" if self.progress >= 100 else "Interrupted (%p%)"
+
+class DownloadListModel(QAbstractListModel):
+    # Live downloads come first, newest at the top; saved entries from earlier
+    # sessions are read from the profile store a page at a time as the view
+    # scrolls. Progress changes are collected and reported to the view at most
+    # every REFRESH_INTERVAL_MS.
+    REFRESH_INTERVAL_MS = 100
+    PAGE_SIZE = 100
+
+    def __init__(self, manager):
+        super().__init__(manager)
+        self.manager = manager
+        self.entries = []
+        self.saved_cursor = None  # Where the next page of saved entries starts
+        self.more_saved = True
+        self.dirty = set()
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(self.REFRESH_INTERVAL_MS)
+        self.refresh_timer.timeout.connect(self.flush_updates)
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.entries):
+            return None
+        entry = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return entry.filename
+        if role == Qt.UserRole:
+            return entry
+        if role == Qt.ToolTipRole:
+            return f"Disk writes for this download: {self.manager.store.download_write_count(entry.filename)}"
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return not parent.isValid() and self.more_saved
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or not self.more_saved:
+            return
+        rows = self.manager.store.download_page(self.saved_cursor, self.PAGE_SIZE)
+        self.more_saved = len(rows) == self.PAGE_SIZE
+        if rows:
+            self.saved_cursor = rows[-1][1]
+        # Downloads started since the list opened are saved too, but already listed
+        listed = {entry.filename for entry in self.entries}
+        page = [state for state, _ in rows if state['filename'] not in listed]
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.entries), len(self.entries) + len(page) - 1)
+            self.entries.extend(DownloadEntry(self, saved_state=state) for state in page)
+            self.endInsertRows()
+
+    def add_entry(self, entry: DownloadEntry, row: int = 0):
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.entries.insert(row, entry)
+        self.endInsertRows()
+
+    def remove_entry(self, entry: DownloadEntry):
+        try:
+            row = self.entries.index(entry)
+        except ValueError:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.entries[row]
+        self.endRemoveRows()
+        self.dirty.discard(entry)
+
+    def mark_dirty(self, entry: DownloadEntry):
+        self.dirty.add(entry)
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def flush_updates(self):
+        rows = [self.entries.index(entry) for entry in self.dirty if entry in self.entries]
+        self.dirty.clear()
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)))
+
+class DownloadItemDelegate(QStyledItemDelegate):
+    # Paints a download row (name, progress bar, buttons) directly instead of
+    # creating widgets for it, and turns clicks on the buttons into actions
+    ROW_HEIGHT = 36
+    MARGIN = 4
+    PROGRESS_WIDTH = 220
+    BUTTON_WIDTH = 80
+    BUTTON_SLOTS = 2
+
+    def sizeHint(self, option, index) -> QSize:
+        # Rows span the view; the parent view relayouts on resize (QListView.Adjust)
+        minimum_width = self.PROGRESS_WIDTH + self.BUTTON_SLOTS * (self.BUTTON_WIDTH + self.MARGIN) + 150
+        view = self.parent()
+        return QSize(max(minimum_width, view.viewport().width() if view else 0), self.ROW_HEIGHT)
+
+    def layout(self, rect: QRect, entry: DownloadEntry):
+        # Button slots are always reserved so progress bars line up between rows
+        inner = rect.adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+        buttons = []
+        right = inner.right() + 1
+        for label, action in reversed(entry.buttons()):
+            right -= self.BUTTON_WIDTH
+            buttons.insert(0, (QRect(right, inner.top(), self.BUTTON_WIDTH, inner.height()), label, action))
+            right -= self.MARGIN
+        buttons_left = inner.right() + 1 - self.BUTTON_SLOTS * (self.BUTTON_WIDTH + self.MARGIN)
+        progress_rect = QRect(buttons_left - self.PROGRESS_WIDTH, inner.top(), self.PROGRESS_WIDTH, inner.height())
+        text_rect = QRect(inner.left(), inner.top(), max(0, progress_rect.left() - self.MARGIN - inner.left()), inner.height())
+        return text_rect, progress_rect, buttons
+
+    def paint(self, painter, option, index):
+        entry = index.data(Qt.UserRole)
+        if entry is None:
+            return
+        style = option.widget.style() if option.widget else QApplication.style()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        text_rect, progress_rect, buttons = self.layout(option.rect, entry)
+
+        name = option.fontMetrics.elidedText(entry.filename, Qt.ElideMiddle, text_rect.width())
+        painter.drawText(text_rect, Qt.AlignVCenter | Qt.AlignLeft, name)
+
+        progress = QStyleOptionProgressBar()
+        progress.rect = progress_rect
+        progress.palette = option.palette
+        progress.state = QStyle.State_Enabled
+        progress.minimum = 0
+        progress.maximum = 100
+        progress.progress = entry.progress
+        progress.text = entry.status.replace('%p', str(entry.progress))
+        progress.textVisible = True
+        progress.textAlignment = Qt.AlignCenter
+        style.drawControl(QStyle.CE_ProgressBar, progress, painter, option.widget)
+
+        for rect, label, action in buttons:
+            button = QStyleOptionButton()
+            button.rect = rect
+            button.palette = option.palette
+            button.text = label
+            button.state = QStyle.State_Enabled | QStyle.State_Raised
+            style.drawControl(QStyle.CE_PushButton, button, painter, option.widget)
+
+    def editorEvent(self, event, model, option, index) -> bool:
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            entry = index.data(Qt.UserRole)
+            if entry is not None:
+                for rect, label, action in self.layout(option.rect, entry)[2]:
+                    if rect.contains(event.pos()):
+                        # Deferred because the action may remove this row
+                        QTimer.singleShot(0, action)
+                        return True
+        return super().editorEvent(event, model, option, index)
 
 class DownloadManagerDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.main_window = parent
         self.setWindowTitle('Download Manager')
         self.setMinimumSize(600, 400)
 
@@ -277,60 +3051,355 @@ class DownloadManagerDialog(QDialog):
         self.no_downloads_label.setStyleSheet("font-size: 16px; color: gray;")
         self.layout.addWidget(self.no_downloads_label)
 
-        self.downloads_layout = QVBoxLayout()
-        self.downloads_layout.setAlignment(Qt.AlignTop)
+        self.model = DownloadListModel(self)
+        self.list_view = QListView()
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setResizeMode(QListView.Adjust)
+        self.list_view.setModel(self.model)
+        self.list_view.setItemDelegate(DownloadItemDelegate(self.list_view))
+        self.list_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.list_view.customContextMenuRequested.connect(self.show_context_menu)
+
+        self.layout.addWidget(self.list_view)
+
+        self.store = self.main_window.profile_store
+        self.scheduler = DownloadScheduler(self)
+        self.restore_downloads()
+
+    def restore_downloads(self):
+        # Segmented downloads that were still running or paused come back paused;
+        # everything else is only read in when the list is scrolled to it
+        for state in self.store.load_resumable_downloads():
+            resume_state = state['resume']
+            download = SegmentedDownload(resume_state['url'], resume_state['path'],
+                                         self.main_window.download_request_headers, resume_state, self)
+            download.paused = True
+            download.download_state = QWebEngineDownloadItem.DownloadInProgress
+            entry = DownloadEntry(self.model, download, dict(state, is_paused=True))
+            self.model.add_entry(entry, self.model.rowCount())
+        self.model.fetchMore()
+        self.check_no_downloads()
 
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area_widget = QWidget()
-        self.scroll_area_widget.setLayout(self.downloads_layout)
-        self.scroll_area.setWidget(self.scroll_area_widget)
-
-        self.layout.addWidget(self.scroll_area)
-
-        self.saved_state_file = "downloads.json"
-        self.load_saved_state()
+    def shutdown(self):
+        # Stop running segmented downloads and record where each one got to
+        for entry in self.model.entries:
+            if isinstance(entry.download_item, SegmentedDownload) and not entry.is_finished:
+                entry.download_item.pause()
+                entry.download_item.wait(timeout=5)
+                entry.save_state()
+        self.store.flush()
 
     def add_download(self, download_item):
-        if self.no_downloads_label.isVisible():
-            self.no_downloads_label.setVisible(False)
-        download_widget = DownloadItemWidget(download_item, self)
-        self.downloads_layout.insertWidget(0, download_widget)
-
-    def save_download_state(self, state):
-        all_states = self.load_saved_state()
-        all_states[state['filename']] = state
-        with open(self.saved_state_file, "w") as file:
-            json.dump(all_states, file)
+        entry = DownloadEntry(self.model, download_item)
+        self.model.add_entry(entry)
+        entry.save_state()
+        self.scheduler.enqueue(entry)
+        self.check_no_downloads()
+        self.list_view.scrollToTop()
+
+    def show_context_menu(self, position):
+        entry = self.list_view.indexAt(position).data(Qt.UserRole)
+        if entry is None or entry.is_finished or entry.is_canceled:
+            return
+        menu = QMenu(self)
+        for name, priority in DownloadScheduler.PRIORITIES.items():
+            action = menu.addAction(f"{name} Priority")
+            action.setCheckable(True)
+            action.setChecked(entry.priority == priority)
+            action.triggered.connect(lambda _, priority=priority: self.scheduler.set_priority(entry, priority))
+        menu.exec_(self.list_view.viewport().mapToGlobal(position))
+
+    def save_download_state(self, state, flush=False):
+        # Only queued here; the persistence writer thread commits it
+        self.store.save_download(state, flush)
 
     def remove_saved_state(self, filename):
-        all_states = self.load_saved_state()
-        if filename in all_states:
-            del all_states[filename]
-            with open(self.saved_state_file, "w") as file:
-                json.dump(all_states, file)
+        self.store.remove_download(filename)
+
+    def check_no_downloads(self):
+        empty = self.model.rowCount() == 0 and not self.model.canFetchMore()
+        self.no_downloads_label.setVisible(empty)
+
+class ProcessSampler:
+    # Reads CPU time and memory for renderer processes from /proc. CPU % comes from
+    # the change in CPU time since the previous sample, and the costlier private
+    # memory figure (smaps_rollup) is only re-read every few samples per process.
+    PRIVATE_MEMORY_INTERVAL = 5
 
-    def load_saved_state(self):
+    def __init__(self):
+        self.cpu_times = {}  # pid -> (cpu seconds, sampled at)
+        self.private_memory = {}  # pid -> (bytes, sample number it was read at)
+        self.sample_number = 0
         try:
-            with open(self.saved_state_file, "r") as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        except (ValueError, AttributeError):
+            self.clock_ticks = 100
+
+    def sample(self, pids) -> dict:
+        self.sample_number += 1
+        now = time.monotonic()
+        results = {}
+        for pid in pids:
+            cpu_time = self.read_cpu_time(pid)
+            cpu_percent = None
+            if cpu_time is not None:
+                previous = self.cpu_times.get(pid)
+                if previous is not None and now > previous[1]:
+                    cpu_percent = max(0.0, (cpu_time - previous[0]) / (now - previous[1]) * 100)
+                self.cpu_times[pid] = (cpu_time, now)
+            private = self.private_memory.get(pid)
+            if private is None or self.sample_number - private[1] >= self.PRIVATE_MEMORY_INTERVAL:
+                private = (self.read_private_memory(pid), self.sample_number)
+                self.private_memory[pid] = private
+            results[pid] = (cpu_percent, process_rss_bytes(pid), private[0])
+
+        # Forget processes that have gone away
+        for pid in set(self.cpu_times) - set(pids):
+            del self.cpu_times[pid]
+        for pid in set(self.private_memory) - set(pids):
+            del self.private_memory[pid]
+        return results
+
+    def read_cpu_time(self, pid: int):
+        try:
+            with open(f"/proc/{pid}/stat", "r") as file:
+                # The command name can contain spaces, so split after its closing paren
+                fields = file.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self.clock_ticks  # utime + stime
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def read_private_memory(self, pid: int):
+        try:
+            total = 0
+            with open(f"/proc/{pid}/smaps_rollup", "r") as file:
+                for line in file:
+                    if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                        total += int(line.split()[1]) * 1024
+            return total
+        except (OSError, ValueError, IndexError):
+            return None
+
+class TabSwitcherDialog(QDialog):
+    # Grid of tab thumbnails; picking one switches to that tab. Thumbnails come
+    # from ThumbnailCache, so tabs that were never loaded this session show too.
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.setWindowTitle("Tabs")
+        self.resize(1100, 700)
+
+        self.model = QStandardItemModel(self)
+        self.view = QListView()
+        self.view.setViewMode(QListView.IconMode)
+        self.view.setMovement(QListView.Static)
+        self.view.setResizeMode(QListView.Adjust)
+        self.view.setUniformItemSizes(True)
+        self.view.setSpacing(12)
+        self.view.setIconSize(QSize(ThumbnailCache.WIDTH, ThumbnailCache.HEIGHT))
+        self.view.setModel(self.model)
+        self.view.clicked.connect(self.switch_to_tab)
+        self.view.activated.connect(self.switch_to_tab)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.view)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+
+    def refresh(self):
+        self.model.clear()
+        tab_widget = self.main_window.tab_widget
+        current = tab_widget.currentWidget()
+        for index in range(tab_widget.count()):
+            widget = tab_widget.widget(index)
+            if isinstance(widget, TabPlaceholder):
+                image = self.main_window.thumbnail_cache.load(widget.url)
+            elif widget is current:
+                # The open tab is shown as it is now rather than as it was last captured
+                image = widget.grab().toImage().scaled(ThumbnailCache.WIDTH, ThumbnailCache.HEIGHT,
+                                                       Qt.KeepAspectRatioByExpanding)
+                image = image.copy(0, 0, ThumbnailCache.WIDTH, ThumbnailCache.HEIGHT)
+            else:
+                image = self.main_window.thumbnail_cache.load(widget.url().toString())
+            pixmap = QPixmap(ThumbnailCache.WIDTH, ThumbnailCache.HEIGHT)
+            if image.isNull():
+                pixmap.fill(QColor('lightgray'))
+            else:
+                pixmap.convertFromImage(image)
+            item = QStandardItem(QIcon(pixmap), tab_widget.tabText(index))
+            item.setToolTip(widget.url if isinstance(widget, TabPlaceholder) else widget.url().toString())
+            item.setData(index, Qt.UserRole)
+            item.setEditable(False)
+            self.model.appendRow(item)
+        self.view.setCurrentIndex(self.model.index(tab_widget.currentIndex(), 0))
+
+    def switch_to_tab(self, index: QModelIndex):
+        self.main_window.tab_widget.setCurrentIndex(index.data(Qt.UserRole))
+        self.accept()
+
+class TaskManagerDialog(QDialog):
+    REFRESH_INTERVAL_MS = 2000
+    COLUMNS = ['Tab', 'Process ID', 'CPU %', 'Memory', 'Private Memory', 'State']
 
-    def check_no_downloads(self):
-        if self.downloads_layout.count() == 0:
-            self.no_downloads_label.setVisible(True)
-        else:
-            self.no_downloads_label.setVisible(False)
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.setWindowTitle('Task Manager')
+        self.setMinimumSize(700, 400)
+        self.sampler = ProcessSampler()
+        self.rows = []  # Browser shown in each table row
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.cellDoubleClicked.connect(self.switch_to_tab)
+
+        self.reload_button = QPushButton('Reload')
+        self.reload_button.clicked.connect(self.reload_selected)
+        self.discard_button = QPushButton('Discard')
+        self.discard_button.clicked.connect(self.discard_selected)
+        self.close_tab_button = QPushButton('Close Tab')
+        self.close_tab_button.clicked.connect(self.close_selected)
+
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        button_layout.addWidget(self.reload_button)
+        button_layout.addWidget(self.discard_button)
+        button_layout.addWidget(self.close_tab_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+        # Only samples while the window is open
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.REFRESH_INTERVAL_MS)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+        self.timer.start()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.timer.stop()
+
+    def refresh(self):
+        browsers = self.main_window.browsers()
+        if browsers != self.rows:
+            selected = set(self.selected_browsers())
+            self.rows = browsers
+            self.table.setRowCount(len(browsers))
+            self.table.clearSelection()
+            for row, browser in enumerate(browsers):
+                if browser in selected:
+                    self.table.selectRow(row)
+
+        # Renderers can be shared between tabs, so each process is only read once
+        pids = {}
+        for browser in browsers:
+            pid = browser.page().renderProcessPid()
+            if pid > 0:
+                pids[pid] = pids.get(pid, 0) + 1
+        samples = self.sampler.sample(list(pids))
+
+        for row, browser in enumerate(browsers):
+            page = browser.page()
+            pid = page.renderProcessPid()
+            cpu_percent, rss, private = samples.get(pid, (None, None, None))
+            state = page.lifecycleState()
+            if state == QWebEnginePage.LifecycleState.Discarded:
+                state_text = 'Discarded'
+            elif state == QWebEnginePage.LifecycleState.Frozen:
+                state_text = 'Frozen'
+            else:
+                state_text = 'Active'
+            process_text = '-'
+            if pid > 0:
+                process_text = str(pid) if pids[pid] == 1 else f"{pid} (shared by {pids[pid]} tabs)"
+            self.set_cell(row, 0, page.title() or browser.url().toString() or 'New Tab')
+            self.set_cell(row, 1, process_text)
+            self.set_cell(row, 2, '-' if cpu_percent is None else f"{cpu_percent:.1f}")
+            self.set_cell(row, 3, self.format_memory(rss))
+            self.set_cell(row, 4, self.format_memory(private))
+            self.set_cell(row, 5, state_text)
+
+    def set_cell(self, row: int, column: int, text: str):
+        # Reuses items and skips unchanged text so a refresh repaints as little as possible
+        item = self.table.item(row, column)
+        if item is None:
+            item = QTableWidgetItem(text)
+            if column > 0:
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            self.table.setItem(row, column, item)
+        elif item.text() != text:
+            item.setText(text)
+
+    @staticmethod
+    def format_memory(size) -> str:
+        if size is None:
+            return '-'
+        return f"{size / (1024 * 1024):.1f} MB"
+
+    def selected_browsers(self) -> list:
+        rows = sorted({index.row() for index in self.table.selectionModel().selectedRows()})
+        return [self.rows[row] for row in rows if row < len(self.rows)]
+
+    def switch_to_tab(self, row: int, column: int):
+        if row < len(self.rows):
+            index = self.main_window.tab_widget.indexOf(self.rows[row])
+            if index >= 0:
+                self.main_window.tab_widget.setCurrentIndex(index)
+
+    def reload_selected(self):
+        for browser in self.selected_browsers():
+            browser.reload()
+        self.refresh()
+
+    def discard_selected(self):
+        for browser in self.selected_browsers():
+            self.main_window.tab_lifecycle.discard(browser)
+        self.refresh()
+
+    def close_selected(self):
+        for browser in self.selected_browsers():
+            index = self.main_window.tab_widget.indexOf(browser)
+            if index >= 0:
+                self.main_window.close_tab(index)
+        self.refresh()
 
 class WebEnginePage(QWebEnginePage):
     def __init__(self, browser):
-        super().__init__(browser)
+        super().__init__(browser.main_window.web_profile, browser)
         self.browser = browser
+        # Last URL reached by submitting a form (or a redirect from one), which may have been a POST
+        self.form_submission_url = QUrl()
+        self.content_blocker = ContentBlockingInterceptor(browser)
+        self.setUrlRequestInterceptor(self.content_blocker)
 
     def createWindow(self, window_type):
+        if self.browser.prerendering:
+            return None  # Hidden prerenders don't get to open popups
         return self.browser.main_window.add_tab().page()
 
+    def acceptNavigationRequest(self, url, navigation_type, is_main_frame):
+        if navigation_type == QWebEnginePage.NavigationTypeFormSubmitted or \
+                (navigation_type == QWebEnginePage.NavigationTypeRedirect and url.isValid() and
+                 self.form_submission_url.isValid()):
+            self.form_submission_url = url
+        elif is_main_frame:
+            self.form_submission_url = QUrl()
+        if is_main_frame and not self.browser.prerendering and navigation_type != QWebEnginePage.NavigationTypeRedirect:
+            self.browser.main_window.predictor.on_navigation(self.browser, url)
+        return super().acceptNavigationRequest(url, navigation_type, is_main_frame)
+
     def acceptFeaturePermission(self, securityOrigin, feature):
         if feature == QWebEnginePage.FullScreenVideoFeature:
             self.setFeaturePermission(securityOrigin, feature, QWebEnginePage.PermissionGrantedByUser)
@@ -338,54 +3407,123 @@ class WebEnginePage(QWebEnginePage):
             super().acceptFeaturePermission(securityOrigin, feature)
 
 class BrowserWindow(QWebEngineView):
-    def __init__(self, main_window):
+    def __init__(self, main_window, prerendering: bool = False):
         super().__init__()
         if main_window is None:
             raise ValueError("main_window is required")
         self.main_window = main_window
+        self.last_active = time.monotonic()
+        self.discarded = False
+        self.blocked_requests = 0
+        self.thumbnail_taken = 0
+        # A hidden prerender stays out of history until it is shown in a tab
+        self.prerendering = prerendering
+        self.prerender_loaded = False
+        self.navigation_timing = None
         self.setPage(WebEnginePage(self))
-        self.page().profile().downloadRequested.connect(self.on_download_requested)
+        self.page().setAudioMuted(prerendering)
         self.loadFinished.connect(self.add_to_history)
         self.loadFinished.connect(self.on_load_finished)
-        self.initial_load = True
+        self.initial_load = not prerendering
         self.page().fullScreenRequested.connect(self.handle_fullscreen_requested)
 
+        # Not needed to show the page, so it is set up once the event loop is running;
+        # the dark mode script subscribes to the shared JavaScriptAPI through it
+        self.channel = None
+        QTimer.singleShot(0, self.setup_web_channel)
+
+    def setup_web_channel(self):
         self.channel = QWebChannel(self.page())
-        self.js_api = JavaScriptAPI()
-        self.channel.registerObject('jsAPI', self.js_api)
+        self.channel.registerObject('jsAPI', self.main_window.js_api)
         self.page().setWebChannel(self.channel)
 
-        # Inject dark mode status on page load
-        self.loadFinished.connect(self.inject_dark_mode_status)
-
     def on_load_finished(self, success: bool):
+        if self.prerendering:
+            self.prerender_loaded = success
+            return
+        self.main_window.predictor.on_load_finished(self, success)
         try:
             if not success:
                 print("Failed to load the page.")
             else:
                 print("Page loaded successfully.")
+                self.capture_page_text()
+                self.measure_cache_hits()
+                self.thumbnail_taken = 0
+                QTimer.singleShot(ThumbnailCache.CAPTURE_DELAY_MS, self.capture_thumbnail)
         except Exception as e:
             print(f"Error in on_load_finished: {e}")
 
+    def capture_page_text(self):
+        url = self.url().toString()
+        if self.url().scheme() not in ('http', 'https', 'file'):
+            return
+        title = self.page().title()
+        visited_at = time.time()
+        # toPlainText is asynchronous; the text is handed straight to the indexer thread
+        self.page().toPlainText(lambda text: self.main_window.page_text_index.add(url, title, text, visited_at))
+
+    def capture_thumbnail(self):
+        # Hidden and discarded views have nothing painted to grab
+        if self.prerendering or self.discarded or not self.isVisible():
+            return
+        if self.url().scheme() not in ('http', 'https', 'file'):
+            return
+        now = time.monotonic()
+        if now - self.thumbnail_taken < ThumbnailCache.MIN_INTERVAL:
+            return
+        # Only the top of the page, in the thumbnail's aspect ratio, is grabbed
+        width = self.width()
+        height = min(self.height(), width * ThumbnailCache.HEIGHT // ThumbnailCache.WIDTH)
+        image = self.grab(QRect(0, 0, width, height)).toImage()
+        if not image.isNull():
+            self.thumbnail_taken = now
+            self.main_window.thumbnail_cache.add(self.url().toString(), image)
+
+    def measure_cache_hits(self):
+        # Resource Timing reports transferSize 0 for responses served from the HTTP
+        # cache. Cross-origin entries without Timing-Allow-Origin report no sizes at
+        # all and are left out, so this is a sample rather than an exact count.
+        js_code = """
+        (function() {
+            var entries = performance.getEntriesByType('navigation').concat(performance.getEntriesByType('resource'));
+            var hits = 0;
+            var total = 0;
+            entries.forEach(function(entry) {
+                if (entry.decodedBodySize > 0) {
+                    total++;
+                    if (entry.transferSize === 0) {
+                        hits++;
+                    }
+                }
+            });
+            return [hits, total];
+        })();
+        """
+        self.page().runJavaScript(js_code, self.main_window.record_cache_hits)
+
     def add_to_history(self, _):
+        if self.prerendering:
+            return
         try:
             if self.initial_load:
                 self.initial_load = False
                 return
             url = self.url().toString()
             title = self.page().title()
-            if url and not url.startswith("about:") and title:
-                if self.main_window.history is None:
-                    self.main_window.history = []
-                self.main_window.history.append((title, url))
-                self.main_window.save_history()
+            if url and not url.startswith(("about:", "pybrowser:")) and title:
+                self.main_window.append_history(title, url)
         except Exception as e:
             print(f"Error in add_to_history: {e}")
 
-    def navigate_to(self, url: str):
+    @staticmethod
+    def url_from_input(url: str) -> QUrl:
         if not url.startswith(('http://', 'https://')):
             url = 'http://' + url
-        self.setUrl(QUrl(url))
+        return QUrl(url)
+
+    def navigate_to(self, url: str):
+        self.setUrl(self.url_from_input(url))
 
     def on_download_requested(self, download: QWebEngineDownloadItem):
         options = QFileDialog.Options()
@@ -395,17 +3533,20 @@ class BrowserWindow(QWebEngineView):
         if path:
             download.setPath(path)
             download.accept()
-            self.main_window.download_manager_dialog.add_download(download)  # Add download to the manager
-            download_dialog = DownloadDialog(suggested_filename, path, self.main_window, self)
-            download_dialog.show()
-            download.downloadProgress.connect(download_dialog.update_progress)
-            download.finished.connect(lambda: self.download_complete(download_dialog, download))
-
-    def download_complete(self, download_dialog, download):
-        if download.state() == QWebEngineDownloadItem.DownloadCancelled:
-            download_dialog.download_canceled()
-        else:
-            download_dialog.download_complete()
+            if self.main_window.settings.get('segmented_downloads', False) and self.can_refetch(download):
+                # Held until a range probe shows our own engine can fetch it in parallel
+                download.pause()
+                self.main_window.probe_download(download, path)
+            else:
+                # Queued and started by the download manager's scheduler
+                self.main_window.download_manager().add_download(download)
+
+    def can_refetch(self, download: QWebEngineDownloadItem) -> bool:
+        # Only plain GETs can be requested again: a form may have POSTed, and saved
+        # pages and blob:/data: URLs exist only inside the browser
+        if download.url().scheme() not in ('http', 'https') or download.isSavePageDownload():
+            return False
+        return download.url() != self.page().form_submission_url
 
     def handle_fullscreen_requested(self, request):
         if request.toggleOn():
@@ -423,17 +3564,187 @@ class BrowserWindow(QWebEngineView):
         context_menu.addAction("Close Tab", lambda: self.main_window.close_tab(self.main_window.tab_widget.currentIndex()))
         context_menu.exec_(self.mapToGlobal(event.pos()))
 
-    def inject_dark_mode_status(self):
-        is_dark_mode = self.main_window.settings.get('theme', 'Light') == 'Dark'
-        js_code = f"""
-        (function() {{
-            var isDarkMode = {str(is_dark_mode).lower()};
-            document.documentElement.style.setProperty('--is-dark-mode', isDarkMode);
-            var event = new CustomEvent('darkModeChanged', {{ detail: {{ isDarkMode: isDarkMode }} }});
-            document.dispatchEvent(event);
-        }})();
-        """
-        self.page().runJavaScript(js_code)
+    def save_navigation_state(self) -> str:
+        data = QByteArray()
+        stream = QDataStream(data, QIODevice.WriteOnly)
+        stream << self.page().history()
+        return bytes(data.toBase64()).decode('ascii')
+
+    def restore_navigation_state(self, encoded: str):
+        # Restoring the back/forward list also navigates to its current entry
+        data = QByteArray.fromBase64(encoded.encode('ascii'))
+        stream = QDataStream(data, QIODevice.ReadOnly)
+        stream >> self.page().history()
+
+class NavigationPredictor(QObject):
+    # Warms up likely navigations before they are committed. A strong URL-bar
+    # match or a hovered link gets a preconnect (and DNS prefetch) issued from a
+    # hidden page; optionally the top URL-bar match is also prerendered in a hidden
+    # view that replaces a fresh tab when the user navigates to it. Hits, misses and
+    # load times are counted so the effect can be checked in Settings.
+    PREDICTION_TTL = 30  # Seconds a prediction can still count as a hit
+    PRECONNECT_INTERVAL = 10  # Chromium keeps idle sockets around for roughly this long
+    HOVER_DELAY_MS = 150
+
+    def __init__(self, main_window):
+        super().__init__(main_window)
+        self.main_window = main_window
+        self.warmup_page = None
+        self.predictions = {}  # origin -> time predicted
+        self.preconnected = {}  # origin -> time of the last preconnect
+        self.prerender_view = None
+        self.prerender_url = None
+        self.stats = {'predictions': 0, 'hits': 0, 'misses': 0, 'prerender_hits': 0}
+        self.load_times = {'predicted': [0.0, 0], 'unpredicted': [0.0, 0]}  # [total ms, count]
+        self.hovered_url = None
+        self.hover_timer = QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(self.HOVER_DELAY_MS)
+        self.hover_timer.timeout.connect(lambda: self.preconnect(QUrl(self.hovered_url)))
+
+    def enabled(self) -> bool:
+        return self.main_window.settings.get('predict_navigation', True)
+
+    @staticmethod
+    def origin(url: QUrl):
+        if url.scheme() not in ('http', 'https') or not url.host():
+            return None
+        return url.adjusted(QUrl.RemovePath | QUrl.RemoveQuery | QUrl.RemoveFragment | QUrl.RemoveUserInfo).toString()
+
+    @staticmethod
+    def same_page(first: QUrl, second: QUrl) -> bool:
+        options = QUrl.StripTrailingSlash | QUrl.NormalizePathSegments | QUrl.RemoveFragment
+        return first.adjusted(options) == second.adjusted(options)
+
+    def current_origin(self):
+        browser = self.main_window.tab_widget.currentWidget()
+        return self.origin(browser.url()) if isinstance(browser, BrowserWindow) else None
+
+    def on_link_hovered(self, url: str):
+        # Only links the pointer rests on for a moment are worth a connection
+        self.hovered_url = url
+        if url:
+            self.hover_timer.start()
+        else:
+            self.hover_timer.stop()
+
+    def predict(self, url: QUrl):
+        # A high-confidence URL-bar match: preconnect, and prerender if enabled
+        self.preconnect(url)
+        if self.enabled() and self.main_window.settings.get('prerender', False):
+            self.prerender(url)
+
+    def preconnect(self, url: QUrl):
+        origin = self.origin(url)
+        # The current page's origin is already connected, so predicting it gains nothing
+        if not self.enabled() or origin is None or origin == self.current_origin():
+            return
+        now = time.monotonic()
+        self.expire(now)
+        if origin not in self.predictions:
+            self.stats['predictions'] += 1
+        self.predictions[origin] = now
+        if now - self.preconnected.get(origin, -self.PRECONNECT_INTERVAL) < self.PRECONNECT_INTERVAL:
+            return
+        self.preconnected[origin] = now
+        if self.warmup_page is None:
+            self.warmup_page = QWebEnginePage(self.main_window.web_profile, self)
+        href = html.escape(origin, quote=True)
+        self.warmup_page.setHtml(f'<link rel="dns-prefetch" href="{href}"><link rel="preconnect" href="{href}">',
+                                 QUrl("about:blank"))
+
+    def prerender(self, url: QUrl):
+        if self.prerender_url is not None and self.same_page(url, self.prerender_url):
+            return
+        self.cancel_prerender()
+        view = BrowserWindow(self.main_window, prerendering=True)
+        view.setUrl(url)
+        self.prerender_view = view
+        self.prerender_url = url
+
+    def cancel_prerender(self):
+        if self.prerender_view is not None:
+            self.prerender_view.deleteLater()
+        self.prerender_view = None
+        self.prerender_url = None
+
+    def take_prerender(self, url: QUrl):
+        if self.prerender_view is None or not self.same_page(url, self.prerender_url):
+            return None
+        view = self.prerender_view
+        self.prerender_view = None
+        self.prerender_url = None
+        return view
+
+    def on_prerender_adopted(self, view, url: QUrl, started_at: float):
+        # The view's navigation happened while it was hidden, so on_navigation never
+        # saw it; its load time runs from when the user navigated
+        self.expire(time.monotonic())
+        self.predictions.pop(self.origin(url), None)
+        self.stats['hits'] += 1
+        self.stats['prerender_hits'] += 1
+        view.navigation_timing = (started_at, 'predicted')
+
+    def expire(self, now: float):
+        for origin, predicted_at in list(self.predictions.items()):
+            if now - predicted_at > self.PREDICTION_TTL:
+                del self.predictions[origin]
+                self.stats['misses'] += 1
+
+    def on_navigation(self, browser, url: QUrl):
+        self.expire(time.monotonic())
+        origin = self.origin(url)
+        # Staying on the page's own origin is never a hit; its connection was already open
+        predicted = origin != self.origin(browser.url()) and self.predictions.pop(origin, None) is not None
+        if predicted:
+            self.stats['hits'] += 1
+        browser.navigation_timing = (time.perf_counter(), 'predicted' if predicted else 'unpredicted')
+
+    def on_load_finished(self, browser, success: bool):
+        if browser.navigation_timing is None:
+            return
+        started_at, kind = browser.navigation_timing
+        browser.navigation_timing = None
+        if success:
+            self.load_times[kind][0] += (time.perf_counter() - started_at) * 1000
+            self.load_times[kind][1] += 1
+
+    def summary(self) -> str:
+        self.expire(time.monotonic())
+        lines = [f"Predictions: {self.stats['predictions']}",
+                 f"Hits: {self.stats['hits']} (of which prerendered: {self.stats['prerender_hits']})",
+                 f"Misses: {self.stats['misses']} (pending: {len(self.predictions)})"]
+        for kind, (total, count) in self.load_times.items():
+            average = f"{total / count:.0f} ms over {count} loads" if count else "no data yet"
+            lines.append(f"Average load time, {kind}: {average}")
+        return "\n".join(lines)
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class TabPlaceholder(QWidget):
+    # Stand-in for a restored tab that hasn't been looked at yet; MainWindow swaps it
+    # for a real BrowserWindow the first time it is activated.
+    def __init__(self, url: str, title: str, history_data: str = None):
+        super().__init__()
+        self.url = url
+        self.title = title
+        self.history_data = history_data
+        layout = QVBoxLayout()
+        label = QLabel(f"Loading {title or url}...")
+        label.setAlignment(Qt.AlignCenter)
+        layout.addWidget(label)
+        self.setLayout(layout)
+
+    def session_entry(self) -> dict:
+        return {'url': self.url, 'title': self.title, 'history': self.history_data}
 
 class SettingsWindow(QDialog):
     def __init__(self, parent=None):
@@ -448,7 +3759,8 @@ class SettingsWindow(QDialog):
 
         self.theme_label = QLabel("Select Theme:")
         self.theme_combo = QComboBox()
-        self.theme_combo.addItems(["Light", "Dark"])
+        self.main_window.theme_engine.discover()
+        self.theme_combo.addItems(self.main_window.theme_engine.theme_names())
         self.theme_combo.setCurrentText(self.main_window.settings.get('theme', 'Light'))
         self.theme_combo.currentIndexChanged.connect(self.change_theme)
 
@@ -474,9 +3786,93 @@ class SettingsWindow(QDialog):
         self.default_zoom_spin.setRange(25, 500)
         self.default_zoom_spin.setValue(self.main_window.settings.get('default_zoom', 100))
 
+        self.freeze_after_label = QLabel("Freeze Background Tabs After (minutes):")
+        self.freeze_after_spin = QSpinBox()
+        self.freeze_after_spin.setRange(1, 240)
+        self.freeze_after_spin.setValue(self.main_window.settings.get('freeze_after_minutes', 5))
+
+        self.memory_budget_label = QLabel("Tab Memory Budget (MB):")
+        self.memory_budget_spin = QSpinBox()
+        self.memory_budget_spin.setRange(256, 65536)
+        self.memory_budget_spin.setSingleStep(256)
+        self.memory_budget_spin.setValue(self.main_window.settings.get('tab_memory_budget_mb', 2048))
+
+        self.page_text_index_label = QLabel("Page Text Search Index Size (MB):")
+        self.page_text_index_spin = QSpinBox()
+        self.page_text_index_spin.setRange(10, 10240)
+        self.page_text_index_spin.setValue(self.main_window.settings.get('page_text_index_mb', 200))
+
+        self.thumbnail_cache_label = QLabel("Tab Thumbnail Cache Size (MB):")
+        self.thumbnail_cache_spin = QSpinBox()
+        self.thumbnail_cache_spin.setRange(5, 2048)
+        self.thumbnail_cache_spin.setValue(self.main_window.settings.get('thumbnail_cache_mb', 50))
+
+        self.history_retention_label = QLabel("Keep History For (days, 0 = forever):")
+        self.history_retention_spin = QSpinBox()
+        self.history_retention_spin.setRange(0, 3650)
+        self.history_retention_spin.setValue(self.main_window.settings.get('history_retention_days',
+                                                                           HISTORY_RETENTION_DAYS))
+
+        self.history_max_visits_label = QLabel("Maximum History Visits:")
+        self.history_max_visits_spin = QSpinBox()
+        self.history_max_visits_spin.setRange(1000, 10000000)
+        self.history_max_visits_spin.setSingleStep(10000)
+        self.history_max_visits_spin.setValue(self.main_window.settings.get('history_max_visits', HISTORY_MAX_VISITS))
+
+        self.content_blocking_check = QCheckBox("Block Ads and Trackers")
+        self.content_blocking_check.setChecked(self.main_window.settings.get('content_blocking', True))
+
+        self.segmented_downloads_check = QCheckBox("Parallel Downloads (resumable after restart)")
+        self.segmented_downloads_check.setChecked(self.main_window.settings.get('segmented_downloads', False))
+
+        self.max_downloads_label = QLabel("Maximum Simultaneous Downloads:")
+        self.max_downloads_spin = QSpinBox()
+        self.max_downloads_spin.setRange(1, 20)
+        self.max_downloads_spin.setValue(self.main_window.settings.get('max_concurrent_downloads', 3))
+
+        self.download_limit_label = QLabel("Total Download Speed Limit (KB/s, 0 = unlimited):")
+        self.download_limit_spin = QSpinBox()
+        self.download_limit_spin.setRange(0, 1000000)
+        self.download_limit_spin.setValue(self.main_window.settings.get('download_limit_kbps', 0))
+
+        self.per_download_limit_label = QLabel("Per-Download Speed Limit (KB/s, 0 = unlimited):")
+        self.per_download_limit_spin = QSpinBox()
+        self.per_download_limit_spin.setRange(0, 1000000)
+        self.per_download_limit_spin.setValue(self.main_window.settings.get('per_download_limit_kbps', 0))
+
+        self.cache_type_label = QLabel("HTTP Cache Type:")
+        self.cache_type_combo = QComboBox()
+        self.cache_type_combo.addItems(["Disk", "Memory"])
+        self.cache_type_combo.setCurrentText(self.main_window.settings.get('cache_type', 'Disk'))
+
+        self.cache_size_label = QLabel("HTTP Cache Size (MB, 0 = automatic):")
+        self.cache_size_spin = QSpinBox()
+        self.cache_size_spin.setRange(0, 65536)
+        self.cache_size_spin.setValue(self.main_window.settings.get('cache_size_mb', 0))
+
+        self.cache_path_label = QLabel("HTTP Cache Location:")
+        self.cache_path_edit = QLineEdit()
+        self.cache_path_edit.setText(self.main_window.settings.get('cache_path', ''))
+        self.cache_path_edit.setPlaceholderText(self.main_window.default_cache_path())
+        self.cache_path_button = QPushButton("Browse...")
+        self.cache_path_button.clicked.connect(self.browse_cache_path)
+
+        self.cache_stats_button = QPushButton("Cache Statistics")
+        self.cache_stats_button.clicked.connect(self.show_cache_stats)
+
+        self.predict_navigation_check = QCheckBox("Preconnect to Pages You Are Likely to Open")
+        self.predict_navigation_check.setChecked(self.main_window.settings.get('predict_navigation', True))
+        self.prerender_check = QCheckBox("Prerender the Top Address Bar Match")
+        self.prerender_check.setChecked(self.main_window.settings.get('prerender', False))
+        self.prediction_stats_button = QPushButton("Prediction Statistics")
+        self.prediction_stats_button.clicked.connect(self.show_prediction_stats)
+
         self.privacy_button = QPushButton("Clear Browsing History")
         self.privacy_button.clicked.connect(self.clear_history)
 
+        self.import_button = QPushButton("Import History and Bookmarks...")
+        self.import_button.clicked.connect(self.import_history)
+
         self.save_button = QPushButton("Save Settings")
         self.save_button.clicked.connect(self.save_settings)
 
@@ -499,11 +3895,43 @@ class SettingsWindow(QDialog):
         layout.addWidget(self.download_dir_label)
         layout.addWidget(self.download_dir_edit)
         layout.addWidget(self.download_dir_button)
+        layout.addWidget(self.segmented_downloads_check)
+        layout.addWidget(self.max_downloads_label)
+        layout.addWidget(self.max_downloads_spin)
+        layout.addWidget(self.download_limit_label)
+        layout.addWidget(self.download_limit_spin)
+        layout.addWidget(self.per_download_limit_label)
+        layout.addWidget(self.per_download_limit_spin)
         layout.addWidget(self.font_size_label)
         layout.addWidget(self.font_size_spin)
         layout.addWidget(self.default_zoom_label)
         layout.addWidget(self.default_zoom_spin)
+        layout.addWidget(self.freeze_after_label)
+        layout.addWidget(self.freeze_after_spin)
+        layout.addWidget(self.memory_budget_label)
+        layout.addWidget(self.memory_budget_spin)
+        layout.addWidget(self.page_text_index_label)
+        layout.addWidget(self.page_text_index_spin)
+        layout.addWidget(self.thumbnail_cache_label)
+        layout.addWidget(self.thumbnail_cache_spin)
+        layout.addWidget(self.history_retention_label)
+        layout.addWidget(self.history_retention_spin)
+        layout.addWidget(self.history_max_visits_label)
+        layout.addWidget(self.history_max_visits_spin)
+        layout.addWidget(self.content_blocking_check)
+        layout.addWidget(self.cache_type_label)
+        layout.addWidget(self.cache_type_combo)
+        layout.addWidget(self.cache_size_label)
+        layout.addWidget(self.cache_size_spin)
+        layout.addWidget(self.cache_path_label)
+        layout.addWidget(self.cache_path_edit)
+        layout.addWidget(self.cache_path_button)
+        layout.addWidget(self.cache_stats_button)
+        layout.addWidget(self.predict_navigation_check)
+        layout.addWidget(self.prerender_check)
+        layout.addWidget(self.prediction_stats_button)
         layout.addWidget(self.privacy_button)
+        layout.addWidget(self.import_button)
         layout.addWidget(self.save_button)
         layout.addWidget(self.shutdown_button)
         layout.addWidget(self.restart_button)
@@ -517,24 +3945,72 @@ class SettingsWindow(QDialog):
         if directory:
             self.download_dir_edit.setText(directory)
 
+    def browse_cache_path(self):
+        directory = QFileDialog.getExistingDirectory(self, "Select Cache Location")
+        if directory:
+            self.cache_path_edit.setText(directory)
+
+    def show_cache_stats(self):
+        profile = self.main_window.web_profile
+        size = directory_size(profile.cachePath()) if profile.httpCacheType() == QWebEngineProfile.DiskHttpCache else 0
+        hits, requests = self.main_window.cache_stats['hits'], self.main_window.cache_stats['requests']
+        hit_rate = f"{hits / requests:.0%} ({hits} of {requests} measured responses)" if requests else "no data yet"
+        QMessageBox.information(self, "Cache Statistics",
+                                f"Cache location: {profile.cachePath()}\n"
+                                f"Cache size on disk: {size / (1024 * 1024):.1f} MB\n"
+                                f"Hit rate this session: {hit_rate}")
+
+    def show_prediction_stats(self):
+        QMessageBox.information(self, "Prediction Statistics", self.main_window.predictor.summary())
+
     def change_theme(self, index: int):
         theme = self.theme_combo.currentText()
         self.main_window.change_theme(theme)
 
+    def import_history(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Import History and Bookmarks", os.path.expanduser("~"),
+                                              "Browser History (History places.sqlite *.html *.htm);;All Files (*)")
+        if path:
+            self.main_window.import_history(path)
+
     def clear_history(self):
-        self.main_window.history = []
-        self.main_window.save_history()
+        self.main_window.clear_history()
+        self.main_window.page_text_index.clear()
+        self.main_window.thumbnail_cache.clear()
         QMessageBox.information(self, "History Cleared", "Your browsing history has been cleared.")
 
     def save_settings(self):
         self.main_window.settings['theme'] = self.theme_combo.currentText()
         self.main_window.settings['homepage_url'] = self.homepage_edit.text()
         self.main_window.settings['download_dir'] = self.download_dir_edit.text()
+        self.main_window.settings['segmented_downloads'] = self.segmented_downloads_check.isChecked()
+        self.main_window.settings['max_concurrent_downloads'] = self.max_downloads_spin.value()
+        self.main_window.settings['download_limit_kbps'] = self.download_limit_spin.value()
+        self.main_window.settings['per_download_limit_kbps'] = self.per_download_limit_spin.value()
+        if self.main_window.download_manager_dialog is not None:
+            self.main_window.download_manager_dialog.scheduler.apply_settings()
         self.main_window.settings['font_size'] = self.font_size_spin.value()
         self.main_window.settings['default_zoom'] = self.default_zoom_spin.value()
+        self.main_window.settings['freeze_after_minutes'] = self.freeze_after_spin.value()
+        self.main_window.settings['tab_memory_budget_mb'] = self.memory_budget_spin.value()
+        self.main_window.settings['page_text_index_mb'] = self.page_text_index_spin.value()
+        self.main_window.page_text_index.max_bytes = self.page_text_index_spin.value() * 1024 * 1024
+        self.main_window.settings['thumbnail_cache_mb'] = self.thumbnail_cache_spin.value()
+        self.main_window.thumbnail_cache.max_bytes = self.thumbnail_cache_spin.value() * 1024 * 1024
+        self.main_window.settings['history_retention_days'] = self.history_retention_spin.value()
+        self.main_window.settings['history_max_visits'] = self.history_max_visits_spin.value()
+        self.main_window.apply_history_retention()
+        self.main_window.settings['content_blocking'] = self.content_blocking_check.isChecked()
+        self.main_window.settings['predict_navigation'] = self.predict_navigation_check.isChecked()
+        self.main_window.settings['prerender'] = self.prerender_check.isChecked()
+        if not self.prerender_check.isChecked():
+            self.main_window.predictor.cancel_prerender()
+        self.main_window.settings['cache_type'] = self.cache_type_combo.currentText()
+        self.main_window.settings['cache_size_mb'] = self.cache_size_spin.value()
+        self.main_window.settings['cache_path'] = self.cache_path_edit.text()
+        self.main_window.apply_cache_settings()
         self.main_window.save_settings()
         self.main_window.apply_settings_immediately()
-        self.main_window.update_startup_page()
         QMessageBox.information(self, "Settings Saved", "Your settings have been saved successfully.")
 
     def confirm_shutdown(self):
@@ -561,30 +4037,49 @@ class SettingsWindow(QDialog):
             self.clear_everything()
 
     def clear_everything(self):
-        self.main_window.settings = {}
-        self.main_window.history = []
-        self.main_window.profiles = []
-        self.main_window.save_settings()
-        self.main_window.save_history()
-        self.main_window.save_profiles()
-
-        # Delete all user-specific settings and history files
-        for file in os.listdir():
-            if file.endswith("_settings.json") or file.endswith("_history.json"):
-                os.remove(file)
-                
-        profile = QWebEngineProfile.defaultProfile()
+        main_window = self.main_window
+        profile_names = [f"{profile['first_name']}_{profile['last_name']}" for profile in main_window.profiles]
+        profile = main_window.web_profile
         profile.clearHttpCache()
         profile.clearAllVisitedLinks()
         profile.cookieStore().deleteAllCookies()
+
+        # Nothing may still have files open in the profile directories when they are
+        # deleted: stop everything that writes there, then the writer thread itself.
+        # The closed store drops whatever is saved on the way out.
+        main_window.session_timer.stop()
+        if main_window.history_importer is not None:
+            main_window.history_importer.cancel()
+        if main_window.download_manager_dialog is not None:
+            main_window.download_manager_dialog.shutdown()
+        main_window.profile_store.close()
+        main_window.page_text_index.close()
+        main_window.thumbnail_cache.close()
+        main_window.persistence.close()
+
+        # All profile data is in one directory; profiles never opened since it was
+        # introduced may still have their old files in the working directory
+        shutil.rmtree(PROFILES_DIR, ignore_errors=True)
+        for profile_name in profile_names:
+            for path in legacy_profile_paths(profile_name):
+                for candidate in (path, path + ".migrated"):
+                    if os.path.isdir(candidate):
+                        shutil.rmtree(candidate, ignore_errors=True)
+                    elif os.path.exists(candidate):
+                        os.remove(candidate)
+
+        # A new writer for what is saved from here on, starting with the empty profile list
+        main_window.persistence = PersistenceService()
+        main_window.settings = {}
+        main_window.profiles = []
+        main_window.save_profiles()
         QApplication.quit()
 
     def shutdown(self):
         QApplication.quit()
 
     def restart(self):
-        QApplication.quit()
-        QProcess.startDetached(sys.executable, sys.argv)
+        self.main_window.restart()
 
 class ProfileDialog(QDialog):
     def __init__(self, parent=None):
@@ -660,43 +4155,129 @@ class ProfileSelectionDialog(QDialog):
             self.profile_combo.setCurrentIndex(self.profile_combo.count() - 1)
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    omnibox_index_ready = pyqtSignal(object, int)
+    history_purged = pyqtSignal(object, list)  # profile store, URLs retention removed
+    download_probed = pyqtSignal(object, str, bool)
+    content_filter_ready = pyqtSignal(object)
+
+    def __init__(self, startup_trace: StartupTrace = None, profile: dict = None):
         super().__init__()
+        self.startup_trace = startup_trace or StartupTrace()
         self.config_path = "settings.json"
         self.history_path = "browser_history.json"
         self.profile_path = "user_profiles.json"
+        # Every profile file is written by this service's thread, never the GUI thread
+        self.persistence = PersistenceService()
+        QApplication.instance().aboutToQuit.connect(self.shutdown)
         self.settings = {}
-        self.history = []
-        self.profiles = self.load_profiles()
-        self.profile = None
-        self.download_manager_dialog = DownloadManagerDialog(self)  # Initialize download manager
-
-        if not self.profiles:
-            if not self.prompt_for_profile():
-                sys.exit()
-        else:
-            if not self.select_profile():
-                sys.exit()
+        # Bumped on every settings change; caches derived from settings key on it
+        self.settings_version = 0
+        self.history_loaded = False
+        self.history_importer = None
+        self.profile_store = None
+        self.omnibox_index = OmniboxIndex()
+        self.omnibox_building = None
+        self.omnibox_index_ready.connect(self.on_omnibox_index_ready)
+        self.omnibox_purged = []  # URLs to take out of the index being built
+        self.history_purged.connect(self.on_history_purged)
+        self.probing_downloads = set()
+        self.download_probed.connect(self.on_download_probed)
+        with self.startup_trace.phase('load_profiles'):
+            self.profiles = self.load_profiles()
+        # A profile passed in (e.g. by benchmark.py) skips the profile dialogs
+        self.profile = profile
+        self.download_manager_dialog = None  # Created after the window is shown
+        self.task_manager_dialog = None
+        self.tab_switcher_dialog = None
+        self.scheme_handler = InternalSchemeHandler(self)
+        self.web_profile = None
+        self.cache_stats = {'hits': 0, 'requests': 0}
+        self.cookies = CookieMirror()
+        self.js_api = JavaScriptAPI(self)
+        self.theme_engine = ThemeEngine(THEMES_DIR, self)
+        self.theme_engine.theme_applied.connect(self.update_dark_mode)
+        self.content_filter = None  # Compiled on a worker thread after startup
+        self.content_filter_ready.connect(self.on_content_filter_ready)
+        self.startup_finished = False
+
+        with self.startup_trace.phase('profile_dialog (interactive)'):
+            if self.profile is not None:
+                pass
+            elif not self.profiles:
+                if not self.prompt_for_profile():
+                    sys.exit()
+            else:
+                if not self.select_profile():
+                    sys.exit()
         if self.profile:
-            self.load_user_data()
+            with self.startup_trace.phase('load_user_data'):
+                self.load_user_data()
         self.setWindowTitle(f'PyBrowser {CURRENT_VERSION} - {self.profile["first_name"]} {self.profile["last_name"]}')
         self.setWindowIcon(QIcon("icon.png"))
-        self.setup_ui()
-        self.restore_window_settings()
-        self.apply_settings()
-        self.download_manager_dialog.show()  # Show the download manager if necessary
+        with self.startup_trace.phase('setup_ui'):
+            self.setup_ui()
+        with self.startup_trace.phase('apply_settings'):
+            self.restore_window_settings()
+            self.apply_settings()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not self.startup_finished:
+            self.startup_finished = True
+            self.startup_trace.mark('window_shown')
+            # Runs on the first event loop iteration, after the window has painted
+            QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        self.startup_trace.mark('first_paint')
+        with self.startup_trace.phase('deferred: load_history'):
+            self.load_history_data()
+        with self.startup_trace.phase('deferred: download_manager'):
+            self.download_manager().show()  # Show the download manager if necessary
+        self.load_content_filter()
+        self.web_profile.cookieStore().loadAllCookies()
+        self.startup_trace.mark('startup_complete')
+        self.startup_trace.report()
+
+    def download_manager(self) -> DownloadManagerDialog:
+        if self.download_manager_dialog is None:
+            self.download_manager_dialog = DownloadManagerDialog(self)  # Initialize download manager
+        return self.download_manager_dialog
 
     def setup_ui(self):
         self.tab_widget = QTabWidget()
         self.tab_widget.setTabsClosable(True)
         self.tab_widget.setMovable(True)
         self.tab_widget.tabCloseRequested.connect(self.close_tab)
+        self.tab_widget.tabBar().tabMoved.connect(self.mark_session_dirty)
+        # Emitted on mouse press, before the tab being left is hidden
+        self.tab_widget.tabBar().tabBarClicked.connect(self.capture_current_thumbnail)
+        self.tab_lifecycle = TabLifecycleManager(self)
+        self.predictor = NavigationPredictor(self)
+        self.tab_widget.currentChanged.connect(self.on_current_tab_changed)
         self.setCentralWidget(self.tab_widget)
-        self.add_tab()  # Open the new tab page by default
+
+        # Session changes are saved shortly after they happen so a crash loses little
+        self.session_timer = QTimer(self)
+        self.session_timer.setSingleShot(True)
+        self.session_timer.setInterval(2000)
+        self.session_timer.timeout.connect(self.save_session)
 
         self.url_bar = QLineEdit()
         self.url_bar.setPlaceholderText("Enter URL and press Enter")
         self.url_bar.returnPressed.connect(self.navigate)
+        self.url_bar.textEdited.connect(self.update_suggestions)
+        self.last_typed_url = ''
+        self.pending_suggestion = None
+
+        # Dropdown suggestions; the model is refilled from OmniboxIndex on every keystroke
+        self.suggestion_model = QStandardItemModel(self)
+        self.url_completer = QCompleter(self.suggestion_model, self)
+        self.url_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.url_completer.setCompletionRole(Qt.UserRole)
+        self.url_completer.setMaxVisibleItems(8)
+        self.url_completer.activated[str].connect(self.on_suggestion_activated)
+        self.url_bar.setCompleter(self.url_completer)
         self.url_bar.setMinimumHeight(32)
 
         button_size = QSize(80, 32)
@@ -728,10 +4309,14 @@ class MainWindow(QMainWindow):
         self.reload_button.clicked.connect(self.reload_page)
         self.add_tab_button.clicked.connect(self.add_tab)
 
+        self.download_indicator = DownloadIndicator(self)
+
         self.menu = QMenu()
         self.menu.addAction('Settings', self.show_settings)
         self.menu.addAction('History', self.show_history)
+        self.menu.addAction('Tab Overview', self.show_tab_switcher)
         self.menu.addAction('Download Manager', self.show_download_manager)
+        self.menu.addAction('Task Manager', self.show_task_manager)
         self.menu.addAction('Switch User', self.switch_user)
         self.menu.addAction('Exit', self.close)
         self.menu_button.setMenu(self.menu)
@@ -743,6 +4328,7 @@ class MainWindow(QMainWindow):
         top_layout.addWidget(self.url_bar, 1)  # Add stretch factor to make it longer
         top_layout.addWidget(self.add_tab_button)
         top_layout.addStretch()  # Add stretch to push menu button to the right
+        top_layout.addWidget(self.download_indicator)
         top_layout.addWidget(self.menu_button)
 
         container_widget = QWidget()
@@ -753,8 +4339,8 @@ class MainWindow(QMainWindow):
         self.settings_window = None
         self.history_browser = None
 
-        # Apply theme on startup
-        self.apply_theme(self.settings.get('theme', 'Light'))
+        if not self.restore_session():
+            self.add_tab()  # Open the new tab page by default
 
         # Add keyboard shortcuts
         self.add_shortcuts()
@@ -805,14 +4391,42 @@ class MainWindow(QMainWindow):
         download_manager_action.triggered.connect(self.show_download_manager)
         self.addAction(download_manager_action)
 
+        task_manager_action = QAction(self)
+        task_manager_action.setShortcut(QKeySequence("Shift+Esc"))
+        task_manager_action.triggered.connect(self.show_task_manager)
+        self.addAction(task_manager_action)
+
+        tab_switcher_action = QAction(self)
+        tab_switcher_action.setShortcut(QKeySequence("Ctrl+Shift+A"))
+        tab_switcher_action.triggered.connect(self.show_tab_switcher)
+        self.addAction(tab_switcher_action)
+
         exit_action = QAction(self)
         exit_action.setShortcut(QKeySequence("Ctrl+Q"))
         exit_action.triggered.connect(self.close)
         self.addAction(exit_action)
 
     def show_download_manager(self):
-        self.download_manager_dialog.show()
-        self.download_manager_dialog.check_no_downloads()
+        self.download_manager().show()
+        self.download_manager().check_no_downloads()
+
+    def show_task_manager(self):
+        if self.task_manager_dialog is None:
+            self.task_manager_dialog = TaskManagerDialog(self)
+        self.task_manager_dialog.show()
+        self.task_manager_dialog.raise_()
+
+    def show_tab_switcher(self):
+        self.capture_current_thumbnail()
+        if self.tab_switcher_dialog is None:
+            self.tab_switcher_dialog = TabSwitcherDialog(self)
+        self.tab_switcher_dialog.show()
+        self.tab_switcher_dialog.raise_()
+
+    def capture_current_thumbnail(self, *_):
+        browser = self.tab_widget.currentWidget()
+        if isinstance(browser, BrowserWindow):
+            browser.capture_thumbnail()
 
     def show_help(self):
         help_text = """
@@ -832,6 +4446,8 @@ class MainWindow(QMainWindow):
             <li><b>Settings:</b> Ctrl + ,</li>
             <li><b>History:</b> Ctrl + H</li>
             <li><b>Download Manager:</b> Ctrl + D</li>
+            <li><b>Task Manager:</b> Shift + Esc</li>
+            <li><b>Tab Overview:</b> Ctrl + Shift + A</li>
             <li><b>Exit:</b> Ctrl + Q</li>
         </ul>
         """
@@ -844,145 +4460,125 @@ class MainWindow(QMainWindow):
         # Apply download directory
         self.download_dir = self.settings.get('download_dir', '')
 
-        # Apply font size
-        font_size = self.settings.get('font_size', 12)
-        self.setStyleSheet(f"* {{ font-size: {font_size}px; }}")
+        # Apply theme and font size as one stylesheet
+        self.theme_engine.apply(self.settings.get('theme', 'Light'), self.settings.get('font_size', 12))
 
         # Apply default zoom level
         self.default_zoom = self.settings.get('default_zoom', 100)
-        for i in range(self.tab_widget.count()):
-            browser = self.tab_widget.widget(i)
+        for browser in self.browsers():
             browser.setZoomFactor(self.default_zoom / 100)
 
     def apply_settings_immediately(self):
-        # Apply font size immediately
-        font_size = self.settings['font_size']
-        self.setStyleSheet(f"* {{ font-size: {font_size}px; }}")
-
         # Apply zoom level immediately
         default_zoom = self.settings['default_zoom']
-        for i in range(self.tab_widget.count()):
-            browser = self.tab_widget.widget(i)
+        for browser in self.browsers():
             browser.setZoomFactor(default_zoom / 100)
 
-        # Apply theme immediately
+        # Apply theme and font size immediately
         theme = self.settings.get('theme', 'Light')
         self.change_theme(theme)
 
     def change_theme(self, theme):
-        if theme == "Dark":
-            apply_dark_theme(QApplication.instance())
-        elif theme == "Light":
-            apply_light_theme(QApplication.instance())
-        # Inject dark mode status for all open tabs
-        for i in range(self.tab_widget.count()):
-            browser = self.tab_widget.widget(i)
-            browser.inject_dark_mode_status()
-
-    def update_startup_page(self):
-        search_engine = self.settings.get('search_engine', 'Google')
-        search_url = {
-            'Google': 'https://www.google.com/search',
-            'Bing': 'https://www.bing.com/search',
-            'DuckDuckGo': 'https://duckduckgo.com/'
-        }.get(search_engine, 'https://www.google.com/search')
-
-        new_tab_html = f"""
-        <html>
-            <head>
-                <style>
-                    body {{
-                        font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                        margin: 0;
-                        padding: 0;
-                        display: flex;
-                        justify-content: center;
-                        align-items: center;
-                        height: 100vh;
-                        background-color: #f0f0f0;
-                        color: #333;
-                    }}
-                    .container {{
-                        text-align: center;
-                    }}
-                    h1 {{
-                        font-size: 48px;
-                        margin-bottom: 20px;
-                    }}
-                    input[type="text"] {{
-                        font-size: 18px;
-                        padding: 10px;
-                        width: 300px;
-                        border: 1px solid #ccc;
-                        border-radius: 5px;
-                    }}
-                    input[type="submit"] {{
-                        font-size: 18px;
-                        padding: 10px 20px;
-                        margin-left: 10px;
-                        border: none;
-                        border-radius: 5px;
-                        background-color: #0078D7;
-                        color: white;
-                        cursor: pointer;
-                    }}
-                    input[type="submit"]:hover {{
-                        background-color: #0056b3;
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1>Welcome to PyBrowser {CURRENT_VERSION}</h1>
-                    <p>Enter a search term below to start browsing:</p>
-                    <form action="{search_url}" method="get">
-                        <input type="text" name="q" placeholder="Search {search_engine}" />
-                        <input type="submit" value="Search" />
-                    </form>
-                </div>
-            </body>
-        </html>
-        """
+        self.theme_engine.apply(theme, self.settings.get('font_size', 12))
 
-        for i in range(self.tab_widget.count()):
-            browser = self.tab_widget.widget(i)
-            if browser.initial_load:
-                browser.setHtml(new_tab_html)
+    def update_dark_mode(self):
+        # New documents get the flag from the profile's script; open pages are told
+        # through the shared JavaScriptAPI's signal
+        if self.web_profile is None:
+            return
+        is_dark_mode = self.theme_engine.is_dark(self.theme_engine.current_theme or self.settings.get('theme', 'Light'))
+        scripts = self.web_profile.scripts()
+        for script in scripts.findScripts(DARK_MODE_SCRIPT_NAME):
+            scripts.remove(script)
+        scripts.insert(dark_mode_script(is_dark_mode))
+        self.js_api.set_dark_mode(is_dark_mode)
 
     def show_settings(self):
         if (self.settings_window is None) or (not self.settings_window.isVisible()):
             self.settings_window = SettingsWindow(self)
             self.settings_window.show()
 
-    def load_settings(self, profile_name) -> dict:
-        try:
-            with open(f"{profile_name}_settings.json", "r") as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
-
     def save_settings(self):
-        with open(f"{self.profile['first_name']}_{self.profile['last_name']}_settings.json", "w") as file:
-            json.dump(self.settings, file)
+        self.settings_version += 1
+        self.profile_store.save_settings(self.settings)
 
-    def apply_theme(self, theme: str):
-        if theme == "Dark":
-            apply_dark_theme(QApplication.instance())
-        elif theme == "Light":
-            apply_light_theme(QApplication.instance())
+    def append_history(self, title: str, url: str):
+        self.load_history_data()
+        visited_at = time.time()
+        self.omnibox_index.record_visit(title, url, visited_at)
+        self.profile_store.add_visit(title, url, visited_at)
 
-    def load_history(self, profile_name) -> list:
-        try:
-            with open(f"{profile_name}_history.json", "r") as file:
-                return json.load(file)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return []
+    def clear_history(self):
+        self.profile_store.clear_history()
+        self.omnibox_index = OmniboxIndex()
+        self.omnibox_building = None
 
-    def save_history(self):
-        with open(f"{self.profile['first_name']}_{self.profile['last_name']}_history.json", "w") as file:
-            json.dump(self.history, file)
+    def import_history(self, path: str):
+        if self.history_importer is not None:
+            QMessageBox.information(self, "Import History", "An import is already running.")
+            return
+        max_age_days = self.settings.get('history_retention_days', HISTORY_RETENTION_DAYS)
+        importer = HistoryImporter(self.profile_store, path, max_age_days,
+                                   self.settings.get('history_max_visits', HISTORY_MAX_VISITS),
+                                   self.profile_store.retained_visit_count(max_age_days), self)
+        progress_dialog = QProgressDialog("Importing history...", "Cancel", 0, 0, self)
+        progress_dialog.setWindowTitle("Import History")
+        progress_dialog.setWindowModality(Qt.NonModal)
+        progress_dialog.setMinimumDuration(0)
+        progress_dialog.setAutoReset(False)
+        progress_dialog.canceled.connect(importer.cancel)
+        importer.progress.connect(lambda done, total: (progress_dialog.setMaximum(total),
+                                                       progress_dialog.setValue(min(done, total))))
+        importer.finished.connect(lambda imported, skipped, error: self.on_history_imported(
+            importer, progress_dialog, imported, skipped, error))
+        self.history_importer = importer
+        importer.start()
+
+    def on_history_imported(self, importer, progress_dialog, imported: int, skipped: int, error: str):
+        progress_dialog.close()
+        progress_dialog.deleteLater()
+        importer.deleteLater()
+        if importer is not self.history_importer:
+            return  # The profile was switched while importing
+        self.history_importer = None
+        if imported and self.history_loaded:
+            self.build_omnibox_index()
+        if error:
+            QMessageBox.warning(self, "Import History", f"Import failed: {error}")
+        else:
+            canceled = " (canceled)" if importer.cancelled.is_set() else ""
+            message = f"Imported {imported} history entries{canceled}."
+            if skipped:
+                message += (f"\n\n{skipped} entries were left out because history is kept for "
+                            f"{importer.max_age_days} days.")
+            if importer.limit_reached:
+                message += (f"\n\nHistory is limited to {importer.max_visits} visits, so the rest of the "
+                            f"source was left out once that was reached.")
+            if skipped or importer.limit_reached:
+                message += " To import more, raise these limits in Settings and import again."
+            QMessageBox.information(self, "Import History", message)
+
+    def purge_page_data(self, store: ProfileStore, urls: list):
+        # Called on the persistence writer thread; these two only queue the work and
+        # the omnibox index is updated on the GUI thread
+        self.page_text_index.remove(urls)
+        self.thumbnail_cache.remove(urls)
+        self.history_purged.emit(store, urls)
+
+    def on_history_purged(self, store: ProfileStore, urls: list):
+        if store is not self.profile_store:
+            return
+        self.omnibox_index.remove(urls)
+        if self.omnibox_building is not None:
+            self.omnibox_purged.extend(urls)
+
+    def apply_history_retention(self):
+        # Compaction runs on the persistence writer thread
+        self.profile_store.apply_history_retention(self.settings.get('history_retention_days', HISTORY_RETENTION_DAYS),
+                                                   self.settings.get('history_max_visits', HISTORY_MAX_VISITS))
 
     def load_profiles(self) -> list:
+        self.persistence.flush(self.profile_path)
         try:
             with open(self.profile_path, "r") as file:
                 return json.load(file)
@@ -990,8 +4586,7 @@ class MainWindow(QMainWindow):
             return []
 
     def save_profiles(self):
-        with open(self.profile_path, "w") as file:
-            json.dump(self.profiles, file)
+        self.persistence.write_json(self.profile_path, self.profiles)
 
     def save_window_settings(self):
         self.settings['window_size'] = (self.size().width(), self.size().height())
@@ -1025,17 +4620,252 @@ class MainWindow(QMainWindow):
 
     def load_user_data(self):
         profile_name = f"{self.profile['first_name']}_{self.profile['last_name']}"
-        self.settings = self.load_settings(profile_name)
-        self.history = self.load_history(profile_name)
+        directory = os.path.join(PROFILES_DIR, profile_name)
+        self.profile_store = ProfileStore(self.persistence, directory, profile_name)
+        self.settings = self.profile_store.load_settings()
+        self.page_text_index = PageTextIndex(os.path.join(directory, "content.db"),
+                                             self.settings.get('page_text_index_mb', 200) * 1024 * 1024)
+        self.thumbnail_cache = ThumbnailCache(os.path.join(directory, "thumbnails"),
+                                              self.settings.get('thumbnail_cache_mb', 50) * 1024 * 1024)
+        store = self.profile_store
+        store.on_history_purged = lambda urls: self.purge_page_data(store, urls)
+        self.web_profile = self.create_web_profile(profile_name)
+
+    def load_history_data(self):
+        # Deferred until after first paint; anything that needs the history calls this first
+        if self.history_loaded:
+            return
+        self.history_loaded = True
+        self.apply_history_retention()
+        self.build_omnibox_index()
+
+    def create_web_profile(self, profile_name: str) -> QWebEngineProfile:
+        # Each PyBrowser user gets their own cookies, storage and HTTP cache
+        web_profile = QWebEngineProfile(profile_name, self)
+        web_profile.setPersistentStoragePath(os.path.abspath(os.path.join(self.profile_store.directory, "web")))
+        web_profile.installUrlSchemeHandler(INTERNAL_SCHEME, self.scheme_handler)
+        web_profile.downloadRequested.connect(self.on_download_requested)
+        web_profile.cookieStore().cookieAdded.connect(self.cookies.add)
+        web_profile.cookieStore().cookieRemoved.connect(self.cookies.remove)
+        self.web_profile = web_profile
+        self.apply_cache_settings()
+        self.update_dark_mode()
+        return web_profile
+
+    def default_cache_path(self) -> str:
+        return os.path.abspath(os.path.join(self.profile_store.directory, "web", "cache"))
+
+    def apply_cache_settings(self):
+        cache_type = QWebEngineProfile.MemoryHttpCache if self.settings.get('cache_type') == 'Memory' \
+            else QWebEngineProfile.DiskHttpCache
+        self.web_profile.setCachePath(self.settings.get('cache_path') or self.default_cache_path())
+        self.web_profile.setHttpCacheType(cache_type)
+        self.web_profile.setHttpCacheMaximumSize(self.settings.get('cache_size_mb', 0) * 1024 * 1024)
+
+    def record_cache_hits(self, result):
+        if result:
+            hits, requests = result
+            self.cache_stats['hits'] += int(hits)
+            self.cache_stats['requests'] += int(requests)
+
+    def on_download_requested(self, download: QWebEngineDownloadItem):
+        # The profile is shared by every tab, so route the download to the tab that started it
+        page = download.page()
+        browser = page.browser if isinstance(page, WebEnginePage) else self.tab_widget.currentWidget()
+        if isinstance(browser, BrowserWindow) and browser.prerendering:
+            download.cancel()
+        elif isinstance(browser, BrowserWindow):
+            browser.on_download_requested(download)
+
+    def probe_download(self, download: QWebEngineDownloadItem, path: str):
+        # Runs off the GUI thread; the download stays paused until the result is back
+        url = download.url().toString()
+        headers = self.download_request_headers(url)
+        self.probing_downloads.add(download)
+
+        def probe():
+            try:
+                supports_ranges, total = SegmentedDownload.probe(url, headers)
+                # Anything smaller would get a single segment, which is no better than QtWebEngine
+                segmented = supports_ranges and total >= 2 * SegmentedDownload.MIN_SEGMENT_SIZE
+            except (OSError, ValueError) as e:
+                print(f"Error probing {url} for range support: {e}")
+                segmented = False
+            self.download_probed.emit(download, path, segmented)
+
+        threading.Thread(target=probe, name="DownloadProbe", daemon=True).start()
+
+    def on_download_probed(self, download: QWebEngineDownloadItem, path: str, segmented: bool):
+        if download not in self.probing_downloads:
+            return  # Canceled by a profile switch
+        self.probing_downloads.discard(download)
+        if segmented:
+            # Fetched by our own engine instead, which can use parallel connections and resume
+            download.cancel()
+            download = SegmentedDownload(download.url().toString(), path, self.download_request_headers,
+                                         parent=self.download_manager())
+        self.download_manager().add_download(download)
+
+    def download_request_headers(self, url: str) -> dict:
+        headers = {'User-Agent': self.web_profile.httpUserAgent()}
+        cookie = self.cookies.header(url)
+        if cookie:
+            headers['Cookie'] = cookie
+        return headers
 
     def switch_user(self):
         self.save_window_settings()
-        self.restart()
+        self.save_session()
+        profile_selection_dialog = ProfileSelectionDialog(self.profiles, self)
+        if profile_selection_dialog.exec_() != QDialog.Accepted:
+            return
+        if profile_selection_dialog.selected_profile == self.profile:
+            self.save_profiles()  # A new user may still have been added
+            return
+        self.switch_profile(profile_selection_dialog.selected_profile)
+
+    def switch_profile(self, profile: dict):
+        # Swaps the per-user state in place; Qt, Chromium and the GPU process stay up
+        start = time.perf_counter()
+        self.unload_user_data()
+        self.profile = profile
+        self.save_profiles()
+        self.load_user_data()
+        self.setWindowTitle(f'PyBrowser {CURRENT_VERSION} - {self.profile["first_name"]} {self.profile["last_name"]}')
+        self.apply_settings()
+        if not self.restore_session():
+            self.add_tab()
+        QTimer.singleShot(0, self.finish_profile_switch)
+        print(f"Switched to {self.profile['first_name']} {self.profile['last_name']} in "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def finish_profile_switch(self):
+        self.load_history_data()
+        self.web_profile.cookieStore().loadAllCookies()
+
+    def unload_user_data(self):
+        self.session_timer.stop()
+        if self.settings_window is not None:
+            self.settings_window.close()
+            self.settings_window = None
+
+        if self.history_importer is not None:
+            self.history_importer.cancel()
+            self.history_importer = None
+        for download in self.probing_downloads:
+            download.cancel()
+        self.probing_downloads.clear()
+
+        # Downloads belong to the profile; the manager is recreated when next needed
+        if self.download_manager_dialog is not None:
+            self.download_manager_dialog.shutdown()
+            self.download_manager_dialog.close()
+            self.download_manager_dialog.deleteLater()
+            self.download_manager_dialog = None
+            self.download_indicator.update_status(0, 0, 0, 0)
+
+        # Everything holding pages of the old web profile goes before the profile itself
+        self.predictor.cancel_prerender()
+        self.predictor.deleteLater()
+        self.predictor = NavigationPredictor(self)
+        self.tab_widget.blockSignals(True)
+        while self.tab_widget.count():
+            widget = self.tab_widget.widget(0)
+            self.tab_widget.removeTab(0)
+            widget.deleteLater()
+        self.tab_widget.blockSignals(False)
+        self.history_browser = None
+        self.web_profile.deleteLater()
+        self.web_profile = None
+
+        self.history_loaded = False
+        self.omnibox_index = OmniboxIndex()
+        self.omnibox_building = None
+        # The store goes first; its last commit may purge expired pages from the other two
+        self.profile_store.close()
+        self.profile_store = None
+        self.page_text_index.close()
+        self.thumbnail_cache.close()
+        self.cookies = CookieMirror()
+        self.cache_stats = {'hits': 0, 'requests': 0}
+        self.settings_version += 1
 
     def restart(self):
+        self.save_session()
+        self.persistence.flush()
         QApplication.quit()
         QProcess.startDetached(sys.executable, sys.argv)
 
+    def mark_session_dirty(self, *_):
+        self.session_timer.start()
+
+    def save_session(self):
+        if self.profile_store is None:
+            return
+        self.session_timer.stop()
+        tabs = []
+        for i in range(self.tab_widget.count()):
+            widget = self.tab_widget.widget(i)
+            if isinstance(widget, TabPlaceholder):
+                tabs.append(widget.session_entry())
+            elif widget.url().scheme() in ('', 'about', 'data') or widget.url() == QUrl(NEW_TAB_URL):
+                tabs.append({'url': '', 'title': 'New Tab', 'history': None})
+            else:
+                tabs.append({'url': widget.url().toString(), 'title': widget.page().title(),
+                             'history': widget.save_navigation_state()})
+        self.profile_store.save_session({'tabs': tabs, 'current': self.tab_widget.currentIndex()})
+
+    def restore_session(self) -> bool:
+        try:
+            session = self.profile_store.load_session()
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Error loading session: {e}")
+            return False
+        if session is None:
+            return False
+        tabs = session.get('tabs', [])
+        if not tabs:
+            return False
+
+        # Every tab starts as a placeholder; only the active one is materialized
+        current = min(max(session.get('current', 0), 0), len(tabs) - 1)
+        self.tab_widget.blockSignals(True)
+        for tab in tabs:
+            placeholder = TabPlaceholder(tab.get('url', ''), tab.get('title', ''), tab.get('history'))
+            index = self.tab_widget.addTab(placeholder, placeholder.title or 'New Tab')
+            self.tab_widget.setTabToolTip(index, placeholder.url)
+        self.tab_widget.setCurrentIndex(current)
+        self.tab_widget.blockSignals(False)
+        self.on_current_tab_changed(current)
+        return True
+
+    def materialize_tab(self, index: int) -> BrowserWindow:
+        placeholder = self.tab_widget.widget(index)
+        browser = BrowserWindow(self)
+        if placeholder.history_data:
+            browser.restore_navigation_state(placeholder.history_data)
+        else:
+            self.load_start_page(browser)
+        self.tab_widget.blockSignals(True)
+        self.tab_widget.removeTab(index)
+        self.tab_widget.insertTab(index, browser, placeholder.title or 'New Tab')
+        self.tab_widget.setCurrentIndex(index)
+        self.tab_widget.blockSignals(False)
+        placeholder.deleteLater()
+        self.connect_tab_signals(browser)
+        self.update_urlbar(browser.url(), browser)
+        return browser
+
+    def browsers(self) -> list:
+        widgets = (self.tab_widget.widget(i) for i in range(self.tab_widget.count()))
+        return [widget for widget in widgets if isinstance(widget, BrowserWindow)]
+
+    def on_current_tab_changed(self, index: int):
+        if isinstance(self.tab_widget.widget(index), TabPlaceholder):
+            self.materialize_tab(index)
+        self.tab_lifecycle.on_tab_activated(index)
+        self.mark_session_dirty()
+
     def navigate_back(self):
         if self.tab_widget.currentWidget():
             self.tab_widget.currentWidget().back()
@@ -1048,92 +4878,165 @@ class MainWindow(QMainWindow):
         if self.tab_widget.currentWidget():
             self.tab_widget.currentWidget().reload()
 
+    def load_content_filter(self):
+        cache_path = os.path.join(self.profile_store.directory, FILTER_CACHE_NAME)
+
+        def load():
+            start = time.perf_counter()
+            try:
+                content_filter = ContentFilter.load(FILTER_LISTS_DIR, cache_path)
+            except (OSError, ValueError) as e:
+                print(f"Error loading filter lists: {e}")
+                return
+            if content_filter is not None:
+                rules = content_filter.block.rule_count() + content_filter.allow.rule_count()
+                print(f"Loaded {rules} content blocking rules in {(time.perf_counter() - start) * 1000:.1f} ms")
+                self.content_filter_ready.emit(content_filter)
+
+        threading.Thread(target=load, name="ContentFilterLoader", daemon=True).start()
+
+    def on_content_filter_ready(self, content_filter: ContentFilter):
+        self.content_filter = content_filter
+
     def navigate(self):
+        started_at = time.perf_counter()
+        self.pending_suggestion = None
         url = self.url_bar.text()
         if url:
-            self.tab_widget.currentWidget().navigate_to(url)
+            browser = self.tab_widget.currentWidget()
+            target = BrowserWindow.url_from_input(url)
+            prerendered = self.predictor.take_prerender(target)
+            # A prerender can only take the place of a fresh tab, since the
+            # current tab's back/forward history can't be carried over
+            if prerendered is not None and browser.page().history().count() <= 1:
+                self.adopt_prerender(browser, prerendered, target, started_at)
+                return
+            if prerendered is not None:
+                prerendered.deleteLater()
+            browser.navigate_to(url)
+
+    def adopt_prerender(self, browser: BrowserWindow, prerendered: BrowserWindow, url: QUrl, started_at: float):
+        index = self.tab_widget.indexOf(browser)
+        prerendered.prerendering = False
+        prerendered.page().setAudioMuted(False)
+        self.predictor.on_prerender_adopted(prerendered, url, started_at)
+        self.tab_widget.insertTab(index, prerendered, prerendered.page().title() or 'New Tab')
+        self.tab_widget.setCurrentIndex(index)
+        self.tab_widget.removeTab(index + 1)
+        browser.deleteLater()
+        self.connect_tab_signals(prerendered)
+        self.update_urlbar(prerendered.url(), prerendered)
+        if prerendered.prerender_loaded:
+            # Already loaded while hidden, so do what loadFinished would have done
+            prerendered.on_load_finished(True)
+            prerendered.add_to_history(True)
+        self.mark_session_dirty()
+
+    def build_omnibox_index(self):
+        # Bulk-building a large history takes a while, so it happens on a worker
+        # thread; visits recorded meanwhile are replayed into the finished index.
+        self.omnibox_index = OmniboxIndex()
+        store = self.profile_store
+        index = OmniboxIndex()
+        self.omnibox_building = index
+        self.omnibox_purged = []
+
+        def build():
+            try:
+                records, newest_visit = store.url_records()
+            except sqlite3.Error as e:
+                print(f"Error loading history: {e}")
+                return
+            index.build(records)
+            self.omnibox_index_ready.emit(index, newest_visit)
+
+        threading.Thread(target=build, name="OmniboxIndexBuilder", daemon=True).start()
+
+    def on_omnibox_index_ready(self, index: OmniboxIndex, newest_visit: int):
+        if index is not self.omnibox_building:
+            return  # History was cleared or the profile switched while the index was being built
+        self.omnibox_building = None
+        # The build may have read URLs that retention removed meanwhile
+        index.remove(self.omnibox_purged)
+        self.omnibox_purged = []
+        for title, url, visited_at in self.profile_store.visits_since(newest_visit) + self.profile_store.pending_visits():
+            index.record_visit(title, url, visited_at)
+        self.omnibox_index = index
+
+    def update_suggestions(self, text: str):
+        suggestions = self.omnibox_index.query(text)
+        self.suggestion_model.clear()
+        for title, url in suggestions:
+            item = QStandardItem(f"{title} - {url}" if title else url)
+            item.setData(url, Qt.UserRole)
+            self.suggestion_model.appendRow(item)
+
+        # Inline-complete the best match, but not while the user is deleting
+        typed_more = len(text) > len(self.last_typed_url)
+        self.last_typed_url = text
+        if suggestions and typed_more and self.url_bar.cursorPosition() == len(text):
+            completion = self.omnibox_index.inline_completion(text, suggestions[0][1])
+            if completion:
+                # What was typed leads straight to the top match, so it is worth warming up
+                self.predictor.predict(QUrl(suggestions[0][1]))
+            if completion and completion != text:
+                self.url_bar.setText(completion)
+                self.url_bar.setSelection(len(text), len(completion) - len(text))
+
+    def on_suggestion_activated(self, url: str):
+        # Enter on a highlighted suggestion also fires returnPressed; deferring lets
+        # navigate() run once and clear this, while mouse clicks still navigate here.
+        self.pending_suggestion = url
+        QTimer.singleShot(0, self.navigate_pending_suggestion)
+
+    def navigate_pending_suggestion(self):
+        if self.pending_suggestion is not None:
+            self.url_bar.setText(self.pending_suggestion)
+            self.navigate()
 
     def add_tab(self, url=None) -> BrowserWindow:
         browser = BrowserWindow(self)
-        homepage_url = self.settings.get('homepage_url', '')
         if url:
             browser.initial_load = False
             browser.setUrl(QUrl(url))
-        elif homepage_url:
-            browser.setUrl(QUrl(homepage_url))
         else:
-            search_engine = self.settings.get('search_engine', 'Google')
-            search_url = {
-                'Google': 'https://www.google.com/search',
-                'Bing': 'https://www.bing.com/search',
-                'DuckDuckGo': 'https://duckduckgo.com/'
-            }.get(search_engine, 'https://www.google.com/search')
-
-            new_tab_html = f"""
-            <html>
-                <head>
-                    <style>
-                        body {{
-                            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                            margin: 0;
-                            padding: 0;
-                            display: flex;
-                            justify-content: center;
-                            align-items: center;
-                            height: 100vh;
-                            background-color: #f0f0f0;
-                            color: #333;
-                        }}
-                        .container {{
-                            text-align: center;
-                        }}
-                        h1 {{
-                            font-size: 48px;
-                            margin-bottom: 20px;
-                        }}
-                        input[type="text"] {{
-                            font-size: 18px;
-                            padding: 10px;
-                            width: 300px;
-                            border: 1px solid #ccc;
-                            border-radius: 5px;
-                        }}
-                        input[type="submit"] {{
-                            font-size: 18px;
-                            padding: 10px 20px;
-                            margin-left: 10px;
-                            border: none;
-                            border-radius: 5px;
-                            background-color: #0078D7;
-                            color: white;
-                            cursor: pointer;
-                        }}
-                        input[type="submit"]:hover {{
-                            background-color: #0056b3;
-                        }}
-                    </style>
-                    <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
-                </head>
-                <body>
-                    <div class="container">
-                        <h1>Welcome to PyBrowser {CURRENT_VERSION}</h1>
-                        <p>Enter a search term below to start browsing:</p>
-                        <form action="{search_url}" method="get">
-                            <input type="text" name="q" placeholder="Search {search_engine}" />
-                            <input type="submit" value="Search" />
-                        </form>
-                    </div>
-                </body>
-            </html>
-            """
-            browser.setHtml(new_tab_html)
+            self.load_start_page(browser)
+        self.capture_current_thumbnail()
         i = self.tab_widget.addTab(browser, 'New Tab')
         self.tab_widget.setCurrentIndex(i)
-        browser.urlChanged.connect(lambda url, browser=browser: self.update_urlbar(url, browser))
-        browser.loadFinished.connect(lambda _, i=i, browser=browser:
-                                     self.tab_widget.setTabText(i, browser.page().title() or 'New Tab'))
+        self.connect_tab_signals(browser)
+        self.mark_session_dirty()
         return browser
 
+    def connect_tab_signals(self, browser: BrowserWindow):
+        browser.urlChanged.connect(lambda url, browser=browser: self.update_urlbar(url, browser))
+        browser.urlChanged.connect(self.mark_session_dirty)
+        browser.loadFinished.connect(lambda _, browser=browser: self.update_tab_title(browser))
+        browser.page().linkHovered.connect(self.predictor.on_link_hovered)
+
+    def update_tab_title(self, browser: BrowserWindow):
+        index = self.tab_widget.indexOf(browser)
+        if index >= 0:
+            self.tab_widget.setTabText(index, browser.page().title() or 'New Tab')
+
+    def update_tab_tooltip(self, browser: BrowserWindow):
+        index = self.tab_widget.indexOf(browser)
+        if index < 0:
+            return
+        notes = []
+        if browser.discarded:
+            notes.append('Discarded to save memory - click to reload')
+        if browser.blocked_requests:
+            notes.append(f'{browser.blocked_requests} ads and trackers blocked')
+        self.tab_widget.setTabToolTip(index, '\n'.join(notes))
+
+    def load_start_page(self, browser: BrowserWindow):
+        homepage_url = self.settings.get('homepage_url', '')
+        if homepage_url:
+            browser.setUrl(QUrl(homepage_url))
+        else:
+            browser.setUrl(QUrl(NEW_TAB_URL))
+
     def close_tab(self, index: int):
         if self.tab_widget.count() < 2:
             return
@@ -1142,6 +5045,7 @@ class MainWindow(QMainWindow):
             self.history_browser = None
         widget.deleteLater()
         self.tab_widget.removeTab(index)
+        self.mark_session_dirty()
 
     def update_urlbar(self, url: QUrl, browser=None):
         if browser != self.tab_widget.currentWidget():
@@ -1149,56 +5053,16 @@ class MainWindow(QMainWindow):
         self.url_bar.setText(url.toString())
 
     def show_history(self):
-        if not self.history:  # Check if history is empty
+        self.load_history_data()
+        if not self.profile_store.has_history():  # Check if history is empty
             QMessageBox.information(self, "No History", "There is no browsing history to show.")
             return
 
-        history_html = """
-        <html>
-        <head>
-            <style>
-                body {
-                    font-family: 'Arial', sans-serif;
-                    margin: 20px;
-                    background-color: #f4f4f9;
-                    color: #333;
-                }
-                h1 {
-                    color: #5d647b;
-                    text-align: center;
-                }
-                ul {
-                    list-style: none;
-                    padding: 0;
-                }
-                li {
-                    background: white;
-                    border-bottom: 1px solid #ccc;
-                    padding: 10px;
-                    margin-top: 5px;
-                }
-                a {
-                    color: #5d647b;
-                    text-decoration: none;
-                }
-                a:hover {
-                    text-decoration: underline;
-                }
-            </style>
-        </head>
-        <body>
-            <h1>History</h1>
-            <ul>"""
-
-        for title, url in self.history:
-            history_html += f"<li><a href='{url}'>{title}</a> - {url}</li>"
-
-        history_html += "</ul></body></html>"
-
-        # Ensure a new tab is opened for history or update an existing one
+        # The page itself pulls entries from InternalSchemeHandler in pages as it scrolls
         if self.history_browser is None:
-            self.history_browser = self.add_tab("about:history")
-        self.history_browser.setHtml(history_html)
+            self.history_browser = self.add_tab(HISTORY_URL)
+        else:
+            self.history_browser.setUrl(QUrl(HISTORY_URL))
 
     def closeEvent(self, event):
         self.save_window_settings()
@@ -1207,14 +5071,21 @@ class MainWindow(QMainWindow):
             reply = QMessageBox.question(self, 'Close Browser',
                                          f'You have {tab_count} tabs open. Are you sure you want to close the browser?',
                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-            if reply == QMessageBox.Yes:
-                self.save_history()
-                event.accept()
-            else:
+            if reply != QMessageBox.Yes:
                 event.ignore()
-        else:
-            self.save_history()
-            event.accept()
+                return
+        self.save_session()
+        event.accept()
+
+    def shutdown(self):
+        # Runs once the event loop has stopped: stop downloads, then wait for every queued write
+        if self.download_manager_dialog is not None:
+            self.download_manager_dialog.shutdown()
+        if self.profile_store is not None:
+            self.profile_store.close()
+            self.page_text_index.close()
+            self.thumbnail_cache.close()
+        self.persistence.close()
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_F11:
@@ -1225,10 +5096,15 @@ class MainWindow(QMainWindow):
         super().keyPressEvent(event)
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    app.setStyle(QStyleFactory.create("Fusion"))
-
-    main_window = MainWindow()
+    startup_trace = StartupTrace.from_args(sys.argv)
+    startup_trace.record('import', STARTUP_BEGIN, time.perf_counter())
+    with startup_trace.phase('create_application'):
+        register_internal_scheme()
+        app = QApplication(sys.argv)
+        app.setStyle(QStyleFactory.create("Fusion"))
+
+    main_window = MainWindow(startup_trace)
     if main_window.profile:
-        main_window.show()
+        with startup_trace.phase('show_window'):
+            main_window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,491 @@
+# Headless end-to-end performance benchmarks for PyBrowser.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --output results.json --baseline baseline.json --tolerance 0.2
+#
+# Runs MainWindow on the offscreen Qt platform against a local HTTP fixture server,
+# with a benchmark profile injected so no profile dialog is shown. Every metric is
+# "lower is better"; with --baseline the run exits non-zero if any metric regressed
+# by more than the tolerance.
+import sys
+import os
+import json
+import time
+import tempfile
+import statistics
+import subprocess
+import threading
+import argparse
+import re
+import random
+import sqlite3
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PROCESS_START = time.perf_counter()
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.environ.setdefault("QTWEBENGINE_CHROMIUM_FLAGS", "--disable-gpu")
+if hasattr(os, "geteuid") and os.geteuid() == 0:
+    # Chromium refuses to run its sandbox as root, which is common in CI containers
+    os.environ.setdefault("QTWEBENGINE_DISABLE_SANDBOX", "1")
+
+BENCHMARK_PROFILE = {'first_name': 'Benchmark', 'last_name': 'User'}
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 1x1 transparent PNG used for the fixture pages' images
+PIXEL_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082")
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/page/'):
+            number = self.path.split('/')[2]
+            paragraphs = "".join(f"<p>Fixture paragraph {i} for page {number}. Lorem ipsum dolor sit amet.</p>"
+                                 for i in range(200))
+            images = "".join(f"<img src='/img/{number}-{i}.png'>" for i in range(10))
+            body = (f"<html><head><title>Fixture page {number}</title>"
+                    f"<link rel='stylesheet' href='/style.css'></head>"
+                    f"<body><h1>Fixture page {number}</h1>{images}{paragraphs}</body></html>").encode('utf-8')
+            self.send_content(body, "text/html; charset=utf-8")
+        elif self.path == '/style.css':
+            self.send_content(b"body { font-family: sans-serif; } p { margin: 4px; }", "text/css")
+        elif self.path.startswith('/img/'):
+            self.send_content(PIXEL_PNG, "image/png")
+        elif self.path.startswith('/file/'):
+            self.send_file(int(self.path.split('/')[2]))
+        else:
+            self.send_error(404)
+
+    def send_content(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "max-age=3600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, size: int):
+        # Deterministic content with Range support, for the segmented downloader
+        body = fixture_file(size)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The downloader stopped reading (paused)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def fixture_file(size: int) -> bytes:
+    pattern = bytes(range(251))  # Prime length so segment boundaries don't line up with it
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def start_fixture_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, name="FixtureServer", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def wait_for_signal(signal, timeout_ms: int = 30000) -> bool:
+    from PyQt5.QtCore import QEventLoop, QTimer
+    loop = QEventLoop()
+    fired = []
+
+    def on_signal(*args):
+        fired.append(args)
+        loop.quit()
+
+    signal.connect(on_signal)
+    QTimer.singleShot(timeout_ms, loop.quit)
+    loop.exec_()
+    signal.disconnect(on_signal)
+    return bool(fired)
+
+
+def wait_until(condition, timeout_ms: int = 30000) -> bool:
+    from PyQt5.QtWidgets import QApplication
+    deadline = time.perf_counter() + timeout_ms / 1000
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        QApplication.processEvents()
+        time.sleep(0.001)
+    return True
+
+
+def measure_cold_startup(runs: int) -> dict:
+    # Each run is a fresh process so imports and Chromium start-up are included
+    first_paint = []
+    startup_complete = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as work_dir:
+            trace_path = os.path.join(work_dir, "trace.json")
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--child-startup", trace_path],
+                           cwd=work_dir, check=True, stdout=subprocess.DEVNULL, timeout=120)
+            with open(trace_path, "r") as file:
+                milestones = json.load(file)['milestones']
+        first_paint.append(milestones['first_paint'])
+        startup_complete.append(milestones['startup_complete'])
+    return {
+        'cold_startup_first_paint_ms': statistics.median(first_paint),
+        'cold_startup_complete_ms': statistics.median(startup_complete),
+    }
+
+
+def child_startup(trace_path: str):
+    sys.path.insert(0, SOURCE_DIR)
+    import PyBrowser
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtCore import QTimer
+
+    trace = PyBrowser.StartupTrace(enabled=True, output_path=trace_path, start=PROCESS_START)
+    PyBrowser.register_internal_scheme()
+    app = QApplication([sys.argv[0]])
+    window = PyBrowser.MainWindow(trace, profile=dict(BENCHMARK_PROFILE))
+    window.show()
+
+    def quit_when_started():
+        if 'startup_complete' in trace.milestones:
+            app.quit()
+
+    timer = QTimer()
+    timer.timeout.connect(quit_when_started)
+    timer.start(10)
+    app.exec_()
+
+
+def measure_browser(base_url: str, tab_count: int) -> dict:
+    sys.path.insert(0, SOURCE_DIR)
+    import PyBrowser
+    from PyQt5.QtWidgets import QApplication
+
+    PyBrowser.register_internal_scheme()
+    # Kept for the whole run; dropping the last reference would destroy the application
+    app = QApplication([sys.argv[0]])
+    window = PyBrowser.MainWindow(profile=dict(BENCHMARK_PROFILE))
+    window.show()
+    wait_until(lambda: window.download_manager_dialog is not None)
+    metrics = {}
+
+    new_tab = []
+    for _ in range(10):
+        start = time.perf_counter()
+        browser = window.add_tab()
+        wait_for_signal(browser.loadFinished)
+        new_tab.append((time.perf_counter() - start) * 1000)
+    metrics['new_tab_ms'] = statistics.median(new_tab)
+
+    load = []
+    for number in range(10):
+        browser = window.tab_widget.currentWidget()
+        start = time.perf_counter()
+        browser.navigate_to(f"{base_url}/page/{number}")
+        wait_for_signal(browser.loadFinished)
+        load.append((time.perf_counter() - start) * 1000)
+    metrics['load_finished_ms'] = statistics.median(load)
+
+    switch = []
+    for i in range(20):
+        index = i % window.tab_widget.count()
+        start = time.perf_counter()
+        window.tab_widget.setCurrentIndex(index)
+        app.processEvents()
+        switch.append((time.perf_counter() - start) * 1000)
+    metrics['tab_switch_ms'] = statistics.median(switch)
+
+    # Time the GUI thread spends grabbing a thumbnail; scaling and encoding happen on the cache's thread
+    # The last tab is the one that loaded the fixture pages; new tab pages aren't captured
+    window.tab_widget.setCurrentIndex(window.tab_widget.count() - 1)
+    app.processEvents()
+    browser = window.tab_widget.currentWidget()
+    capture = []
+    for _ in range(10):
+        browser.thumbnail_taken = 0
+        start = time.perf_counter()
+        browser.capture_thumbnail()
+        capture.append((time.perf_counter() - start) * 1000)
+    metrics['thumbnail_capture_ms'] = statistics.median(capture)
+
+    # A long download history should not make the download manager slow to open
+    for i in range(10000):
+        window.profile_store.save_download({'filename': f"file{i}.bin", 'progress': 100, 'is_paused': False,
+                                            'is_canceled': False, 'started_at': i})
+    window.profile_store.flush()
+    start = time.perf_counter()
+    dialog = PyBrowser.DownloadManagerDialog(window)
+    dialog.show()
+    app.processEvents()
+    metrics['download_manager_10k_open_ms'] = (time.perf_counter() - start) * 1000
+    dialog.close()
+
+    browser_rss_before = PyBrowser.process_rss_bytes(os.getpid()) or 0
+    for number in range(tab_count):
+        browser = window.add_tab(f"{base_url}/page/tab{number}")
+        wait_for_signal(browser.loadFinished)
+    renderer_pids = {browser.page().renderProcessPid() for browser in window.browsers()}
+    renderer_rss = sum(PyBrowser.process_rss_bytes(pid) or 0 for pid in renderer_pids if pid > 0)
+    browser_rss = (PyBrowser.process_rss_bytes(os.getpid()) or 0) - browser_rss_before
+    metrics['rss_per_tab_mb'] = (renderer_rss + browser_rss) / len(window.browsers()) / (1024 * 1024)
+
+    # Switching users in process, until the new profile's first tab has loaded
+    profiles = [dict(BENCHMARK_PROFILE, last_name='Other'), dict(BENCHMARK_PROFILE)]
+    profile_switch = []
+    for i in range(6):
+        start = time.perf_counter()
+        window.switch_profile(profiles[i % 2])
+        wait_for_signal(window.tab_widget.currentWidget().loadFinished)
+        profile_switch.append((time.perf_counter() - start) * 1000)
+    metrics['profile_switch_ms'] = statistics.median(profile_switch)
+    # Longest the GUI thread was held up by saving settings, history, sessions and downloads
+    metrics['persistence_stall_ms'] = window.persistence.max_stall_ms
+    return metrics
+
+
+def measure_persistence(work_dir: str, sizes) -> dict:
+    sys.path.insert(0, SOURCE_DIR)
+    import PyBrowser
+    metrics = {}
+    persistence = PyBrowser.PersistenceService()
+    for size in sizes:
+        store = PyBrowser.ProfileStore(persistence, os.path.join(work_dir, f"profile_{size}"))
+        for i in range(size):
+            store.add_visit(f"Title {i}", f"https://example.com/{i}", 0)
+        store.flush()
+        start = time.perf_counter()
+        for i in range(200):
+            store.add_visit(f"New {i}", f"https://example.org/{i}", time.time())
+        metrics[f'history_append_{size}_ms'] = (time.perf_counter() - start) * 1000 / 200
+
+        for i in range(size):
+            store.save_download({'filename': f"file{i}", 'progress': 100, 'is_paused': False, 'is_canceled': False})
+        store.flush()
+        start = time.perf_counter()
+        for progress in range(100):
+            store.save_download({'filename': "file0", 'progress': progress, 'is_paused': False, 'is_canceled': False})
+        metrics[f'download_progress_{size}_ms'] = (time.perf_counter() - start) * 1000 / 100
+        start = time.perf_counter()
+        store.flush()
+        metrics[f'download_flush_{size}_ms'] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        store.close()
+        store = PyBrowser.ProfileStore(persistence, os.path.join(work_dir, f"profile_{size}"))
+        store.load_settings()
+        metrics[f'profile_open_{size}_ms'] = (time.perf_counter() - start) * 1000
+        store.close()
+
+    # A year of heavy browsing: 500 visits a day, mostly to a few thousand favourite pages
+    store = PyBrowser.ProfileStore(persistence, os.path.join(work_dir, "profile_year"))
+    random.seed(0)
+    start_of_year = time.time() - 365 * 86400
+    for visit in range(365 * 500):
+        page = min(int(random.expovariate(1 / 2000)), 49999)
+        store.add_visit(f"Page {page % 5000} on site {page % 1500}", f"https://site{page % 1500}.example.com/page/{page}",
+                        start_of_year + visit * 172.8)
+    store.flush()
+    tracemalloc.start()
+    records, _ = store.url_records()
+    index = PyBrowser.OmniboxIndex()
+    index.build(records)
+    del records
+    metrics['history_year_memory_mb'] = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+    start = time.perf_counter()
+    store.apply_history_retention(PyBrowser.HISTORY_RETENTION_DAYS, PyBrowser.HISTORY_MAX_VISITS)
+    store.flush()
+    metrics['history_compaction_ms'] = (time.perf_counter() - start) * 1000
+    store.close()
+
+    # Importing another browser's history is streamed, so its peak memory shouldn't grow with the import
+    metrics.update(measure_history_import(persistence, work_dir, 100000))
+    persistence.close()
+    return metrics
+
+
+def chrome_history_fixture(path: str, visit_count: int):
+    # Same tables and timestamps (microseconds since 1601) as Chrome's "History" database
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE urls (id INTEGER PRIMARY KEY, url LONGVARCHAR, title LONGVARCHAR);
+        CREATE TABLE visits (id INTEGER PRIMARY KEY, url INTEGER NOT NULL, visit_time INTEGER NOT NULL);
+    """)
+    url_count = max(visit_count // 10, 1)
+    connection.executemany("INSERT INTO urls VALUES (?, ?, ?)",
+                           ((i, f"https://site{i % 1500}.example.com/page/{i}", f"Page {i}") for i in range(1, url_count + 1)))
+    first_visit = (time.time() - 30 * 86400 + 11644473600) * 1000000
+    connection.executemany("INSERT INTO visits VALUES (?, ?, ?)",
+                           ((i, i % url_count + 1, int(first_visit + i * 1000000)) for i in range(1, visit_count + 1)))
+    connection.commit()
+    connection.close()
+
+
+def measure_history_import(persistence, work_dir: str, visit_count: int) -> dict:
+    import PyBrowser
+    source = os.path.join(work_dir, "History")
+    chrome_history_fixture(source, visit_count)
+    store = PyBrowser.ProfileStore(persistence, os.path.join(work_dir, "profile_import"))
+    importer = PyBrowser.HistoryImporter(store, source, PyBrowser.HISTORY_RETENTION_DAYS, PyBrowser.HISTORY_MAX_VISITS)
+    tracemalloc.start()
+    start = time.perf_counter()
+    importer.run()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    store.close()
+    return {f'history_import_{visit_count}_ms': elapsed * 1000,
+            f'history_import_{visit_count}_peak_mb': peak / (1024 * 1024)}
+
+
+def measure_downloads(base_url: str, work_dir: str) -> dict:
+    sys.path.insert(0, SOURCE_DIR)
+    import PyBrowser
+    from PyQt5.QtWebEngineWidgets import QWebEngineDownloadItem
+    size = 64 * 1024 * 1024
+    expected = fixture_file(size)
+    metrics = {}
+
+    def run_to_end(download):
+        while download.state() == QWebEngineDownloadItem.DownloadInProgress and not download.isPaused():
+            time.sleep(0.005)
+        download.wait()
+        if download.state() != QWebEngineDownloadItem.DownloadCompleted:
+            raise RuntimeError(f"download ended in state {download.state()}")
+
+    path = os.path.join(work_dir, "segmented.bin")
+    start = time.perf_counter()
+    download = PyBrowser.SegmentedDownload(f"{base_url}/file/{size}", path)
+    download.start()
+    run_to_end(download)
+    metrics['download_64mb_ms'] = (time.perf_counter() - start) * 1000
+
+    # Pause part way, then resume from the saved state as a restarted browser would
+    path = os.path.join(work_dir, "resumed.bin")
+    download = PyBrowser.SegmentedDownload(f"{base_url}/file/{size}", path)
+    download.start()
+    wait_until_plain(lambda: download.receivedBytes() >= size // 3 or download.state() != QWebEngineDownloadItem.DownloadInProgress)
+    download.pause()
+    download.wait()
+    resume_state = json.loads(json.dumps(download.resume_state()))
+    start = time.perf_counter()
+    download = PyBrowser.SegmentedDownload(resume_state['url'], resume_state['path'], resume_state=resume_state)
+    download.start()
+    run_to_end(download)
+    metrics['download_resume_ms'] = (time.perf_counter() - start) * 1000
+
+    for name in ("segmented.bin", "resumed.bin"):
+        with open(os.path.join(work_dir, name), "rb") as file:
+            if file.read() != expected:
+                raise RuntimeError(f"{name} does not match the served file")
+    return metrics
+
+
+def wait_until_plain(condition, timeout: float = 30):
+    # For code that reports from worker threads and needs no Qt event loop
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.001)
+
+
+def measure_omnibox(url_count: int) -> dict:
+    # Per-keystroke suggestion latency over a large history where a few sites hold half
+    # the URLs, so longer prefixes hit big ranges of the sorted keys and word postings
+    sys.path.insert(0, SOURCE_DIR)
+    import PyBrowser
+    random.seed(0)
+    words = [f"w{i:x}ord" for i in range(20000)]
+    sites = ["github.com", "google.com", "stackoverflow.com", "en.wikipedia.org", "youtube.com"]
+    sites += [f"site{i}.example.com" for i in range(5000)]
+    now = time.time()
+    records = []
+    for i in range(url_count):
+        site = random.choice(sites[:5]) if random.random() < 0.5 else random.choice(sites)
+        records.append((f"https://{site}/{random.choice(words)}/{i}", " ".join(random.sample(words, 6)),
+                        random.randint(1, 30), now - random.random() * 365 * 86400))
+    index = PyBrowser.OmniboxIndex()
+    index.build(records)
+    del records
+    queries = ["g", "gi", "git", "gith", "githu", "github", "github.com/", "googl", "stack", "en.wiki",
+               "site12", "w1a", "w1aord", "gith w2", "googl zzzz", "zzzz"]
+    timings = []
+    for query in queries:
+        for _ in range(5):
+            start = time.perf_counter()
+            index.query(query)
+            timings.append((time.perf_counter() - start) * 1000)
+    suffix = f"{url_count // 1000}k"
+    return {f'omnibox_query_{suffix}_median_ms': statistics.median(timings),
+            f'omnibox_query_{suffix}_max_ms': max(timings)}
+
+
+def compare_to_baseline(metrics: dict, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)['metrics']
+    regressions = []
+    for name, value in metrics.items():
+        previous = baseline.get(name)
+        if previous and value > previous * (1 + tolerance):
+            regressions.append((name, previous, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyBrowser performance benchmarks")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs. baseline (0.2 = 20%%)")
+    parser.add_argument("--startup-runs", type=int, default=3)
+    parser.add_argument("--tabs", type=int, default=10, help="tabs opened for the per-tab memory measurement")
+    parser.add_argument("--child-startup", metavar="TRACE", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_startup:
+        child_startup(args.child_startup)
+        return
+
+    output_path = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    server, base_url = start_fixture_server()
+    metrics = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Profile files are written to the working directory, so keep them out of the tree
+        os.chdir(work_dir)
+        metrics.update(measure_cold_startup(args.startup_runs))
+        metrics.update(measure_persistence(work_dir, (1000, 10000, 100000)))
+        metrics.update(measure_omnibox(500000))
+        metrics.update(measure_downloads(base_url, work_dir))
+        metrics.update(measure_browser(base_url, args.tabs))
+        os.chdir(SOURCE_DIR)
+    server.shutdown()
+
+    results = {'timestamp': time.time(), 'python': sys.version.split()[0], 'metrics': metrics}
+    with open(output_path, "w") as file:
+        json.dump(results, file, indent=2)
+    for name, value in metrics.items():
+        print(f"{name:<36} {value:10.3f}")
+
+    if baseline_path:
+        regressions = compare_to_baseline(metrics, baseline_path, args.tolerance)
+        for name, previous, value in regressions:
+            print(f"REGRESSION {name}: {previous:.3f} -> {value:.3f}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()